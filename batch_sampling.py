@@ -0,0 +1,266 @@
+import os
+import glob
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import click
+import pandas as pd
+from func import instrument
+from func.data_preparation import creation_options, stretch_quantile
+from func.sample_temp import level_count
+from func.sample_temp.sample_crop import level_class, level_name, level_stratum
+from func.sample_temp.scene_score import scene_score_stages
+from func.sample_temp.tile_kernel import resolve_kernel
+from func.sample_selection import sample_select_tiles, StreamSelect, stream_select, shard_export
+
+
+def scene_pairs(pair_list=None, image_glob=None, lc_glob=None, lc_path=None):
+    """
+    (image_path, lc_path) of every scene, from a text file (one 'image_path,lc_path' per line)
+    or from an image glob with one land cover for all scenes (lc_path) or a land cover glob (sorted, same order).
+    """
+    if pair_list is not None:
+        pairs = []
+        with open(pair_list) as f:
+            for line in f:
+                if line.strip():
+                    image_path, scene_lc_path = [item.strip() for item in line.split(',')]
+                    pairs.append((image_path, scene_lc_path))
+        return pairs
+
+    assert image_glob is not None, 'pair_list or image_glob is required'
+    image_list = sorted(glob.glob(image_glob))
+    if lc_glob is not None:
+        lc_list = sorted(glob.glob(lc_glob))
+        assert len(lc_list) == len(image_list), \
+            'images: {} land covers: {}'.format(len(image_list), len(lc_list))
+    else:
+        assert lc_path is not None, 'lc_glob or lc_path is required with image_glob'
+        lc_list = [lc_path] * len(image_list)
+    return list(zip(image_list, lc_list))
+
+
+def scene_names(image_list):
+    """
+    Unique sample prefix of every scene (image file name without extension).
+    """
+    names = []
+    for image_path in image_list:
+        name = os.path.splitext(os.path.basename(image_path))[0]
+        while name in names:
+            name = name + '_{}'.format(len(names))
+        names.append(name)
+    return names
+
+
+@click.command()
+@click.option('--pair_list', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Text file with one "image_path,lc_path" pair per line.')
+@click.option('--image_glob', type=str, default=None,
+              help='Glob of the remote sensing images, e.g. "D:\\data\\*.tif".')
+@click.option('--lc_glob', type=str, default=None,
+              help='Glob of the land cover data, matched with the images in sorted order.')
+@click.option('--lc_path', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='One land cover data for all images.')
+@click.option('--lc_target_value', type=int, required=True,
+              help='Value of the target class in the land cover data.')
+@click.option('--sample_folder', type=click.Path(exists=False), default=r'.\samples',
+              help='Folder where the selected samples of all scenes saved.')
+@click.option('--work_folder', type=click.Path(exists=False), default=r'.\batch_temp',
+              help='Folder of the processed images.')
+@click.option('--process_image', type=click.BOOL, default=True,
+              help='Whether the images are processed.')
+@click.option('--block_process', type=click.BOOL, default=False,
+              help='Whether the images are stretched block by block.')
+@click.option('--memory_mb', type=int, default=256,
+              help='Memory budget (MB) of one block.')
+@click.option('--quantile', type=click.Choice(['exact', 'histogram']), default=None,
+              help='Estimation of the 2%/98% stretch limits (default: histogram with block_process, exact otherwise).')
+@click.option('--rgb_bands', type=list, default=[2, 1, 0],
+              help='Band indices corresponding to the RGB bands in the images.')
+@click.option('--sample_size', type=int, default=256,
+              help='Size of the sample (bands, size, size)')
+@click.option('--zero_percent', type=float, default=0.2,
+              help='Save samples that are all 0 (no data in image) with the probability, values (0-1).')
+@click.option('--target_grid', type=click.BOOL, default=False,
+              help='Whether the target level of all samples is computed at once.')
+@click.option('--edge_mode', type=click.Choice(['tile', 'scene', 'gradient']), default='tile',
+              help='Edge intensity from canny of each sample, canny of image strips or gradient magnitude.')
+@click.option('--windowed', type=click.BOOL, default=False,
+              help='Whether images and land cover are read one sample row at a time.')
+@click.option('--stride', type=int, default=None,
+              help='Pixels between two candidate samples, overlapping samples when smaller than sample_size.')
+@click.option('--no_overlap', type=click.BOOL, default=False,
+              help='Whether the selected samples are kept from overlapping each other.')
+@click.option('--prescreen', type=click.BOOL, default=False,
+              help='Whether samples that are clearly no data are dropped before cropping (with windowed).')
+@click.option('--build_overviews', type=click.BOOL, default=False,
+              help='Whether the 1/8 overview of the processed images is built for prescreen when they have none.')
+@click.option('--target_bins', type=int, default=3,
+              help='Number of target (entropy) levels of the stratification.')
+@click.option('--edge_bins', type=int, default=3,
+              help='Number of edge intensity levels of the stratification.')
+@click.option('--clip_q1', type=float, default=0.05,
+              help='Lower quantile of the pooled metric range split into equal levels, values (0-1).')
+@click.option('--clip_q2', type=float, default=0.95,
+              help='Upper quantile of the pooled metric range split into equal levels, values (0-1).')
+@click.option('--pipeline', type=click.BOOL, default=False,
+              help='Whether the next sample rows of a scene are read in a background thread while scoring.')
+@click.option('--read_depth', type=int, default=2,
+              help='Sample row strips read ahead with pipeline.')
+@click.option('--kernel', type=click.Choice(['numpy', 'numba']), default='numpy',
+              help='Metrics of each sample computed by NumPy / scikit-image, or by one fused Numba kernel '
+                   '(same values, numpy when Numba is not installed).')
+@click.option('--scene_workers', type=int, default=1,
+              help='Number of scenes processed and scored in parallel.')
+@click.option('--streaming', type=click.BOOL, default=False,
+              help='Whether each scene is summarised by metric sketches and bounded reservoirs of samples, merged '
+                   'for the pooled thresholds and the selection (memory independent of the number of samples).')
+@click.option('--reservoir_size', type=int, default=1000,
+              help='Samples kept in each cell of the metric grid with streaming.')
+@click.option('--sample_percent', type=float, default=0.025,
+              help='Percentage of samples selected from all scenes, values (0-1).')
+@click.option('--seed', type=int, default=None,
+              help='Seed of the random selection (random if None), same samples as the sampling service selecting '
+                   'from the same scenes with this seed.')
+@click.option('--sample_format', type=click.Choice(['tif', 'vrt']), default='tif',
+              help='Selected samples saved as GeoTIFF, or as VRT windows of the processed images (kept).')
+@click.option('--write_workers', type=int, default=0,
+              help='Number of threads writing sample GeoTIFFs.')
+@click.option('--compress', type=click.Choice(['NONE', 'DEFLATE', 'LZW', 'ZSTD']), default='NONE',
+              help='Compression of the sample GeoTIFFs.')
+@click.option('--export_folder', type=click.Path(exists=False), default=None,
+              help='Folder where the selected image tiles of all scenes and their land cover label tiles are '
+                   'exported in fixed-size memory-mappable shards with an index (None: no export).')
+@click.option('--shard_size', type=int, default=1024,
+              help='Samples per shard of the export.')
+@click.option('--label_value', type=int, default=None,
+              help='Labels of the export: land cover classes (None) or 1 / 0 for this land cover value.')
+@click.option('--cache_folder', type=click.Path(exists=False), default=None,
+              help='Folder caching the processed images and sample levels of every scene (kept), '
+                   'reruns skip the finished scenes and sample rows.')
+@click.option('--log_mode', type=click.Choice(instrument.MODES), default='progress',
+              help='Progress lines (progress), one summary line per stage (quiet) or one JSON record per stage '
+                   'on stdout (json). The stage records are saved in <sample_folder>_report.json.')
+@click.option('--profile', type=click.BOOL, default=False,
+              help='Whether the main process is profiled with cProfile (<sample_folder>_report.prof).')
+@click.option('--trace_memory', type=click.BOOL, default=False,
+              help='Whether Python allocations are traced with tracemalloc (peak per stage, top allocations).')
+@click.option('--delete_temp_tif', type=click.BOOL, default=True,
+              help='Whether to delete the processed images')
+def batch_sampling(pair_list,
+                   image_glob,
+                   lc_glob,
+                   lc_path,
+                   lc_target_value,
+                   sample_folder,
+                   work_folder,
+                   process_image,
+                   block_process,
+                   memory_mb,
+                   quantile,
+                   rgb_bands,
+                   sample_size,
+                   zero_percent,
+                   target_grid,
+                   edge_mode,
+                   windowed,
+                   stride,
+                   no_overlap,
+                   prescreen,
+                   build_overviews,
+                   target_bins,
+                   edge_bins,
+                   clip_q1,
+                   clip_q2,
+                   pipeline,
+                   read_depth,
+                   kernel,
+                   scene_workers,
+                   streaming,
+                   reservoir_size,
+                   sample_percent,
+                   seed,
+                   sample_format,
+                   write_workers,
+                   compress,
+                   export_folder,
+                   shard_size,
+                   label_value,
+                   cache_folder,
+                   log_mode,
+                   profile,
+                   trace_memory,
+                   delete_temp_tif):
+    """
+    Score the samples of many scenes in one run, classify them with thresholds of the pooled metrics,
+    and select the training samples from all scenes together.
+    """
+    params = dict(locals())
+    instrument.configure(log_mode, profile, trace_memory)
+    quantile = stretch_quantile(quantile, block_process)
+    assert not prescreen or windowed, 'prescreen needs windowed reading'
+    kernel = resolve_kernel(kernel)  # one message, not one per scene worker
+    pairs = scene_pairs(pair_list, image_glob, lc_glob, lc_path)
+    names = scene_names([image_path for image_path, _ in pairs])
+    os.makedirs(work_folder, exist_ok=True)
+    instrument.log('scenes', len(pairs))
+    stream = StreamSelect(target_bins, edge_bins, clip_q1, clip_q2, reservoir_size, seed=seed) if streaming else None
+
+    instrument.log('-' * 10, '1. data preparation and sample scoring', '-' * 10)
+    with ProcessPoolExecutor(max_workers=scene_workers) as executor:
+        futures = [executor.submit(scene_score_stages, log_mode, trace_memory, image_path, scene_lc_path,
+                                   lc_target_value, work_folder, name, process_image, block_process, memory_mb,
+                                   quantile, rgb_bands, sample_size, zero_percent, target_grid, edge_mode, windowed,
+                                   prescreen, build_overviews, stride, cache_folder, stream, pipeline, read_depth,
+                                   kernel)
+                   for (image_path, scene_lc_path), name in zip(pairs, names)]
+        tile_list = []
+        for future in futures:
+            scene_tiles, scene_stages = future.result()
+            if streaming:
+                stream.merge(scene_tiles)  # summaries of the scene, merged as they come
+            else:
+                tile_list.append(scene_tiles)
+            for record in scene_stages:
+                instrument.add_stage(record)
+
+    instrument.log('-' * 10, '2. classify with pooled thresholds', '-' * 10)
+    write_options = None if compress == 'NONE' else creation_options(compress, block_size=sample_size)
+    if streaming:
+        sample_count = stream.sample_count()
+
+        instrument.log('-' * 10, '3. sample select', '-' * 10)
+        with instrument.stage('sample_select'):
+            stream_select(stream, sample_folder, sample_percent, sample_size, sample_format, write_workers,
+                          write_options, no_overlap, sample_count)
+    else:
+        tiles = pd.concat(tile_list, ignore_index=True)
+        target_levels, edge_levels = level_class(tiles['target'], tiles['edge'], clip_q1, clip_q2, target_bins,
+                                                 edge_bins)
+        tiles['t_level'] = target_levels
+        tiles['e_level'] = edge_levels
+        tiles['stratum'] = level_stratum(target_levels, edge_levels, edge_bins)
+        tiles['name'] = [level_name('{0}_h{1:03d}w{2:03d}.tif'.format(scene, row, col), t, e)
+                         for scene, row, col, t, e
+                         in zip(tiles['scene'], tiles['row'], tiles['col'], target_levels, edge_levels)]
+        sample_count = level_count(tiles, t_bins=target_bins, e_bins=edge_bins)
+
+        instrument.log('-' * 10, '3. sample select', '-' * 10)
+        with instrument.stage('sample_select'):
+            sample_select_tiles(sample_count, tiles, None, sample_folder, sample_percent, sample_size,
+                                sample_format, write_workers, write_options, stride, no_overlap, seed)
+
+    if export_folder is not None:
+        instrument.log('-' * 10, '4. training export', '-' * 10)
+        with instrument.stage('shard_export'):
+            shard_export(sample_folder, export_folder, {name: scene_lc_path for (_, scene_lc_path), name
+                                                        in zip(pairs, names)},
+                         None, sample_size, stride, shard_size, label_value)
+
+    if delete_temp_tif and process_image and sample_format != 'vrt':
+        shutil.rmtree(work_folder)
+    instrument.write_report(instrument.report_path(sample_folder), **params)
+
+
+if __name__ == '__main__':
+    batch_sampling()
@@ -0,0 +1,67 @@
+"""
+Edge intensity of every sample: canny of each sample (level_edge, reference)
+vs canny of image strips (scene) vs thresholded gradient magnitude (gradient).
+Reports timing and the agreement with the reference (correlation, same edge level).
+    python benchmarks/bench_edge.py --height 2048 --width 2048
+"""
+import os
+import sys
+import time
+import click
+import numpy as np
+import pandas as pd
+from skimage import filters
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from func.sample_temp.sample_crop import level_edge, level_threshold  # noqa: E402
+from func.sample_temp.level_grid import edge_level_grid  # noqa: E402
+
+
+def synthetic_rgb(height, width, seed=0):
+    """
+    uint8 (3, h, w) image with smooth texture and patches of different brightness.
+    """
+    rng = np.random.default_rng(seed)
+    texture = filters.gaussian(rng.random((height, width, 3)), sigma=4, channel_axis=-1)
+    texture = (texture - texture.min()) / (texture.max() - texture.min())
+    patch = np.kron(rng.random((height // 64 + 1, width // 64 + 1)), np.ones((64, 64)))[:height, :width]
+    image = 100 * texture + 150 * patch[:, :, np.newaxis]
+    return np.clip(image, 0, 255).astype(np.uint8).transpose(2, 0, 1)
+
+
+def edge_levels(values):
+    e_l1, e_l2 = level_threshold(values)
+    return np.where(values < e_l1, 1, np.where(values < e_l2, 2, 3))
+
+
+@click.command()
+@click.option('--height', type=int, default=2048)
+@click.option('--width', type=int, default=2048)
+@click.option('--sample_size', type=int, default=256)
+def bench_edge(height, width, sample_size):
+    image = synthetic_rgb(height, width)
+    rgb_bands = [0, 1, 2]
+    rows, cols = height // sample_size, width // sample_size
+
+    t = time.perf_counter()
+    reference = np.array([[level_edge(image[rgb_bands,
+                                            i * sample_size:(i + 1) * sample_size,
+                                            j * sample_size:(j + 1) * sample_size])
+                           for j in range(cols)] for i in range(rows)])
+    t_tile = time.perf_counter() - t
+    print('image {}  samples {}'.format(image.shape, rows * cols))
+    print('{:<9} {:>8} {:>9} {:>9} {:>11}'.format('mode', 'time(s)', 'pearson', 'spearman', 'same level'))
+    print('{:<9} {:>8.3f} {:>9} {:>9} {:>11}'.format('tile', t_tile, '-', '-', '-'))
+
+    for mode, method in [('scene', 'canny'), ('gradient', 'gradient')]:
+        t = time.perf_counter()
+        values = edge_level_grid(image, rgb_bands, rows, cols, sample_size, method=method)
+        t_mode = time.perf_counter() - t
+        pearson = np.corrcoef(reference.ravel(), values.ravel())[0, 1]
+        spearman = pd.Series(reference.ravel()).corr(pd.Series(values.ravel()), method='spearman')
+        same = np.mean(edge_levels(reference.ravel()) == edge_levels(values.ravel()))
+        print('{:<9} {:>8.3f} {:>9.3f} {:>9.3f} {:>10.1f}%'.format(mode, t_mode, pearson, spearman, same * 100))
+
+
+if __name__ == '__main__':
+    bench_edge()
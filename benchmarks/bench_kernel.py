@@ -0,0 +1,59 @@
+"""
+Metrics of every sample with the NumPy kernel (np.all, sum / 255, level_edge: reference)
+vs the fused Numba kernel (tile_kernel). Reports timing and the agreement with the reference
+(same zero count, target fraction and edge pixel count).
+    python benchmarks/bench_kernel.py --height 2048 --width 2048
+"""
+import os
+import sys
+import time
+import click
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_edge import synthetic_rgb  # noqa: E402
+from func.sample_temp.tile_kernel import tile_metrics, check_kernel, kernel_available  # noqa: E402
+
+
+@click.command()
+@click.option('--height', type=int, default=2048)
+@click.option('--width', type=int, default=2048)
+@click.option('--sample_size', type=int, default=256)
+@click.option('--seed', type=int, default=0)
+def bench_kernel(height, width, sample_size, seed):
+    if not kernel_available('numba'):
+        raise SystemExit('numba is not installed')
+    image = synthetic_rgb(height, width, seed)
+    image[:, :height // 8, :width // 8] = 0  # no data corner
+    rng = np.random.default_rng(seed)
+    lc = np.kron(rng.random((height // 32 + 1, width // 32 + 1)) < 0.4, np.ones((32, 32), dtype=np.uint8))
+    lc = lc[:height + 1, :width + 1] * 255
+    windows = [(i, j) for i in range(0, height - sample_size + 1, sample_size)
+               for j in range(0, width - sample_size + 1, sample_size)]
+    samples = [image[:, i:i + sample_size, j:j + sample_size] for i, j in windows]
+    lc_areas = [lc[i:i + sample_size + 1, j:j + sample_size + 1] for i, j in windows]
+    rgb_bands = [0, 1, 2]
+    zero_limit = 0.2 * sample_size ** 2
+
+    t = time.perf_counter()
+    tile_metrics(samples[-1], lc_areas[-1], rgb_bands, zero_limit, kernel='numba')
+    print('image {}  samples {}  numba compile (or cache load) {:.2f}s'.format(image.shape, len(samples),
+                                                                            time.perf_counter() - t))
+    print('{:<7} {:>8} {:>12}'.format('kernel', 'time(s)', 'ms / sample'))
+    for kernel in ('numpy', 'numba'):
+        t = time.perf_counter()
+        for sample, lc_area in zip(samples, lc_areas):
+            tile_metrics(sample, lc_area, rgb_bands, zero_limit, kernel=kernel)
+        seconds = time.perf_counter() - t
+        print('{:<7} {:>8.3f} {:>12.2f}'.format(kernel, seconds, 1000 * seconds / len(samples)))
+
+    check = check_kernel(samples, lc_areas, rgb_bands)
+    print('same zero count {:.1%}, same target {:.1%}, same edge count {:.1%}, max edge difference {} pixels'
+          .format(check['same_zero'], check['same_target'], check['same_edge'], check['max_edge_diff']))
+    if check['same_zero'] < 1 or check['same_target'] < 1 or check['same_edge'] < 1:
+        raise SystemExit('kernels differ')
+
+
+if __name__ == '__main__':
+    bench_kernel()
@@ -0,0 +1,192 @@
+"""
+Timing and peak memory (RSS) of every pipeline stage on synthetic GeoTIFF scenes
+(image_process, land_cover_process, sample_crop, level_table, sample_select), with reference checks of the outputs:
+the stretched raster, the class counts and the selected samples under a fixed seed.
+    python benchmarks/bench_pipeline.py --sizes 2048,4096 --bands 3,4 --dtypes uint16,float32
+    python benchmarks/bench_pipeline.py --save_reference benchmarks/reference.json
+    python benchmarks/bench_pipeline.py --reference benchmarks/reference.json
+Each stage runs in a fresh process, so its peak RSS is not hidden by the previous stages
+(the RSS of an idle process, 'base', is printed for comparison).
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import contextlib
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import click
+import numpy as np
+import pandas as pd
+from osgeo import gdal, osr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_edge import synthetic_rgb  # noqa: E402
+from func.instrument import peak_mb  # noqa: E402
+from func.data_preparation import array_proj, image_process, land_cover_process  # noqa: E402
+from func.sample_temp import sample_crop, level_table  # noqa: E402
+from func.sample_temp.manifest import load_manifest  # noqa: E402
+from func.sample_selection import sample_select  # noqa: E402
+
+LC_TARGET_VALUE = 3
+
+
+def synthetic_scene(image_path, lc_path, size, bands, dtype, seed=0, collar=True):
+    """
+    Synthetic image (bands, size, size) at 10 m and land cover (classes 1-6 from the image brightness) at 30 m,
+    covering a slightly larger extent, both in UTM 50N.
+    uint16: 12-bit values; float32: reflectance in [0, 0.6] with 0.1% NaN pixels;
+    collar: no data corners and top rows (0, NaN for float32) as in a rotated scene footprint.
+    """
+    rng = np.random.default_rng(seed)
+    rgb = np.maximum(synthetic_rgb(size, size, seed), 1)  # 0 only in the collar
+    image = np.stack([rgb[b % 3] for b in range(bands)], axis=0)
+    if dtype == 'uint16':
+        image = image.astype(np.uint16) * 16 + rng.integers(0, 16, image.shape, dtype=np.uint16)
+    elif dtype == 'float32':
+        image = (image / 255. * 0.6).astype(np.float32)
+        image[:, rng.random((size, size)) < 0.001] = np.nan
+
+    if collar:
+        y, x = np.mgrid[0:size, 0:size]
+        outside = (x + y < size // 6) | (x - y > size - size // 6) | (y < size // 32)
+        image[:, outside] = np.nan if dtype == 'float32' else 0
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32650)
+    proj = srs.ExportToWkt()
+    array_proj(image, image_path, (500000., 10., 0., 3400000., 0., -10.), proj)
+
+    gray = rgb.mean(axis=0)[:size // 3 * 3, :size // 3 * 3]
+    gray = gray.reshape(size // 3, 3, size // 3, 3).mean(axis=(1, 3))
+    lc = np.digitize(gray, np.quantile(gray, [1 / 6, 2 / 6, 3 / 6, 4 / 6, 5 / 6])).astype(np.uint8) + 1
+    lc = np.pad(lc, 10, mode='edge')
+    array_proj(lc, lc_path, (500000. - 300., 30., 0., 3400000. + 300., 0., -30.), proj)
+
+
+def raster_digest(path):
+    ds = gdal.Open(path)
+    return hashlib.sha1(np.ascontiguousarray(ds.ReadAsArray()).tobytes()).hexdigest()
+
+
+def _stage(func, args, kwargs, seed, verbose):
+    np.random.seed(seed)
+    out = sys.stdout if verbose else io.StringIO()
+    with contextlib.redirect_stdout(out):
+        t = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - t
+    return seconds, peak_mb(), result
+
+
+def run_stage(func, *args, seed=0, verbose=False, **kwargs):
+    """
+    func(*args, **kwargs) in a fresh process.
+    :return: seconds, peak RSS (MB) of the process, result
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as executor:
+        return executor.submit(_stage, func, args, kwargs, seed, verbose).result()
+
+
+def bench_case(folder, size, bands, dtype, sample_size, block_process, quantile, seed, verbose):
+    """
+    All stages of one synthetic scene.
+    :return: timing rows (stage, seconds, peak_mb), reference outputs (stretch, strata, selected)
+    """
+    image_path = os.path.join(folder, 'image.tif')
+    lc_path = os.path.join(folder, 'lc.tif')
+    image_process_path = os.path.join(folder, 'image_process.tif')
+    lc_process_path = os.path.join(folder, 'land_cover.tif')
+    temp_folder = os.path.join(folder, 'temp')
+    sample_folder = os.path.join(folder, 'samples')
+    synthetic_scene(image_path, lc_path, size, bands, dtype, seed)
+
+    rows = []
+    stages = [('image_process', image_process, (image_path, image_process_path),
+               dict(block=block_process, quantile=quantile)),
+              ('land_cover_process', land_cover_process, (image_process_path, lc_path, lc_process_path,
+                                                          LC_TARGET_VALUE), {}),
+              ('sample_crop', sample_crop, (image_process_path, lc_process_path, temp_folder),
+               dict(sample_size=sample_size, delete_temp_tif=False)),
+              ('level_table', level_table, (temp_folder,), {})]
+    results = {}
+    for name, func, args, kwargs in stages:
+        seconds, peak, results[name] = run_stage(func, *args, seed=seed, verbose=verbose, **kwargs)
+        rows.append((name, seconds, peak))
+    seconds, peak, _ = run_stage(sample_select, results['level_table'], temp_folder, sample_folder, 0.1, False,
+                                 seed=seed, verbose=verbose)
+    rows.append(('sample_select', seconds, peak))
+
+    reference = {'stretch': raster_digest(image_process_path),
+                 'strata': np.asarray(results['level_table']).tolist(),
+                 'selected': sorted(load_manifest(sample_folder)['name'].tolist())}
+    return rows, reference
+
+
+@click.command()
+@click.option('--sizes', type=str, default='2048', help='Comma separated image sizes (height = width).')
+@click.option('--bands', 'band_counts', type=str, default='4', help='Comma separated band counts.')
+@click.option('--dtypes', type=str, default='uint16,float32', help='Comma separated dtypes (uint8, uint16, float32).')
+@click.option('--sample_size', type=int, default=256)
+@click.option('--block_process', type=click.BOOL, default=False, help='image_process block by block.')
+@click.option('--quantile', type=click.Choice(['exact', 'histogram']), default='exact')
+@click.option('--seed', type=int, default=0, help='Seed of the synthetic scenes and of the sample selection.')
+@click.option('--work_folder', type=click.Path(), default=None, help='Folder of the scenes (temporary if None).')
+@click.option('--results', type=click.Path(), default=None, help='CSV of the timing and memory of every stage.')
+@click.option('--reference', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='JSON of reference outputs to check against.')
+@click.option('--save_reference', type=click.Path(dir_okay=False), default=None,
+              help='Save the outputs as reference JSON.')
+@click.option('--verbose', type=click.BOOL, default=False, help='Print the output of the stages.')
+def bench_pipeline(sizes, band_counts, dtypes, sample_size, block_process, quantile, seed, work_folder, results,
+                   reference, save_reference, verbose):
+    work_folder = tempfile.mkdtemp() if work_folder is None else work_folder
+    _, base_peak, _ = run_stage(time.sleep, 0)
+    print('base peak RSS: {:.1f} MB'.format(base_peak))
+
+    expected = {}
+    if reference is not None:
+        with open(reference) as f:
+            expected = json.load(f)
+
+    table = []
+    outputs = {}
+    failed = []
+    for size in [int(v) for v in sizes.split(',')]:
+        for bands in [int(v) for v in band_counts.split(',')]:
+            for dtype in dtypes.split(','):
+                case = 's{}_b{}_{}'.format(size, bands, dtype)
+                folder = os.path.join(work_folder, case)
+                shutil.rmtree(folder, ignore_errors=True)
+                os.makedirs(folder)
+                rows, outputs[case] = bench_case(folder, size, bands, dtype, sample_size, block_process, quantile,
+                                                 seed, verbose)
+                print('\n' + case)
+                print('{:<20} {:>9} {:>13}'.format('stage', 'time(s)', 'peak RSS(MB)'))
+                for stage, seconds, peak in rows:
+                    print('{:<20} {:>9.3f} {:>13.1f}'.format(stage, seconds, peak))
+                    table.append({'case': case, 'stage': stage, 'seconds': seconds, 'peak_mb': peak})
+                if case in expected:
+                    diff = [key for key in outputs[case] if outputs[case][key] != expected[case].get(key)]
+                    print('reference:', 'OK' if not diff else 'DIFF ' + ', '.join(diff))
+                    if diff:
+                        failed.append(case)
+                shutil.rmtree(folder, ignore_errors=True)
+
+    if results is not None:
+        pd.DataFrame(table).to_csv(results, index=False)
+    if save_reference is not None:
+        with open(save_reference, 'w') as f:
+            json.dump(outputs, f, indent=1)
+        print('\nreference saved:', save_reference)
+    if failed:
+        raise SystemExit('reference mismatch: ' + ', '.join(failed))
+
+
+if __name__ == '__main__':
+    bench_pipeline()
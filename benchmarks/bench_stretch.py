@@ -0,0 +1,47 @@
+"""
+Timing of image_stretch: float path (image_stretch_2d) vs lookup table path.
+    python benchmarks/bench_stretch.py --size 4096 --bands 4 --dtype uint16
+"""
+import os
+import sys
+import time
+import click
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from func.data_preparation.image_stretch import image_stretch  # noqa: E402
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t)
+    return min(times), result
+
+
+@click.command()
+@click.option('--size', type=int, default=4096, help='Height and width of the synthetic image.')
+@click.option('--bands', type=int, default=4, help='Number of bands.')
+@click.option('--dtype', type=click.Choice(['uint8', 'uint16', 'int16']), default='uint16')
+@click.option('--repeat', type=int, default=3, help='Repeats, the best time is reported.')
+def bench_stretch(size, bands, dtype, repeat):
+    rng = np.random.default_rng(0)
+    info = np.iinfo(dtype)
+    image = rng.integers(info.min, info.max, size=(bands, size, size), endpoint=True).astype(dtype)
+    image[:, :size // 8, :] = 0  # no data collar
+    min_list = [np.quantile(r[r != 0], 0.02) for r in image]
+    max_list = [np.quantile(r[r != 0], 0.98) for r in image]
+
+    t_float, out_float = best_time(lambda: image_stretch(image, min_list, max_list, lut=False), repeat)
+    t_lut, out_lut = best_time(lambda: image_stretch(image, min_list, max_list, lut=True), repeat)
+
+    print('image {} {}'.format(image.shape, dtype))
+    print('float path : {:.3f} s'.format(t_float))
+    print('lut path   : {:.3f} s  (x{:.2f})'.format(t_lut, t_float / t_lut))
+    print('identical  :', np.array_equal(out_float, out_lut))
+
+
+if __name__ == '__main__':
+    bench_stretch()
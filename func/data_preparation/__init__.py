@@ -1,3 +1,3 @@
-from .array_proj import array_proj
-from .image_stretch import image_process
-from .land_cover_clip import land_cover_process
+from .array_proj import array_proj, ArrayWriter, creation_options, raster_remove
+from .image_stretch import image_process, stretch_quantile
+from .land_cover_clip import land_cover_process, land_cover_vrt
@@ -1,8 +1,76 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from osgeo import gdal
 import numpy as np
 
+BUFFER_TYPES = {'uint8': gdal.GDT_Byte, 'uint16': gdal.GDT_UInt16, 'int16': gdal.GDT_Int16,
+                'uint32': gdal.GDT_UInt32, 'int32': gdal.GDT_Int32,
+                'float32': gdal.GDT_Float32, 'float64': gdal.GDT_Float64}
 
-def array_proj(array, save_path, geotrans, proj):
+
+def gdal_datatype(dtype):
+    """
+    numpy dtype -> gdal data type (Byte / UInt16 / Float32)
+    """
+    if 'int8' in np.dtype(dtype).name:
+        datatype = gdal.GDT_Byte
+    elif 'int16' in np.dtype(dtype).name:
+        datatype = gdal.GDT_UInt16
+    else:
+        datatype = gdal.GDT_Float32
+    return datatype
+
+
+def creation_options(compress=None, tiled=True, block_size=256, predictor=2):
+    """
+    GeoTIFF creation options, e.g. creation_options('DEFLATE') ->
+    ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'COMPRESS=DEFLATE', 'PREDICTOR=2']
+    :param compress: None / 'NONE', 'DEFLATE', 'LZW', 'ZSTD'
+    :param predictor: 2 (horizontal differencing, integer data), 3 (floating point) or None
+    """
+    options = []
+    block_size = -(-block_size // 16) * 16  # multiple of 16
+    if tiled:
+        options += ['TILED=YES', 'BLOCKXSIZE={}'.format(block_size), 'BLOCKYSIZE={}'.format(block_size)]
+    if compress and compress.upper() != 'NONE':
+        options += ['COMPRESS={}'.format(compress.upper())]
+        if predictor:
+            options += ['PREDICTOR={}'.format(predictor)]
+    return options
+
+
+def array_create(save_path, width, height, bands, datatype, geotrans, proj, options=None):
+    """
+    Create an empty GeoTIFF, which is filled later (e.g. block by block).
+    Usage:
+        ds = array_create(save_path, width, height, bands, gdal.GDT_Byte, geotrans, proj)
+        ds.GetRasterBand(1).WriteArray(block, 0, y_offset)
+        ...
+        del ds
+    :param options: GeoTIFF creation options, see creation_options
+    """
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(save_path, width, height, bands, datatype, options=options or [])
+    ds.SetGeoTransform(geotrans)
+    ds.SetProjection(proj)
+
+    if bands > 3:
+        gdal.PushErrorHandler('CPLQuietErrorHandler')
+        ds.GetRasterBand(4).SetColorInterpretation(gdal.GCI_GrayIndex)  # not alpha
+    return ds
+
+
+def raster_remove(path):
+    """
+    Remove a GeoTIFF and its external overviews (path + '.ovr', see zero_fraction_grid) when there are any.
+    """
+    os.remove(path)
+    if os.path.exists(path + '.ovr'):
+        os.remove(path + '.ovr')
+
+
+def array_proj(array, save_path, geotrans, proj, options=None):
     """
     (bands, height, width) = array.shape
     Usage:
@@ -12,32 +80,67 @@ def array_proj(array, save_path, geotrans, proj):
         # del image_ds
         ...
         array_proj(image_array, save_path, geotrans, proj)
+    :param options: GeoTIFF creation options, see creation_options
     """
-    if 'int8' in array.dtype.name:
-        datatype = gdal.GDT_Byte
-    elif 'int16' in array.dtype.name:
-        datatype = gdal.GDT_UInt16
-    else:
-        datatype = gdal.GDT_Float32
+    datatype = gdal_datatype(array.dtype)
 
     if len(array.shape) == 3:
         bands, height, width = array.shape
     else:
         bands, (height, width) = 1, array.shape
 
-    driver = gdal.GetDriverByName('GTiff')
-    ds = driver.Create(save_path, width, height, bands, datatype)
-    ds.SetGeoTransform(geotrans)
-    ds.SetProjection(proj)
+    ds = array_create(save_path, width, height, bands, datatype, geotrans, proj, options)
 
-    if bands > 3:
-        gdal.PushErrorHandler('CPLQuietErrorHandler')
-        ds.GetRasterBand(4).SetColorInterpretation(gdal.GCI_GrayIndex)  # not alpha
-
-    if bands == 1:
+    if bands > 1 and array.dtype.name in BUFFER_TYPES:  # all bands in one call
+        ds.WriteRaster(0, 0, width, height, np.ascontiguousarray(array).tobytes(),
+                       buf_type=BUFFER_TYPES[array.dtype.name])
+    elif bands == 1:
         if len(array.shape) == 3:
             array = np.squeeze(array, axis=0)
         ds.GetRasterBand(1).WriteArray(array)
     else:
         for band in range(bands):
-            ds.GetRasterBand(band + 1).WriteArray(array[band])
\ No newline at end of file
+            ds.GetRasterBand(band + 1).WriteArray(array[band])
+
+
+class ArrayWriter:
+    """
+    array_proj calls queued on a bounded thread pool (GDAL releases the GIL while writing),
+    so the caller keeps computing while the files are written.
+    Usage:
+        with ArrayWriter(workers=4) as writer:
+            writer.write(array, save_path, geotrans, proj)  # blocks only when max_pending writes are queued
+        # all files written here
+    workers=0 writes synchronously.
+    """
+    def __init__(self, workers=4, max_pending=64, options=None):
+        self.options = options
+        self.pool = ThreadPoolExecutor(workers) if workers > 0 else None
+        self.pending = threading.BoundedSemaphore(max(max_pending, 1))
+        self.futures = []
+
+    def write(self, array, save_path, geotrans, proj):
+        if self.pool is None:
+            array_proj(array, save_path, geotrans, proj, self.options)
+            return
+        self.pending.acquire()
+        future = self.pool.submit(array_proj, array, save_path, geotrans, proj, self.options)
+        future.add_done_callback(lambda _: self.pending.release())
+        self.futures.append(future)
+
+    def close(self):
+        """
+        Wait for all queued writes, and raise the first error of them.
+        """
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,145 @@
+from osgeo import gdal
+import numpy as np
+
+
+def block_rows(width, bands, itemsize, memory_mb=256):
+    """
+    Number of image rows read at a time, so that one block (input, float32 copy and uint8 output) fits in memory_mb,
+    with the temporaries of image_stretch_2d on one band (nan_to_num copy, int64 mask, float32 intermediates, uint8).
+    """
+    row_bytes = width * (bands * (itemsize + 4 + 1) + itemsize + 8 + 3 * 4 + 1)
+    return int(max(1, memory_mb * 1024 ** 2 // row_bytes))
+
+
+def quantile_from_counts(values, counts, q):
+    """
+    Same as np.quantile (linear) of the data summarised by (values, counts), values ascending.
+    """
+    cum = np.cumsum(counts)
+    n = cum[-1]
+    if n == 0:
+        return 0.
+    pos = q * (n - 1)
+    lo, hi = int(np.floor(pos)), int(np.ceil(pos))
+    v_lo = values[np.searchsorted(cum, lo, side='right')]
+    v_hi = values[np.searchsorted(cum, hi, side='right')]
+    return v_lo + (pos - lo) * (v_hi - v_lo)
+
+
+class IntHistogram:
+    """
+    Exact value counts of an integer band (uint8 / int8 / uint16 / int16).
+    """
+    def __init__(self, dtype):
+        info = np.iinfo(dtype)
+        self.offset = int(info.min)
+        self.counts = np.zeros(int(info.max) - int(info.min) + 1, dtype=np.int64)
+
+    def add(self, values):
+        values = values[values != 0]
+        if values.size:
+            self.counts += np.bincount((values.astype(np.int64) - self.offset), minlength=self.counts.size)
+
+    def quantile(self, q):
+        values = np.arange(self.counts.size, dtype=np.float64) + self.offset
+        return quantile_from_counts(values, self.counts, q)
+
+
+class FloatHistogram:
+    """
+    Fixed number of equal-width bins over a range that doubles when new values fall outside it.
+    The error of a quantile is at most one bin width, (max - min) / bins * 2.
+    """
+    def __init__(self, bins=65536):
+        self.bins = bins
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.lo = None
+        self.width = None
+
+    def _grow(self, vmin, vmax):
+        while vmin < self.lo or vmax >= self.lo + self.width * self.bins:
+            merged = self.counts.reshape(-1, 2).sum(axis=1)
+            self.counts[:] = 0
+            if vmin < self.lo:  # extend downward, old range -> upper half
+                self.counts[self.bins // 2:] = merged
+                self.lo = self.lo - self.width * self.bins
+            else:  # extend upward, old range -> lower half
+                self.counts[:self.bins // 2] = merged
+            self.width = self.width * 2
+
+    def add(self, values):
+        values = values[(values != 0) & ~np.isnan(values)]
+        if values.size == 0:
+            return
+        vmin, vmax = float(values.min()), float(values.max())
+        if self.lo is None:
+            self.lo = vmin
+            self.width = max((vmax - vmin) / self.bins, np.finfo(np.float32).tiny) * (1 + 1e-6)
+        self._grow(vmin, vmax)
+        idx = np.floor((values.astype(np.float64) - self.lo) / self.width).astype(np.int64)
+        idx = np.clip(idx, 0, self.bins - 1)
+        self.counts += np.bincount(idx, minlength=self.bins)
+
+    def quantile(self, q):
+        if self.lo is None:
+            return 0.
+        centers = self.lo + (np.arange(self.bins) + 0.5) * self.width
+        return quantile_from_counts(centers, self.counts, q)
+
+
+def band_histogram(dtype, bins=65536):
+    if np.issubdtype(dtype, np.integer) and np.dtype(dtype).itemsize <= 2:
+        return IntHistogram(dtype)
+    return FloatHistogram(bins)
+
+
+def histogram_quantiles(img_ds, q1=0.02, q2=0.98, memory_mb=256, bins=65536):
+    """
+    Per-band quantiles of the non-zero pixels from one streaming pass over row blocks.
+    Exact (same as np.quantile) for 8/16-bit integer images, bounded error for float images.
+    :return: min_list, max_list
+    """
+    C, H, W = img_ds.RasterCount, img_ds.RasterYSize, img_ds.RasterXSize
+    itemsize = gdal.GetDataTypeSize(img_ds.GetRasterBand(1).DataType) // 8
+    rows = block_rows(W, C, itemsize, memory_mb)
+
+    hist_list = None
+    for y in range(0, H, rows):
+        block = img_ds.ReadAsArray(0, y, W, min(rows, H - y))
+        if len(block.shape) == 2:
+            block = block[np.newaxis]
+        if hist_list is None:
+            hist_list = [band_histogram(block.dtype, bins) for _ in range(C)]
+        for c in range(C):
+            hist_list[c].add(block[c].ravel())
+
+    min_list = [hist.quantile(q1) for hist in hist_list]
+    max_list = [hist.quantile(q2) for hist in hist_list]
+    return min_list, max_list
+
+
+def exact_quantiles(img_ds, q1=0.02, q2=0.98):
+    """
+    Per-band np.quantile of the non-zero pixels, one full band in memory at a time.
+    :return: min_list, max_list
+    """
+    min_list, max_list = [], []
+    for c in range(img_ds.RasterCount):
+        r = img_ds.GetRasterBand(c + 1).ReadAsArray()
+        r = np.nan_to_num(r, nan=0)
+        r = r[r != 0]
+        min_list.append(np.quantile(r, q1))
+        max_list.append(np.quantile(r, q2))
+        del r
+    return min_list, max_list
+
+
+def band_quantiles(img_ds, q1=0.02, q2=0.98, method='exact', memory_mb=256):
+    """
+    :param method: 'exact' (np.quantile on each band) or 'histogram' (one streaming pass)
+    """
+    if method == 'histogram':
+        return histogram_quantiles(img_ds, q1, q2, memory_mb)
+    elif method == 'exact':
+        return exact_quantiles(img_ds, q1, q2)
+    raise ValueError('quantile method should be exact or histogram: {}'.format(method))
@@ -1,7 +1,9 @@
 import os
 from osgeo import gdal, gdalconst
 import numpy as np
-from .array_proj import array_proj
+from func import instrument
+from .array_proj import array_proj, array_create
+from .image_quantile import block_rows, band_quantiles
 
 
 def image_stretch_2d(image, tmin, tmax):
@@ -18,16 +20,41 @@ def image_stretch_2d(image, tmin, tmax):
     return image
 
 
-def image_stretch(image, min_list, max_list):
+def stretch_lut(dtype, tmin, tmax):
+    """
+    Lookup table of image_stretch_2d for every value of an 8/16-bit integer dtype,
+    indexed by the unsigned view of the values (see image_stretch_lut).
+    """
+    dtype = np.dtype(dtype)
+    index_dtype = np.dtype('uint{}'.format(dtype.itemsize * 8))
+    values = np.arange(np.iinfo(index_dtype).max + 1, dtype=index_dtype).view(dtype)
+    return image_stretch_2d(values, tmin, tmax)
+
+
+def image_stretch_lut(image, tmin, tmax):
+    """
+    (h, w) 8/16-bit integer -> 255 uint8, identical to image_stretch_2d with one lookup.
+    """
+    index_dtype = np.dtype('uint{}'.format(image.dtype.itemsize * 8))
+    return stretch_lut(image.dtype, tmin, tmax)[image.view(index_dtype)]
+
+
+def lut_dtype(dtype):
+    return np.issubdtype(dtype, np.integer) and np.dtype(dtype).itemsize <= 2
+
+
+def image_stretch(image, min_list, max_list, lut=True):
     """
     (c, h, w) -> uint8
+    :param lut: use the lookup table for 8/16-bit integer images (float images keep image_stretch_2d)
     """
+    stretch_2d = image_stretch_lut if lut and lut_dtype(image.dtype) else image_stretch_2d
     if len(image.shape) == 3:
         c, h, w = image.shape
-        image_bands = [image_stretch_2d(image[i, :, :], min_list[i], max_list[i]) for i in range(c)]
+        image_bands = [stretch_2d(image[i, :, :], min_list[i], max_list[i]) for i in range(c)]
         image = np.stack(image_bands, axis=0)
     elif len(image.shape) == 2:
-        image = image_stretch_2d(image, min_list[0], max_list[0])
+        image = stretch_2d(image, min_list[0], max_list[0])
     return image.astype(np.uint8)
 
 
@@ -55,34 +82,95 @@ def merge_two_tif(tif_path1, tif_path2, save_path):
     del raster_list
 
 
-def image_process(img_path, save_path, q1=0.02, q2=0.98):
+def stretch_quantile(quantile, block=False):
+    """
+    Estimation of the stretch limits: quantile, or when None 'histogram' for block processing
+    (memory bounded by memory_mb) and 'exact' otherwise.
+    """
+    return quantile or ('histogram' if block else 'exact')
+
+
+def image_process_block(img_path, save_path, q1=0.02, q2=0.98, memory_mb=256, quantile='histogram'):
+    """
+    Stretch the image block by block and write it into one uint8 GeoTIFF.
+    The peak memory is set by memory_mb instead of the image size,
+    except with quantile='exact', which reads one full band at a time for np.quantile.
+    """
+    img_ds = gdal.Open(img_path)
+    img_geo = img_ds.GetGeoTransform()
+    img_proj = img_ds.GetProjection()
+    C, H, W = img_ds.RasterCount, img_ds.RasterYSize, img_ds.RasterXSize
+    itemsize = gdal.GetDataTypeSize(img_ds.GetRasterBand(1).DataType) // 8
+
+    instrument.progress('Processing image ... : {}'.format(img_path))
+
+    with instrument.step('stretch', bytes_read=C * H * W * itemsize):
+        min_list, max_list = band_quantiles(img_ds, q1, q2, quantile, memory_mb)
+
+    out_ds = array_create(save_path, W, H, C, gdal.GDT_Byte, img_geo, img_proj)
+    rows = block_rows(W, C, itemsize, memory_mb)
+    for y in range(0, H, rows):
+        h = min(rows, H - y)
+        with instrument.step('read') as step:
+            block = img_ds.ReadAsArray(0, y, W, h)  # (c, h, w) or (h, w)
+            step.add(bytes_read=block.nbytes)
+        with instrument.step('stretch'):
+            block = image_stretch(block, min_list, max_list)
+        if len(block.shape) == 2:
+            block = block[np.newaxis]
+        with instrument.step('write', bytes_written=block.nbytes):
+            for c in range(C):
+                out_ds.GetRasterBand(c + 1).WriteArray(block[c], 0, y)
+        instrument.progress('Processing image ... : {} [{}/{}]'.format(img_path, y + h, H))
+    with instrument.step('write'):
+        out_ds.FlushCache()
+        del out_ds, img_ds
+    instrument.progress_end('Image saved (uint8): {}'.format(save_path))
+
+
+def image_process(img_path, save_path, q1=0.02, q2=0.98, block=False, memory_mb=256, quantile=None):
     """
     Stretch the remote sensing image and save it in uint8 format.
     :param img_path: remote sensing image path
     :param save_path: save path
     :param q1:
     :param q2:
+    :param block: stream the image block by block into the output (see image_process_block)
+    :param memory_mb: memory budget (MB) of one block
+    :param quantile: 'exact' (np.quantile, one full band in memory) or 'histogram' (one streaming pass,
+                     see histogram_quantiles); None: 'histogram' with block, 'exact' otherwise
     :return:
     """
     assert '.tif' in img_path
     assert '.tif' in save_path
+    quantile = stretch_quantile(quantile, block)
+    if block:
+        return image_process_block(img_path, save_path, q1, q2, memory_mb, quantile)
+
     img_ds = gdal.Open(img_path)
     img_geo = img_ds.GetGeoTransform()
     img_proj = img_ds.GetProjection()
 
-    print('Processing image ... :', img_path, end='')
+    instrument.progress('Processing image ... : {}'.format(img_path))
 
-    image = img_ds.ReadAsArray()  # (c, h, w)
+    if quantile != 'exact':
+        with instrument.step('stretch'):
+            min_list, max_list = band_quantiles(img_ds, q1, q2, quantile, memory_mb)
+    with instrument.step('read') as step:
+        image = img_ds.ReadAsArray()  # (c, h, w)
+        step.add(bytes_read=image.nbytes)
     del img_ds
     C, H, W = image.shape
     # print('image', image.shape, np.max(image), image.dtype)
 
-    image = np.nan_to_num(image, nan=0)  # transform nan to 0
-    img_list = np.split(image, C, axis=0)
-    min_list = [np.quantile(r[r != 0], q1) for r in img_list]
-    max_list = [np.quantile(r[r != 0], q2) for r in img_list]
-    # print(min_list, max_list)
-    del img_list
+    with instrument.step('stretch'):
+        image = np.nan_to_num(image, nan=0)  # transform nan to 0
+        if quantile == 'exact':
+            img_list = np.split(image, C, axis=0)
+            min_list = [np.quantile(r[r != 0], q1) for r in img_list]
+            max_list = [np.quantile(r[r != 0], q2) for r in img_list]
+            # print(min_list, max_list)
+            del img_list
 
     """ Avoiding memory shortage """
     image1 = image[:, :, :(W // 2)]
@@ -90,21 +178,26 @@ def image_process(img_path, save_path, q1=0.02, q2=0.98):
     del image
 
     # --- image 1 ---
-    image1 = image_stretch(image1, min_list, max_list)
-    array_proj(image1, save_path[:-4] + '_temp1.tif', img_geo, img_proj)
+    with instrument.step('stretch'):
+        image1 = image_stretch(image1, min_list, max_list)
+    with instrument.step('write', bytes_written=image1.nbytes):
+        array_proj(image1, save_path[:-4] + '_temp1.tif', img_geo, img_proj)
     del image1
 
     # --- image 2 ---
     clip_geo = list(img_geo)
     clip_geo[0] = img_geo[0] + (W // 2) * img_geo[1]
-    image2 = image_stretch(image2, min_list, max_list)
-    array_proj(image2, save_path[:-4] + '_temp2.tif', clip_geo, img_proj)
+    with instrument.step('stretch'):
+        image2 = image_stretch(image2, min_list, max_list)
+    with instrument.step('write', bytes_written=image2.nbytes):
+        array_proj(image2, save_path[:-4] + '_temp2.tif', clip_geo, img_proj)
     del image2
 
     # ----- merge -----
-    merge_two_tif(save_path[:-4] + '_temp1.tif',
-                  save_path[:-4] + '_temp2.tif',
-                  save_path)
+    with instrument.step('write', bytes_written=C * H * W):
+        merge_two_tif(save_path[:-4] + '_temp1.tif',
+                      save_path[:-4] + '_temp2.tif',
+                      save_path)
     os.remove(save_path[:-4] + '_temp1.tif')
     os.remove(save_path[:-4] + '_temp2.tif')
-    print('\r' + 'Image saved (uint8):', save_path)
+    instrument.progress_end('Image saved (uint8): {}'.format(save_path))
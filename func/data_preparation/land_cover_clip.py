@@ -1,7 +1,9 @@
 import os
 from osgeo import gdal
 import numpy as np
+from func import instrument
 from .array_proj import array_proj
+from .image_quantile import block_rows
 
 
 def land_cover_clip(img_path, lc_path, lc_save_path):
@@ -18,33 +20,111 @@ def land_cover_clip(img_path, lc_path, lc_save_path):
     gdal.Warp(lc_save_path, lc_ds, options=options)
 
 
-def land_cover_process(img_path, lc_path, lc_save_path, class_value):
+def land_cover_vrt(img_path, lc_path):
+    """
+    The land cover warped onto the exact image grid (extent, resolution, size), nearest neighbour, in a VRT:
+    windows of the image and of the VRT cover the same ground. No file is written.
+    """
+    img_ds = gdal.Open(img_path)
+    img_geo = img_ds.GetGeoTransform()
+    img_proj = img_ds.GetProjection()
+    W, H = img_ds.RasterXSize, img_ds.RasterYSize
+    del img_ds
+
+    x1, x2 = img_geo[0], img_geo[0] + img_geo[1] * W
+    y1, y2 = img_geo[3], img_geo[3] + img_geo[5] * H
+    options = gdal.WarpOptions(format='VRT',
+                               outputBounds=[min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)],
+                               width=W,
+                               height=H,
+                               dstSRS=img_proj,
+                               resampleAlg='near')
+    return gdal.Warp('', gdal.Open(lc_path), options=options)
+
+
+def land_cover_align(img_path, lc_path, class_value, memory_mb=256):
+    """
+    Warp the land cover onto the exact image grid (see land_cover_vrt),
+    and extract the target class block by block into a MEM dataset (uint8, True=255).
+    No file is written.
+    :param class_value: target class value, or list of values of several target classes: the land cover classes
+                        are kept (data type of the land cover)
+    :return: gdal MEM dataset with the image geotransform and projection
+    """
+    img_ds = gdal.Open(img_path)
+    img_geo = img_ds.GetGeoTransform()
+    img_proj = img_ds.GetProjection()
+    W, H = img_ds.RasterXSize, img_ds.RasterYSize
+    del img_ds
+
+    lc_vrt = land_cover_vrt(img_path, lc_path)
+
+    classes = isinstance(class_value, (list, tuple))
+    lc_ds = gdal.GetDriverByName('MEM').Create('', W, H, 1,
+                                               lc_vrt.GetRasterBand(1).DataType if classes else gdal.GDT_Byte)
+    lc_ds.SetGeoTransform(img_geo)
+    lc_ds.SetProjection(img_proj)
+    lc_band = lc_ds.GetRasterBand(1)
+
+    itemsize = gdal.GetDataTypeSize(lc_vrt.GetRasterBand(1).DataType) // 8
+    rows = block_rows(W, 1, itemsize, memory_mb)
+    for y in range(0, H, rows):
+        with instrument.step('warp') as step:
+            block = lc_vrt.ReadAsArray(0, y, W, min(rows, H - y))
+            step.add(bytes_read=block.nbytes)
+        with instrument.step('write', bytes_written=block.size):
+            if not classes:
+                block = (block == class_value).view(np.uint8) * np.uint8(255)
+            lc_band.WriteArray(block, 0, y)
+    del lc_vrt
+    return lc_ds
+
+
+def land_cover_process(img_path, lc_path, lc_save_path, class_value, in_memory=False, memory_mb=256):
     """
     Clip the land cover to image extent, and extract the target class.
     :param img_path:
     :param lc_path:
     :param lc_save_path:
-    :param class_value: the target class value in land cover
-    :return:
+    :param class_value: the target class value in land cover, or a list of values of several target classes
+                        (the land cover classes are kept instead of the 0/255 mask)
+    :param in_memory: align the land cover to the image grid in memory (see land_cover_align), lc_save_path unused
+    :param memory_mb: memory budget (MB) of one block, used when in_memory=True
+    :return: lc_save_path, or the MEM dataset when in_memory=True
     """
     # clip land cover to image extent
     assert '.tif' in img_path
     assert '.tif' in lc_path
-    print('Processing land cover ... :', lc_path, end='')
+    instrument.progress('Processing land cover ... : {}'.format(lc_path))
+
+    classes = isinstance(class_value, (list, tuple))
+    if in_memory:
+        lc_ds = land_cover_align(img_path, lc_path, class_value, memory_mb)
+        instrument.progress_end('Land cover aligned to image grid in memory ({}): {}'.format(
+            'classes' if classes else 'True=255', lc_path))
+        return lc_ds
 
     lc_template_path = lc_save_path[:-4] + '_temp.tif'
-    land_cover_clip(img_path, lc_path, lc_template_path)
+    with instrument.step('warp'):
+        land_cover_clip(img_path, lc_path, lc_save_path if classes else lc_template_path)
+    if classes:
+        instrument.progress_end('Land cover saved (classes): {}'.format(lc_path))
+        return lc_save_path
 
     # transfer to 0/255
     lc_ds = gdal.Open(lc_template_path)
     lc_geo = lc_ds.GetGeoTransform()
     lc_proj = lc_ds.GetProjection()
 
-    lc = lc_ds.ReadAsArray()
+    with instrument.step('read') as step:
+        lc = lc_ds.ReadAsArray()
+        step.add(bytes_read=lc.nbytes)
     del lc_ds
     lc = np.where(lc == class_value, 1, 0)
     lc = (lc * 255).astype(np.uint8)
-    array_proj(lc, lc_save_path, lc_geo, lc_proj)
+    with instrument.step('write', bytes_written=lc.nbytes):
+        array_proj(lc, lc_save_path, lc_geo, lc_proj)
 
     os.remove(lc_template_path)
-    print('\r' + 'Land cover saved (True=255):', lc_path)
+    instrument.progress_end('Land cover saved (True=255): {}'.format(lc_path))
+    return lc_save_path
@@ -0,0 +1,248 @@
+"""
+Run instrumentation: wall time, CPU time, peak memory, bytes read / written and samples per second
+of every stage and of its sub-steps (read, stretch, warp, zero_filter, target, edge, write),
+and the progress lines of the pipeline.
+    from func import instrument
+    instrument.configure('quiet')
+    with instrument.stage('sample_crop'):
+        with instrument.step('read') as step:
+            strip = ...
+            step.add(bytes_read=strip.nbytes)
+    instrument.write_report(report_path)
+CPU time and sub-steps are those of the main process (the scoring workers of sample_crop(workers > 1)
+are only in the stage wall time).
+"""
+import os
+import sys
+import json
+import time
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+
+MODES = ('progress', 'quiet', 'json')
+
+_state = {'mode': 'progress', 'stages': [], 'current': None, 'profiler': None, 'started': time.time()}
+
+
+class Step:
+    """
+    Totals of one sub-step within a stage.
+    """
+    __slots__ = ('wall', 'cpu', 'calls', 'bytes_read', 'bytes_written', 'tiles')
+
+    def __init__(self):
+        self.wall = self.cpu = 0.
+        self.calls = self.bytes_read = self.bytes_written = self.tiles = 0
+
+    def add(self, bytes_read=0, bytes_written=0, tiles=0):
+        self.bytes_read += int(bytes_read)
+        self.bytes_written += int(bytes_written)
+        self.tiles += int(tiles)
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+def configure(mode='progress', profile=False, trace_memory=False):
+    """
+    :param mode: 'progress' (progress lines as before), 'quiet' (no progress lines, one summary line per stage)
+                 or 'json' (one JSON line per stage on stdout, messages on stderr)
+    :param profile: run cProfile over the whole run, saved next to the report
+    :param trace_memory: tracemalloc peak of the Python allocations per stage, and top allocations in the report
+    """
+    assert mode in MODES, 'mode should be one of {}'.format(MODES)
+    _state.update(mode=mode, stages=[], current=None, started=time.time(), profiler=None)
+    if profile:
+        _state['profiler'] = cProfile.Profile()
+        _state['profiler'].enable()
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def progress(text):
+    """
+    Progress line rewritten in place ('\\r'), only in progress mode.
+    """
+    if _state['mode'] == 'progress':
+        print('\r' + text, end='')
+
+
+def progress_end(text):
+    """
+    Last line of a progress sequence, kept in every mode.
+    """
+    if _state['mode'] == 'progress':
+        print('\r' + text)
+    else:
+        log(text)
+
+
+def log(*args, **kwargs):
+    """
+    Message of the pipeline: stdout, or stderr in json mode (stdout is kept for the stage records).
+    """
+    if _state['mode'] == 'json':
+        kwargs['file'] = sys.stderr
+    print(*args, **kwargs)
+
+
+def reset_peak():
+    """
+    Reset the peak resident memory of the process (Linux: VmHWM through /proc/self/clear_refs).
+    :return: whether the peak could be reset (otherwise peak_mb is the peak since the process start)
+    """
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_mb():
+    """
+    Peak resident memory of the process (MB), NaN when it cannot be read.
+    """
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    try:
+        import resource
+    except ImportError:  # Windows
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 1024 ** 2
+        except ImportError:
+            return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+@contextmanager
+def stage(name, **info):
+    """
+    Record one stage of the run (nested stages are recorded as separate stages).
+    :param info: extra values saved with the stage record (paths, sizes ...)
+    """
+    parent = _state['current']
+    record = {'stage': name, 'steps': {}, 'tiles': 0}
+    record.update(info)
+    peak_reset = reset_peak()
+    wall, cpu = time.perf_counter(), time.process_time()
+    _state['current'] = record
+    try:
+        yield record
+    finally:
+        record['wall'] = time.perf_counter() - wall
+        record['cpu'] = time.process_time() - cpu
+        record['peak_mb'] = peak_mb()
+        record['peak_since_start'] = not peak_reset
+        if tracemalloc.is_tracing():
+            record['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        record['steps'] = {key: value.as_dict() for key, value in record['steps'].items()}
+        record['bytes_read'] = sum(value['bytes_read'] for value in record['steps'].values())
+        record['bytes_written'] = sum(value['bytes_written'] for value in record['steps'].values())
+        record['tiles_per_s'] = record['tiles'] / record['wall'] if record['wall'] > 0 else 0.
+        _state['stages'].append(record)
+        _state['current'] = parent
+        _emit(record)
+
+
+@contextmanager
+def step(name, bytes_read=0, bytes_written=0, tiles=0):
+    """
+    Add the time of the block to the sub-step of the current stage (nothing recorded outside a stage).
+    :return: Step, step.add(bytes_read, bytes_written, tiles) for amounts known at the end of the block
+    """
+    record = _state['current']
+    if record is None:
+        yield Step()
+        return
+    totals = record['steps'].get(name)
+    if totals is None:
+        totals = record['steps'][name] = Step()
+    totals.add(bytes_read, bytes_written, tiles)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield totals
+    finally:
+        totals.wall += time.perf_counter() - wall
+        totals.cpu += time.process_time() - cpu
+        totals.calls += 1
+
+
+def add_tiles(number):
+    """
+    Count samples processed by the current stage (samples per second of the stage).
+    """
+    if _state['current'] is not None:
+        _state['current']['tiles'] += int(number)
+
+
+def annotate(**info):
+    """
+    Add values to the record of the current stage (e.g. the stalls of a pipelined stage).
+    """
+    if _state['current'] is not None:
+        _state['current'].update(info)
+
+
+def stages():
+    """
+    Stage records of the run so far.
+    """
+    return _state['stages']
+
+
+def add_stage(record):
+    """
+    Add a stage record made in another process (e.g. a scene scored by a worker).
+    """
+    _state['stages'].append(record)
+
+
+def _emit(record):
+    if _state['mode'] == 'json':
+        print(json.dumps(record, default=str), flush=True)
+        return
+    steps = ' '.join('{}:{:.2f}s'.format(key, value['wall']) for key, value in record['steps'].items())
+    text = '[{}] wall {:.2f}s cpu {:.2f}s peak {:.0f} MB read {:.1f} MB written {:.1f} MB'.format(
+        record['stage'], record['wall'], record['cpu'], record['peak_mb'],
+        record['bytes_read'] / 1024 ** 2, record['bytes_written'] / 1024 ** 2)
+    if record['tiles']:
+        text += ' samples {} ({:.1f}/s)'.format(record['tiles'], record['tiles_per_s'])
+    print(('\n' if _state['mode'] == 'progress' else '') + text + (' | ' + steps if steps else ''))
+
+
+def report_path(sample_folder):
+    """
+    Run report next to the sample folder: <sample_folder>_report.json
+    """
+    return os.path.normpath(os.path.abspath(sample_folder)) + '_report.json'
+
+
+def write_report(path, **info):
+    """
+    Save the stage records (and the cProfile stats / tracemalloc top allocations when enabled) as JSON.
+    :param info: run parameters saved in the report
+    """
+    report = {'started': _state['started'], 'finished': time.time(), 'mode': _state['mode'],
+              'info': info, 'stages': _state['stages']}
+    if _state['profiler'] is not None:
+        _state['profiler'].disable()
+        report['profile'] = os.path.splitext(path)[0] + '.prof'
+        _state['profiler'].dump_stats(report['profile'])
+    if tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot()
+        report['tracemalloc_top'] = [{'where': str(stat.traceback), 'size_mb': stat.size / 1024 ** 2,
+                                      'count': stat.count}
+                                     for stat in snapshot.statistics('lineno')[:20]]
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1, default=str)
+    log('run report:', path)
+    return path
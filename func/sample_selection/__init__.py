@@ -1 +1,3 @@
-from .sample_select import sample_select
\ No newline at end of file
+from .sample_select import sample_select, sample_select_tiles
+from .stream_select import StreamSelect, stream_select
+from .shard_export import shard_export, load_shards
@@ -1,120 +1,276 @@
 import os
 import numpy as np
-import random
-import re
 import shutil
+from osgeo import gdal
+from func import instrument
+from func.data_preparation import ArrayWriter
+from func.sample_temp.manifest import load_manifest, save_manifest, manifest_from_names
+from func.sample_temp.tile_store import load_store, STORE_META
 
 
-def sample_select(sample_count,
-                  temp_folder,
-                  sample_folder,
-                  sample_percent=0.03,
-                  delete_temp_folder=True):
+def class_select_number(sample_count, sample_percent=0.03):
+    """
+    Number of samples selected in each class (t1e1, t1e2, ... in row-major order of sample_count),
+    classes with few samples are taken entirely and the rest are shared by the other classes.
+    Water-filling over the classes sorted by count: class k (sorted) is taken entirely when its count is
+    at most ceil(remaining / remaining classes), the first class above it and all larger ones share the rest.
+    """
     file_number = np.sum(sample_count)
     select_number = np.ceil(file_number * sample_percent)
     select_number = int(select_number)
-    print('select sample number: {} [{}%]'.format(select_number, sample_percent * 100))
+    instrument.log('select sample number: {} [{}%]'.format(select_number, sample_percent * 100))
 
-    class_number = np.ceil(select_number / 9)
-    count_list = sample_count.flatten()
-    class_list = ['t1e1', 't1e2', 't1e3', 't2e1', 't2e2', 't2e3', 't3e1', 't3e2', 't3e3']
+    count_list = np.asarray(sample_count, dtype=np.int64).flatten()
+    class_total = count_list.size
 
     # sort
     sorted_indices = np.argsort(count_list)
-    count_list_sorted = [count_list[i] for i in sorted_indices]
-    class_list_sorted = [class_list[i] for i in sorted_indices]
+    count_list_sorted = count_list[sorted_indices]
 
     # select sample number for each class
-    select_list = []
-    remain_number = select_number
-    for num in count_list_sorted:
-        if num <= class_number:
-            select_list.append(int(num))
-            remain_number = int(remain_number - num)
-            remain_len = 9 - len(select_list)
-            class_number = np.ceil(remain_number / remain_len)
-        else:
-            remain_len = 9 - len(select_list)
-            class_number = np.ceil(remain_number / remain_len)
-            select_list.extend([int(class_number)] * remain_len)
-            break
-    print('actual sample numbers:', np.sum(select_list))
-
-    # sort as class_list
-    mapping = {key: value for key, value in zip(class_list_sorted, select_list)}
-    select_list_sorted = [mapping[key] for key in class_list]
-    # print(class_list)
-    # print(select_list_sorted)
+    remain_number = select_number - np.concatenate([[0], np.cumsum(count_list_sorted)[:-1]])
+    remain_len = class_total - np.arange(class_total)
+    class_number = np.ceil(remain_number / remain_len)
+    shared = np.flatnonzero(count_list_sorted > class_number)
+    select_list = count_list_sorted.copy()
+    if shared.size:
+        first = shared[0]
+        select_list[first:] = class_number[first]
+    instrument.log('actual sample numbers:', np.sum(select_list))
+
+    # sort as the classes
+    select_list_sorted = np.zeros(class_total, dtype=np.int64)
+    select_list_sorted[sorted_indices] = select_list
+    return select_list_sorted.tolist()
+
+
+def class_pick(tiles, select_list_sorted, span=0, random_state=None):
+    """
+    Shuffle the samples, then keep the first select_list_sorted[k] samples of each class (stratum k).
+    :param span: with span > 1, selected samples are at least span rows or columns apart in the same scene,
+                 so that windows of sample_size every stride do not overlap (span = ceil(sample_size / stride)),
+                 see spaced_pick
+    :param random_state: seed of the shuffle (np.random if None)
+    """
+    tiles = tiles.sample(frac=1, random_state=random_state)
+    if span > 1:
+        return spaced_pick(tiles, select_list_sorted, span).sort_values('stratum', kind='stable')
+    stratum = tiles['stratum'].to_numpy()
+    rank = tiles.groupby(stratum).cumcount().to_numpy()
+    selected = tiles[rank < np.asarray(select_list_sorted)[stratum]]
+    return selected.sort_values('stratum', kind='stable')
+
+
+def spaced_pick(tiles, select_list_sorted, span):
+    """
+    Greedy pick of the shuffled samples: a sample is kept while its class is not full and no kept sample
+    of the scene is less than span rows and span columns away. The classes with fewer candidates are
+    picked first, so that the overlap constraint mostly falls on the large classes.
+    """
+    stratum = tiles['stratum'].to_numpy()
+    quota = np.array(select_list_sorted, dtype=np.int64)
+    scene = tiles['scene'].to_numpy() if 'scene' in tiles.columns else np.zeros(len(tiles), dtype=np.int64)
+    row = tiles['row'].to_numpy().astype(np.int64)
+    col = tiles['col'].to_numpy().astype(np.int64)
+    order = np.argsort(np.bincount(stratum, minlength=quota.size)[stratum], kind='stable')
+
+    taken = {}  # kept samples of each scene, padded by span
+    keep = np.zeros(len(tiles), dtype=bool)
+    for k in order:
+        if quota[stratum[k]] == 0:
+            continue
+        if scene[k] not in taken:
+            in_scene = scene == scene[k]
+            taken[scene[k]] = np.zeros((row[in_scene].max() + 2 * span, col[in_scene].max() + 2 * span), dtype=bool)
+        grid = taken[scene[k]]
+        if grid[row[k] + 1:row[k] + 2 * span, col[k] + 1:col[k] + 2 * span].any():
+            continue
+        grid[row[k] + span, col[k] + span] = True
+        quota[stratum[k]] -= 1
+        keep[k] = True
+    if quota.sum():
+        instrument.log('samples not selected because of overlap:', quota.sum())
+    return tiles[keep]
+
+
+def sample_vrt(image_path, save_path, x1, y1, sample_size=256):
+    """
+    VRT of one sample window (rows x1, cols y1) pointing into the image, instead of a copy of the pixels.
+    """
+    options = gdal.TranslateOptions(format='VRT', srcWin=[y1, x1, sample_size, sample_size])
+    gdal.Translate(save_path, os.path.abspath(image_path), options=options)
+
+
+def sample_save(writer, sample, name, sample_folder, geo_sample, proj, image_path=None, row=0, col=0,
+                sample_size=256, sample_format='tif', stride=None):
+    """
+    Save a selected sample as GeoTIFF (from the sample array, queued on the ArrayWriter) or VRT (window of image_path).
+    stride: image pixels between two samples (sample_size if None), the window of sample (row, col)
+    :return: saved file name
+    """
+    if sample_format == 'vrt':
+        stride = sample_size if stride is None else stride
+        name = name[:-4] + '.vrt'
+        sample_vrt(image_path, os.path.join(sample_folder, name), int(row) * stride, int(col) * stride, sample_size)
+    else:
+        writer.write(sample, os.path.join(sample_folder, name), geo_sample, proj)
+    return name
+
+
+def sample_select(sample_count,
+                  temp_folder,
+                  sample_folder,
+                  sample_percent=0.03,
+                  delete_temp_folder=True,
+                  sample_format='tif',
+                  write_workers=0,
+                  write_options=None,
+                  stride=None,
+                  no_overlap=False):
+    """
+    Select samples from the candidates in temp_folder (GeoTIFFs, or the TileStore of sample_crop(tile_store='npy')).
+    :param sample_format: 'tif' or 'vrt' (window of the image, only for candidates in a TileStore)
+    :param write_workers: threads writing the GeoTIFFs of samples from a TileStore (0: synchronous)
+    :param write_options: GeoTIFF creation options of samples from a TileStore, see creation_options
+    :param stride: image pixels between two candidate samples (sample_size if None)
+    :param no_overlap: select samples whose windows do not overlap (stride < sample_size), see spaced_pick
+    """
+    select_list_sorted = class_select_number(sample_count, sample_percent)
 
     # ----- After determine sample number, list samples for each class -----
-    folder_files = os.listdir(temp_folder)
-    tif_files = [file for file in folder_files if file.endswith('.tif')]
-    random.shuffle(tif_files)
-
-    list1 = []
-    list2 = []
-    list3 = []
-    list4 = []
-    list5 = []
-    list6 = []
-    list7 = []
-    list8 = []
-    list9 = []
-
-    for i in range(len(tif_files)):
-        tif_name = tif_files[i]
-        match_t = re.search(r't(\d+)', tif_name)
-        match_e = re.search(r'e(\d+)', tif_name)
-
-        if match_t:
-            t = int(match_t.group(1))
-        else:
-            raise ValueError('tif name:', tif_name, i)
-        if match_e:
-            e = int(match_e.group(1))
-        else:
-            raise ValueError('tif name:', tif_name, i)
-
-        if (t == 1) & (e == 1):
-            if len(list1) < select_list_sorted[0]:
-                list1.append(tif_name)
-        elif (t == 1) & (e == 2):
-            if len(list2) < select_list_sorted[1]:
-                list2.append(tif_name)
-        elif (t == 1) & (e == 3):
-            if len(list3) < select_list_sorted[2]:
-                list3.append(tif_name)
-        elif (t == 2) & (e == 1):
-            if len(list4) < select_list_sorted[3]:
-                list4.append(tif_name)
-        elif (t == 2) & (e == 2):
-            if len(list5) < select_list_sorted[4]:
-                list5.append(tif_name)
-        elif (t == 2) & (e == 3):
-            if len(list6) < select_list_sorted[5]:
-                list6.append(tif_name)
-        elif (t == 3) & (e == 1):
-            if len(list7) < select_list_sorted[6]:
-                list7.append(tif_name)
-        elif (t == 3) & (e == 2):
-            if len(list8) < select_list_sorted[7]:
-                list8.append(tif_name)
-        elif (t == 3) & (e == 3):
-            if len(list9) < select_list_sorted[8]:
-                list9.append(tif_name)
-        else:
-            raise ValueError('t:', t, 'e:', e, tif_name, i)
-
-    list_select = list1 + list2 + list3 + list4 + list5 + list6 + list7 + list8 + list9
+    tiles = load_manifest(temp_folder)
+    if tiles is None:
+        tiles = manifest_from_names(temp_folder, np.shape(sample_count)[-1])
+    sample_size = None
+    if os.path.exists(os.path.join(temp_folder, STORE_META)):
+        store, meta = load_store(temp_folder)
+        sample_size = meta['shape'][-1] if meta['count'] else None
+    elif no_overlap and len(tiles):
+        if 'row' not in tiles.columns:
+            raise ValueError('no_overlap needs the sample rows and columns: no manifest in {} and tif names '
+                             'without _h???w???'.format(temp_folder))
+        file = tiles['crop_name'].iloc[0] if 'crop_name' in tiles.columns else tiles['name'].iloc[0]
+        sample_size = gdal.Open(os.path.join(temp_folder, file)).RasterXSize
+    span = int(np.ceil(sample_size / stride)) if no_overlap and stride and sample_size else 0
+    selected = class_pick(tiles, select_list_sorted, span)
+    list_select = list(selected['name'])
 
     os.makedirs(sample_folder, exist_ok=True)
-    for idx, file in enumerate(list_select):
-        source_path = os.path.join(temp_folder, file)
-        target_path = os.path.join(sample_folder, file)
-        shutil.copy(source_path, target_path)
-        print('\r' + 'Selecting samples ... [{}/{}]'.format(idx + 1, len(list_select)), end='')
+    if 'store_index' in selected.columns:
+        geo_array = selected[['geo{}'.format(k) for k in range(6)]].to_numpy()
+        writer = ArrayWriter(write_workers, options=write_options)
+        for idx, (file, k) in enumerate(zip(list_select, selected['store_index'])):
+            with instrument.step('write', bytes_written=store[k].nbytes if sample_format != 'vrt' else 0):
+                list_select[idx] = sample_save(writer, store[k], file, sample_folder, list(geo_array[idx]),
+                                               meta['proj'], meta['image_path'], selected['row'].iloc[idx],
+                                               selected['col'].iloc[idx], sample_size, sample_format, stride)
+            instrument.progress('Selecting samples ... [{}/{}]'.format(idx + 1, len(list_select)))
+        with instrument.step('write'):
+            writer.close()
+        del store
+        selected = selected.assign(name=list_select)
+    else:
+        # candidates saved under their crop names, copied under their level names
+        list_file = list(selected['crop_name']) if 'crop_name' in selected.columns else list_select
+        for idx, (file, name) in enumerate(zip(list_file, list_select)):
+            source_path = os.path.join(temp_folder, file)
+            target_path = os.path.join(sample_folder, name)
+            with instrument.step('write', bytes_written=os.path.getsize(source_path)):
+                shutil.copy(source_path, target_path)
+            instrument.progress('Selecting samples ... [{}/{}]'.format(idx + 1, len(list_select)))
+        selected = selected.drop(columns='crop_name', errors='ignore')
+
+    save_manifest(selected, sample_folder)
 
     if delete_temp_folder:
         shutil.rmtree(temp_folder)
 
-    print('\r' + 'Training Samples have been select in {}'.format(sample_folder))
+    instrument.add_tiles(len(selected))
+    instrument.progress_end('Training Samples have been select in {}'.format(sample_folder))
+
+
+def sample_write(selected, image_path, sample_folder, sample_size=256, sample_format='tif', writer=None,
+                 stride=None):
+    """
+    Crop the selected samples (rows of the sample DataFrame) from the image into sample_folder.
+    :return: saved file names
+    """
+    stride = sample_size if stride is None else stride
+    image_ds = gdal.Open(image_path)
+    image_proj = image_ds.GetProjection()
+
+    geo_array = selected[['geo{}'.format(k) for k in range(6)]].to_numpy()
+    name_list = []
+    for idx, (name, row, col) in enumerate(zip(selected['name'], selected['row'], selected['col'])):
+        sample = None
+        if sample_format != 'vrt':
+            x1, y1 = int(row) * stride, int(col) * stride
+            with instrument.step('read') as step:
+                sample = image_ds.ReadAsArray(y1, x1, sample_size, sample_size)
+                step.add(bytes_read=sample.nbytes)
+        with instrument.step('write', bytes_written=0 if sample is None else sample.nbytes):
+            name_list.append(sample_save(writer, sample, name, sample_folder, list(geo_array[idx]), image_proj,
+                                         image_path, row, col, sample_size, sample_format, stride))
+        instrument.progress('Selecting samples ... [{}/{}]'.format(idx + 1, len(selected)))
+    del image_ds
+    return name_list
+
+
+def sample_select_tiles(sample_count,
+                        tiles,
+                        image_path,
+                        sample_folder,
+                        sample_percent=0.03,
+                        sample_size=256,
+                        sample_format='tif',
+                        write_workers=0,
+                        write_options=None,
+                        stride=None,
+                        no_overlap=False,
+                        seed=None):
+    """
+    Select samples from the scored candidates (DataFrame from sample_crop(save_tiles=False)),
+    and only crop the selected samples from the image into sample_folder.
+    :param image_path: image of the samples, or None when the DataFrame has an image_path column (several scenes)
+    :param sample_format: 'tif' or 'vrt' (window of image_path, no pixels copied)
+    :param write_workers: threads writing the samples while the next ones are read (0: synchronous)
+    :param write_options: GeoTIFF creation options of the samples, see creation_options
+    :param stride: image pixels between two candidate samples (sample_size if None)
+    :param no_overlap: select samples whose windows do not overlap (stride < sample_size), see spaced_pick
+    :param seed: seed of the shuffle of the candidates (random if None), see class_pick
+    """
+    select_list_sorted = class_select_number(sample_count, sample_percent)
+
+    stride = sample_size if stride is None else stride
+    selected = class_pick(tiles, select_list_sorted, int(np.ceil(sample_size / stride)) if no_overlap else 0,
+                          random_state=seed)
+    return sample_write_selected(selected, image_path, sample_folder, sample_size, sample_format, write_workers,
+                                 write_options, stride)
+
+
+def sample_write_selected(selected, image_path, sample_folder, sample_size=256, sample_format='tif',
+                          write_workers=0, write_options=None, stride=None):
+    """
+    Crop the selected samples into sample_folder and save their manifest.
+    :param image_path: image of the samples, or None when the DataFrame has an image_path column (several scenes)
+    :return: selected samples with the saved file names
+    """
+    os.makedirs(sample_folder, exist_ok=True)
+    writer = ArrayWriter(write_workers, options=write_options)
+    if image_path is None:
+        name_list = selected['name'].to_list()
+        for scene_path, scene in selected.groupby('image_path', sort=False):
+            scene_names = sample_write(scene, scene_path, sample_folder, sample_size, sample_format, writer,
+                                       stride)
+            for position, name in zip(selected.index.get_indexer(scene.index), scene_names):
+                name_list[position] = name
+    else:
+        name_list = sample_write(selected, image_path, sample_folder, sample_size, sample_format, writer, stride)
+    with instrument.step('write'):
+        writer.close()
+    selected = selected.assign(name=name_list)
+    save_manifest(selected, sample_folder)
+
+    instrument.add_tiles(len(selected))
+    instrument.progress_end('Training Samples have been select in {}'.format(sample_folder))
+    return selected
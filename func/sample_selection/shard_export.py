@@ -0,0 +1,102 @@
+import os
+import json
+import numpy as np
+from osgeo import gdal
+from func import instrument
+from func.data_preparation import land_cover_vrt
+from func.sample_temp.manifest import load_manifest, save_manifest
+
+SHARD_META = 'shards.json'
+
+
+def shard_name(k, part):
+    return 'shard_{0:05d}.{1}.npy'.format(k, part)
+
+
+def shard_export(sample_folder,
+                 export_folder,
+                 lc_path,
+                 image_path=None,
+                 sample_size=256,
+                 stride=None,
+                 shard_size=1024,
+                 label_value=None):
+    """
+    Training-ready copy of the selected samples: image tile and land cover label tile cut from the same window,
+    in fixed-size shards of shard_size samples, shard_00000.image.npy (n, bands, size, size) and
+    shard_00000.label.npy (n, size, size), memory-mappable (np.load(mmap_mode='r')) and read sequentially.
+    The index is the manifest of export_folder (the selected samples with shard and offset columns, geotransform
+    and class of each sample), shards.json lists the shards.
+    :param sample_folder: folder of the selected samples (its manifest: row, col, geo0-geo5, stratum ...)
+    :param lc_path: land cover of the image, or dict {scene: land cover path} for the samples of several scenes,
+                    warped onto the image grid (see land_cover_vrt)
+    :param image_path: (processed) image of the samples, or None when the manifest has an image_path column
+    :param stride: image pixels between two candidate samples (sample_size if None)
+    :param label_value: None (land cover classes as labels) or the target class value (labels 1 / 0)
+    :return: index DataFrame
+    """
+    stride = sample_size if stride is None else stride
+    tiles = load_manifest(sample_folder)
+    assert tiles is not None and 'row' in tiles.columns, 'no manifest with sample windows in {}'.format(sample_folder)
+    if image_path is not None:
+        tiles['image_path'] = image_path
+    # read order: scene by scene, row by row
+    tiles = tiles.sort_values(['image_path', 'row', 'col'], kind='stable').reset_index(drop=True)
+    tiles['shard'] = np.arange(len(tiles)) // shard_size
+    tiles['offset'] = np.arange(len(tiles)) % shard_size
+
+    os.makedirs(export_folder, exist_ok=True)
+    shards = []
+    image, label = None, None
+    for scene_path, scene in tiles.groupby('image_path', sort=False):
+        scene_lc = lc_path[scene['scene'].iloc[0]] if isinstance(lc_path, dict) else lc_path
+        image_ds = gdal.Open(scene_path)
+        lc_ds = land_cover_vrt(scene_path, scene_lc)
+        for idx, row, col, k, offset in zip(scene.index, scene['row'], scene['col'], scene['shard'],
+                                            scene['offset']):
+            x1, y1 = int(row) * stride, int(col) * stride
+            with instrument.step('read') as step:
+                sample = image_ds.ReadAsArray(y1, x1, sample_size, sample_size)
+                sample_label = lc_ds.ReadAsArray(y1, x1, sample_size, sample_size)
+                step.add(bytes_read=sample.nbytes + sample_label.nbytes)
+            if len(sample.shape) == 2:
+                sample = sample[np.newaxis]
+            if label_value is not None:
+                sample_label = (sample_label == label_value).astype(np.uint8)
+
+            if offset == 0:  # new shard
+                count = min(shard_size, len(tiles) - k * shard_size)
+                image = np.lib.format.open_memmap(os.path.join(export_folder, shard_name(k, 'image')), mode='w+',
+                                                  dtype=sample.dtype, shape=(count,) + sample.shape)
+                label = np.lib.format.open_memmap(os.path.join(export_folder, shard_name(k, 'label')), mode='w+',
+                                                  dtype=sample_label.dtype, shape=(count,) + sample_label.shape)
+                shards.append({'image': shard_name(k, 'image'), 'label': shard_name(k, 'label'), 'count': count})
+            with instrument.step('write', bytes_written=sample.nbytes + sample_label.nbytes):
+                image[offset] = sample
+                label[offset] = sample_label
+                if offset == image.shape[0] - 1:
+                    image.flush()
+                    label.flush()
+            instrument.progress('Exporting samples ... [{}/{}]'.format(idx + 1, len(tiles)))
+        del image_ds, lc_ds
+    del image, label
+
+    save_manifest(tiles, export_folder)
+    with open(os.path.join(export_folder, SHARD_META), 'w') as f:
+        json.dump({'sample_size': sample_size, 'shard_size': shard_size, 'count': len(tiles),
+                   'label_value': label_value, 'proj': gdal.Open(tiles['image_path'].iloc[0]).GetProjection()
+                   if len(tiles) else '', 'shards': shards}, f, indent=1)
+    instrument.add_tiles(len(tiles))
+    instrument.progress_end('Training samples exported in {} shards: {}'.format(len(shards), export_folder))
+    return tiles
+
+
+def load_shards(export_folder):
+    """
+    :return: list of (image, label) memory-mapped arrays of the shards, index DataFrame (shard, offset of each sample)
+    """
+    with open(os.path.join(export_folder, SHARD_META)) as f:
+        meta = json.load(f)
+    shards = [(np.load(os.path.join(export_folder, shard['image']), mmap_mode='r'),
+               np.load(os.path.join(export_folder, shard['label']), mmap_mode='r')) for shard in meta['shards']]
+    return shards, load_manifest(export_folder)
@@ -0,0 +1,279 @@
+import zlib
+import numpy as np
+import pandas as pd
+from func import instrument
+from func.data_preparation.image_quantile import quantile_from_counts
+from func.sample_temp.sample_crop import level_name, level_stratum
+from func.sample_temp.level_table import level_frame
+from .sample_select import class_select_number, spaced_pick, sample_write_selected
+
+COLUMNS = ('scene', 'row', 'col', 'zero', 'target', 'edge', 'key', 'cell')
+
+
+class MetricSketch:
+    """
+    Quantiles of a metric in one pass: the values themselves up to exact_size values (same quantiles as
+    np.quantile), then counts in equal-width bins over a fixed range [low, high] (values outside are counted
+    in the first / last bin) whose quantile error is at most one bin width. Merged by adding the counts.
+    """
+    def __init__(self, low, high, bins=16384, exact_size=65536):
+        self.low = low
+        self.high = high
+        self.exact_size = exact_size
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.values = np.zeros(0, dtype=np.float64)  # None once folded into the counts
+        self.v_min, self.v_max = np.inf, -np.inf
+
+    def index(self, values, bins=None):
+        bins = self.counts.size if bins is None else bins
+        idx = np.floor((np.asarray(values, dtype=np.float64) - self.low) / (self.high - self.low) * bins)
+        return np.clip(idx, 0, bins - 1).astype(np.int64)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return
+        self.v_min = min(self.v_min, values.min())
+        self.v_max = max(self.v_max, values.max())
+        if self.values is not None and self.values.size + values.size <= self.exact_size:
+            self.values = np.concatenate([self.values, values])
+            return
+        if self.values is not None:
+            values = np.concatenate([self.values, values])
+            self.values = None
+        self.counts += np.bincount(self.index(values), minlength=self.counts.size)
+
+    def merge(self, other):
+        if other.values is not None:
+            self.add(other.values)
+            return
+        if self.values is not None:
+            self.counts += np.bincount(self.index(self.values), minlength=self.counts.size)
+            self.values = None
+        self.counts += other.counts
+        self.v_min = min(self.v_min, other.v_min)
+        self.v_max = max(self.v_max, other.v_max)
+
+    def quantile(self, q):
+        if self.values is not None:
+            return np.quantile(self.values, q) if self.values.size else 0.
+        width = (self.high - self.low) / self.counts.size
+        value = quantile_from_counts(self.low + (np.arange(self.counts.size) + 0.5) * width, self.counts, q)
+        return np.clip(value, self.v_min, self.v_max)
+
+    def threshold(self, q1=0.05, q2=0.95, bins=3):
+        """
+        level_threshold of the sketched values.
+        """
+        v_min = self.quantile(q1)
+        v_max = self.quantile(q2)
+        return v_min + np.arange(1, bins) * (v_max - v_min) / bins
+
+
+class StreamSelect:
+    """
+    One-pass selection: the scored samples are streamed in (sample_crop(stream=...)) and only summaries are kept,
+    - sketches of the target (entropy, [0, 1]) and edge ([0, edge_max]) values, the level thresholds of
+      level_class come from their quantiles (the same thresholds up to exact_size samples, see MetricSketch),
+    - the number of samples in each cell of a grid x grid metric grid,
+    - the reservoir_size samples of each cell with the smallest random keys.
+    The samples of a class with the smallest keys over the cells is a uniform draw of the class, as class_pick,
+    as long as no class takes more than reservoir_size samples of a cell (otherwise a warning is printed).
+    The class counts are exact for the cells that fit in their reservoir, estimated from the reservoir otherwise.
+    Memory: grid ** 2 * reservoir_size samples and 2 * exact_size values at most, whatever the number of
+    scenes and samples.
+    Usage:
+        stream = StreamSelect(t_bins, e_bins, q1, q2)
+        sample_crop(..., save_tiles=False, stream=stream)  # one or more scenes, or stream.merge(scene_stream)
+        sample_count = stream.sample_count()
+        selected = stream.pick(class_select_number(sample_count, sample_percent))
+    """
+    def __init__(self, t_bins=3, e_bins=3, q1=0.05, q2=0.95, reservoir_size=1000, grid=32, edge_max=10.,
+                 sketch_bins=16384, exact_size=65536, seed=None, flush_size=65536):
+        self.t_bins, self.e_bins, self.q1, self.q2 = t_bins, e_bins, q1, q2
+        self.reservoir_size = reservoir_size
+        self.grid = grid
+        self.seed = seed
+        self.flush_size = flush_size
+        self.target_sketch = MetricSketch(0., 1., sketch_bins, exact_size)
+        self.edge_sketch = MetricSketch(0., edge_max, sketch_bins, exact_size)
+        self.cell_count = np.zeros(grid * grid, dtype=np.int64)
+        self.kept = {column: np.zeros(0, dtype=np.float64 if column in ('zero', 'target', 'edge', 'key')
+                                      else np.int64) for column in COLUMNS}
+        self.scenes = []
+        self.stride = None
+        self.buffer = []
+        self.buffered = 0
+        self.rng = None
+
+    def add_scene(self, name, image_path, geo, stride):
+        """
+        :return: index of the scene, for add
+        """
+        assert self.stride in (None, stride), 'all scenes of a stream have the same stride'
+        self.stride = stride
+        self.scenes.append({'name': name, 'image_path': image_path, 'geo': list(geo)})
+        # keys independent across scenes (and worker processes), reproducible with a seed
+        self.rng = np.random.default_rng(None if self.seed is None else [self.seed, zlib.crc32(name.encode())])
+        return len(self.scenes) - 1
+
+    def add(self, scene, row, records):
+        """
+        :param records: list of (col, zero, target_level, edge_level) of sample row `row`, as returned by score_row
+        """
+        if not records:
+            return
+        records = np.asarray(records, dtype=np.float64)
+        n = records.shape[0]
+        self.buffer.append({'scene': np.full(n, scene, dtype=np.int64), 'row': np.full(n, row, dtype=np.int64),
+                            'col': records[:, 0].astype(np.int64), 'zero': records[:, 1],
+                            'target': records[:, 2], 'edge': records[:, 3], 'key': self.rng.random(n)})
+        self.buffered += n
+        if self.buffered >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Add the buffered samples to the sketches, cell counts and reservoirs.
+        """
+        if not self.buffer:
+            return
+        new = {column: np.concatenate([part[column] for part in self.buffer]) for column in self.buffer[0]}
+        self.buffer, self.buffered = [], 0
+        self.target_sketch.add(new['target'])
+        self.edge_sketch.add(new['edge'])
+        new['cell'] = (self.target_sketch.index(new['target'], self.grid) * self.grid
+                       + self.edge_sketch.index(new['edge'], self.grid))
+        self.cell_count += np.bincount(new['cell'], minlength=self.cell_count.size)
+        self._keep({column: np.concatenate([self.kept[column], new[column]]) for column in COLUMNS})
+
+    def _keep(self, kept):
+        # reservoir_size smallest keys of each cell
+        order = np.lexsort((kept['key'], kept['cell']))
+        cell = kept['cell'][order]
+        start = np.flatnonzero(np.r_[True, cell[1:] != cell[:-1]])
+        rank = np.arange(cell.size) - np.repeat(start, np.diff(np.r_[start, cell.size]))
+        order = order[rank < self.reservoir_size]
+        self.kept = {column: values[order] for column, values in kept.items()}
+
+    def merge(self, other):
+        """
+        Add the samples of another stream with the same settings (e.g. a scene scored in a worker process).
+        """
+        assert (self.t_bins, self.e_bins, self.grid, self.reservoir_size) == \
+               (other.t_bins, other.e_bins, other.grid, other.reservoir_size), 'streams with different settings'
+        assert self.stride in (None, other.stride) or other.stride is None, 'streams with different strides'
+        self.flush()
+        other.flush()
+        self.stride = other.stride if self.stride is None else self.stride
+        kept = dict(other.kept)
+        kept['scene'] = kept['scene'] + len(self.scenes)
+        self.scenes.extend(other.scenes)
+        self.target_sketch.merge(other.target_sketch)
+        self.edge_sketch.merge(other.edge_sketch)
+        self.cell_count += other.cell_count
+        self._keep({column: np.concatenate([self.kept[column], kept[column]]) for column in COLUMNS})
+        return self
+
+    def levels(self):
+        """
+        :return: t_level, e_level of the reservoir samples, from the sketch thresholds
+        """
+        self.flush()
+        t_level = np.digitize(self.kept['target'], self.target_sketch.threshold(self.q1, self.q2, self.t_bins)) + 1
+        e_level = np.digitize(self.kept['edge'], self.edge_sketch.threshold(self.q1, self.q2, self.e_bins)) + 1
+        return t_level, e_level
+
+    def sample_count(self, print_data=True):
+        """
+        Number of samples in each class (t_bins, e_bins), as level_count: each cell count is shared among
+        the classes as its reservoir (exact for the cells that fit in their reservoir).
+        """
+        stratum = level_stratum(*self.levels(), self.e_bins)
+        classes = self.t_bins * self.e_bins
+        kept = np.bincount(self.kept['cell'] * classes + stratum, minlength=self.cell_count.size * classes)
+        kept = kept.reshape(self.cell_count.size, classes)
+        in_cell = np.maximum(kept.sum(axis=1, keepdims=True), 1)
+        estimate = (self.cell_count[:, np.newaxis] * kept / in_cell).sum(axis=0)
+
+        # integer counts with the exact total (largest remainders)
+        count = np.floor(estimate + 1e-9).astype(np.int64)
+        remainder = np.argsort(-(estimate - count), kind='stable')[:self.cell_count.sum() - count.sum()]
+        count[remainder] += 1
+        data = count.reshape(self.t_bins, self.e_bins)
+        instrument.log('samples', self.cell_count.sum(), '(reservoirs: {})'.format(self.kept['key'].size))
+        if print_data:
+            instrument.log(level_frame(data))
+        return data
+
+    def pick(self, select_list_sorted, span=0):
+        """
+        The select_list_sorted[k] samples of class k with the smallest keys (spaced_pick in key order with span > 1).
+        :return: sample DataFrame (scene, image_path, name, row, col, geo0-geo5, zero, target, edge,
+                 t_level, e_level, stratum), as sample_select_tiles picks from sample_crop
+        """
+        t_level, e_level = self.levels()
+        order = np.argsort(self.kept['key'], kind='stable')
+        tiles = pd.DataFrame({column: self.kept[column][order] for column in COLUMNS})
+        tiles['t_level'] = t_level[order]
+        tiles['e_level'] = e_level[order]
+        tiles['stratum'] = level_stratum(tiles['t_level'], tiles['e_level'], self.e_bins)
+        if span > 1:
+            selected = spaced_pick(tiles, select_list_sorted, span)
+        else:
+            rank = tiles.groupby('stratum').cumcount().to_numpy()
+            selected = tiles[rank < np.asarray(select_list_sorted)[tiles['stratum'].to_numpy()]]
+        self._check_uniform(tiles, selected)
+        selected = selected.sort_values('stratum', kind='stable').reset_index(drop=True)
+
+        scenes = pd.DataFrame(self.scenes)
+        scene = selected['scene'].to_numpy()
+        geo = np.array(scenes['geo'].tolist(), dtype=np.float64)[scene]
+        geo[:, 0] += selected['col'].to_numpy() * self.stride * geo[:, 1]
+        geo[:, 3] += selected['row'].to_numpy() * self.stride * geo[:, 5]
+        selected = selected.assign(scene=scenes['name'].to_numpy()[scene])
+        selected.insert(1, 'image_path', scenes['image_path'].to_numpy()[scene])
+        selected.insert(2, 'name', [level_name('{0}_h{1:03d}w{2:03d}.tif'.format(name, row, col), t, e)
+                                    for name, row, col, t, e in zip(selected['scene'], selected['row'],
+                                                                    selected['col'], selected['t_level'],
+                                                                    selected['e_level'])])
+        for k in range(6):
+            selected['geo{}'.format(k)] = geo[:, k]
+        return selected.drop(columns=['key', 'cell'])
+
+    def _check_uniform(self, tiles, selected):
+        # a picked key above the largest key kept by a full cell of its class may have missed a smaller one
+        cell = tiles['cell'].to_numpy()
+        full = self.cell_count > np.bincount(cell, minlength=self.cell_count.size)
+        limit = np.full(self.cell_count.size, np.inf)
+        np.maximum.at(limit, cell, np.where(full[cell], tiles['key'].to_numpy(), -np.inf))
+        limit[~full] = np.inf
+        stratum_limit = np.full(self.t_bins * self.e_bins, np.inf)
+        np.minimum.at(stratum_limit, tiles['stratum'].to_numpy(), limit[cell])
+        beyond = selected['key'].to_numpy() > stratum_limit[selected['stratum'].to_numpy()]
+        if beyond.any():
+            instrument.log('{} selected samples are beyond the reservoirs of their class, '
+                           'increase reservoir_size for a uniform draw'.format(np.sum(beyond)))
+
+
+def stream_select(stream,
+                  sample_folder,
+                  sample_percent=0.03,
+                  sample_size=256,
+                  sample_format='tif',
+                  write_workers=0,
+                  write_options=None,
+                  no_overlap=False,
+                  sample_count=None):
+    """
+    Select samples from a StreamSelect filled by sample_crop(stream=...) (one or more scenes),
+    and crop them from the processed images into sample_folder, as sample_select_tiles.
+    :param sample_count: class counts from stream.sample_count(), computed if None
+    """
+    if sample_count is None:
+        sample_count = stream.sample_count()
+    select_list_sorted = class_select_number(sample_count, sample_percent)
+    stride = sample_size if stream.stride is None else stream.stride
+    selected = stream.pick(select_list_sorted, int(np.ceil(sample_size / stride)) if no_overlap else 0)
+    return sample_write_selected(selected, None, sample_folder, sample_size, sample_format, write_workers,
+                                 write_options, stride)
@@ -0,0 +1,297 @@
+"""
+Local sampling service: scenes are stretched, aligned and scored once, their per-sample metrics kept in memory,
+and selections (any sample_percent, seed, levels) are answered from memory without reading the rasters again.
+    store = SceneStore('work', memory_mb=1024)
+    scene = store.score('image.tif', 'lc.tif', 3)
+    store.select([scene['id']], sample_percent=0.025, seed=1)
+serve(store, port) answers the same calls as JSON over HTTP on localhost (see ServiceHandler),
+service_call(path, port, **body) calls it.
+"""
+import os
+import json
+import time
+import threading
+import urllib.request
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import pandas as pd
+from func import instrument
+from func.data_preparation import creation_options, stretch_quantile, raster_remove
+from func.sample_temp.scene_score import scene_score, scene_image_path
+from func.sample_temp.sample_crop import level_class, level_name, level_stratum
+from func.sample_temp.level_table import level_data
+from func.sample_temp.metric_cache import file_fingerprint, cache_key
+from func.sample_selection.sample_select import class_select_number, class_pick, sample_write_selected
+
+# scene_score parameters of a scene, and those the sample metrics depend on (the scene key)
+SCORE_PARAMS = {'process_image': True, 'block_process': False, 'memory_mb': 256, 'quantile': None,
+                'rgb_bands': [2, 1, 0], 'sample_size': 256, 'zero_percent': 0.2, 'target_grid': False,
+                'edge_mode': 'tile', 'windowed': False, 'prescreen': False, 'build_overviews': False,
+                'stride': None, 'pipeline': False,
+                'read_depth': 2, 'kernel': 'numpy'}
+KEY_PARAMS = ('process_image', 'quantile', 'rgb_bands', 'sample_size', 'zero_percent', 'edge_mode', 'prescreen',
+              'stride')
+
+
+class SceneStore:
+    """
+    Scored scenes in memory (sample DataFrames with target and edge values), least recently used evicted first
+    when their total size exceeds memory_mb. Scenes are scored one at a time (the run instrumentation is
+    per process), selections run concurrently on the scenes in memory.
+    """
+    def __init__(self, work_folder, memory_mb=1024, cache_folder=None, cache_hash=False):
+        """
+        :param work_folder: folder of the processed images (kept while their scene is in memory)
+        :param memory_mb: memory limit of the sample DataFrames of all scenes
+        :param cache_folder: processed images and sample levels cached on disk as well (see scene_cache),
+                             an evicted scene scored again is read back from there
+        :param cache_hash: inputs identified by the hash of their content instead of path, size and mtime
+        """
+        self.work_folder = work_folder
+        self.memory_mb = memory_mb
+        self.cache_folder = cache_folder
+        self.cache_hash = cache_hash
+        self.scenes = OrderedDict()  # id: {'tiles', 'params', 'mb', 'pins', ...}, least recently used first
+        self.lock = threading.Lock()
+        self.score_lock = threading.Lock()
+        os.makedirs(work_folder, exist_ok=True)
+
+    def scene_id(self, image_path, lc_path, lc_target_value, params):
+        key = cache_key(file_fingerprint(image_path, self.cache_hash), file_fingerprint(lc_path, self.cache_hash),
+                        lc_target_value, [params[name] for name in KEY_PARAMS])
+        return '{}_{}'.format(os.path.splitext(os.path.basename(image_path))[0], key[:8])
+
+    def info(self, scene_id):
+        scene = self.scenes[scene_id]
+        return {key: value for key, value in scene.items() if key != 'tiles'}
+
+    def used_mb(self):
+        return sum(scene['mb'] for scene in self.scenes.values())
+
+    def score(self, image_path, lc_path, lc_target_value, **params):
+        """
+        Score a scene, or find it in memory when the same inputs and parameters were scored before.
+        :param params: scene_score parameters (SCORE_PARAMS)
+        :return: scene info (id, samples, mb, seconds, cached: found in memory)
+        """
+        unknown = set(params) - set(SCORE_PARAMS)
+        assert not unknown, 'unknown parameters: {}'.format(', '.join(sorted(unknown)))
+        params = dict(SCORE_PARAMS, **params)
+        params['quantile'] = stretch_quantile(params['quantile'], params['block_process'])
+        scene_id = self.scene_id(image_path, lc_path, lc_target_value, params)
+        cached = self.cached(scene_id)
+        if cached is not None:  # without waiting for a scene being scored
+            return cached
+        with self.score_lock:
+            cached = self.cached(scene_id)  # scored while waiting for score_lock
+            if cached is not None:
+                return cached
+
+            start = time.perf_counter()
+            first = len(instrument.stages())
+            tiles = scene_score(image_path, lc_path, lc_target_value, self.work_folder, scene_id,
+                                cache_folder=self.cache_folder, **params)
+            stages = instrument.stages()[first:]
+            del instrument.stages()[first:]  # kept in the scene info, not for the life of the service
+            # only the processed image written by scene_score is removed on eviction, never an input raster
+            # (process_image=False) or an image of cache_folder
+            created_path = scene_image_path(self.work_folder, scene_id) \
+                if params['process_image'] and self.cache_folder is None else None
+            scene = {'id': scene_id, 'image_path': image_path, 'lc_path': lc_path,
+                     'lc_target_value': lc_target_value, 'params': params, 'samples': len(tiles),
+                     'mb': tiles.memory_usage(deep=True).sum() / 1024 ** 2,
+                     'seconds': time.perf_counter() - start, 'stages': stages,
+                     'image_process_path': created_path, 'pins': 0, 'tiles': tiles}
+            with self.lock:
+                self.scenes[scene_id] = scene
+                unpinned = [other for other in self.scenes if other != scene_id and not self.scenes[other]['pins']]
+                while self.used_mb() > self.memory_mb and unpinned:
+                    self._evict(unpinned.pop(0))
+                return dict(self.info(scene_id), cached=False)
+
+    def cached(self, scene_id):
+        """
+        :return: scene info (cached=True) when the scene is in memory, else None
+        """
+        with self.lock:
+            if scene_id not in self.scenes:
+                return None
+            self.scenes.move_to_end(scene_id)
+            return dict(self.info(scene_id), cached=True)
+
+    def evict(self, scene_id):
+        """
+        Drop a scene from memory (and the processed image scene_score wrote in work_folder).
+        A scene used by a running selection is not evicted.
+        """
+        with self.lock:
+            assert scene_id in self.scenes, 'scene not in memory: {}'.format(scene_id)
+            assert not self.scenes[scene_id]['pins'], 'scene used by a selection: {}'.format(scene_id)
+            self._evict(scene_id)
+
+    def _evict(self, scene_id):
+        scene = self.scenes.pop(scene_id)
+        if scene['image_process_path'] is not None and os.path.exists(scene['image_process_path']):
+            raster_remove(scene['image_process_path'])
+        instrument.log('evicted scene {} ({:.1f} MB)'.format(scene_id, scene['mb']))
+
+    def select(self,
+               scene_ids=None,
+               sample_percent=0.025,
+               seed=None,
+               target_bins=3,
+               edge_bins=3,
+               clip_q1=0.05,
+               clip_q2=0.95,
+               no_overlap=False,
+               sample_folder=None,
+               sample_format='tif',
+               write_workers=0,
+               compress='NONE'):
+        """
+        Select samples from scenes in memory, with levels from the pooled thresholds of these scenes
+        (same samples as batch_sampling.py --seed with the same seed on the same scenes in the same order,
+        without streaming).
+        :param scene_ids: scenes to select from (all scenes in memory if None)
+        :param seed: seed of the shuffle of the samples (random if None)
+        :param sample_folder: folder where the selected samples are cropped (None: only the list is returned)
+        :return: dict: count (samples of each class), select (samples selected in each class),
+                 samples (scene, row, col, stratum, name of the selected samples), seconds
+        """
+        start = time.perf_counter()
+        with self.lock:
+            scene_ids = list(self.scenes) if scene_ids is None else scene_ids
+            missing = [scene_id for scene_id in scene_ids if scene_id not in self.scenes]
+            assert not missing, 'scenes not in memory: {}'.format(', '.join(missing))
+            assert scene_ids, 'no scene in memory'
+            scenes = [self.scenes[scene_id] for scene_id in scene_ids]
+            for scene in scenes:  # pinned: not evicted while their images are cropped
+                self.scenes.move_to_end(scene['id'])
+                scene['pins'] += 1
+        try:
+            return self._select(scenes, start, sample_percent, seed, target_bins, edge_bins, clip_q1, clip_q2,
+                                no_overlap, sample_folder, sample_format, write_workers, compress)
+        finally:
+            with self.lock:
+                for scene in scenes:
+                    scene['pins'] -= 1
+
+    def _select(self, scenes, start, sample_percent, seed, target_bins, edge_bins, clip_q1, clip_q2, no_overlap,
+                sample_folder, sample_format, write_workers, compress):
+        scene_ids = [scene['id'] for scene in scenes]
+        sample_size = {scene['params']['sample_size'] for scene in scenes}
+        stride = {scene['params']['stride'] for scene in scenes}
+        assert len(sample_size) == 1 and len(stride) == 1, 'scenes scored with different sample_size or stride'
+        sample_size, stride = sample_size.pop(), stride.pop()
+        stride = sample_size if stride is None else stride
+
+        tiles = pd.concat([scene['tiles'] for scene in scenes], ignore_index=True)
+        target_levels, edge_levels = level_class(tiles['target'], tiles['edge'], clip_q1, clip_q2, target_bins,
+                                                 edge_bins)
+        tiles['t_level'] = target_levels
+        tiles['e_level'] = edge_levels
+        tiles['stratum'] = level_stratum(target_levels, edge_levels, edge_bins)
+        tiles['name'] = [level_name('{0}_h{1:03d}w{2:03d}.tif'.format(scene, row, col), t, e)
+                         for scene, row, col, t, e
+                         in zip(tiles['scene'], tiles['row'], tiles['col'], target_levels, edge_levels)]
+        sample_count = level_data(tiles, False, target_bins, edge_bins)
+        select_list = class_select_number(sample_count, sample_percent)
+        selected = class_pick(tiles, select_list, int(np.ceil(sample_size / stride)) if no_overlap else 0,
+                              random_state=seed)
+        if sample_folder is not None:
+            write_options = None if compress == 'NONE' else creation_options(compress, block_size=sample_size)
+            selected = sample_write_selected(selected, None, sample_folder, sample_size, sample_format,
+                                             write_workers, write_options, stride)
+        return {'scenes': scene_ids, 'count': sample_count.tolist(), 'select': select_list,
+                'samples': selected[['scene', 'row', 'col', 'stratum', 'name']].to_dict('records'),
+                'sample_folder': sample_folder, 'seconds': time.perf_counter() - start}
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    JSON over HTTP, the store is self.server.store:
+        GET  /scenes    scenes in memory and memory used
+        POST /score     {"image_path", "lc_path", "lc_target_value", scene_score parameters} -> scene info
+        POST /select    {"scenes": [id, ...], "sample_percent", "seed", ...} (SceneStore.select) -> selection
+        POST /evict     {"scene": id}
+        POST /shutdown
+    Errors are answered with status 400 and {"error": message}.
+    """
+    def _answer(self, status, body):
+        data = json.dumps(body, default=_json_value).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        store = self.server.store
+        if self.path.rstrip('/') != '/scenes':
+            return self._answer(404, {'error': 'unknown path {}'.format(self.path)})
+        with store.lock:
+            scenes = [store.info(scene_id) for scene_id in store.scenes]
+        self._answer(200, {'scenes': scenes, 'used_mb': sum(scene['mb'] for scene in scenes),
+                           'memory_mb': store.memory_mb})
+
+    def do_POST(self):
+        store = self.server.store
+        path = self.path.rstrip('/')
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if path == '/score':
+                answer = store.score(**body)
+            elif path == '/select':
+                answer = store.select(body.pop('scenes', None), **body)
+            elif path == '/evict':
+                store.evict(body['scene'])
+                answer = {'evicted': body['scene']}
+            elif path == '/shutdown':
+                answer = {'shutdown': True}
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+            else:
+                return self._answer(404, {'error': 'unknown path {}'.format(self.path)})
+        except Exception as error:
+            return self._answer(400, {'error': '{}: {}'.format(type(error).__name__, error)})
+        self._answer(200, answer)
+
+    def log_message(self, format, *args):
+        instrument.log('{} - {}'.format(self.address_string(), format % args))
+
+
+def _json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def serve(store, port=8765, host='127.0.0.1'):
+    """
+    Answer the requests of ServiceHandler until POST /shutdown (or Ctrl+C).
+    """
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.store = store
+    instrument.log('sampling service on http://{}:{}'.format(host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def service_call(path, port=8765, host='127.0.0.1', **body):
+    """
+    Call the service: GET without body, POST with the JSON body otherwise.
+    :return: decoded JSON answer (RuntimeError with the error message for status 400)
+    """
+    data = json.dumps(body).encode() if body or path != '/scenes' else None
+    request = urllib.request.Request('http://{}:{}{}'.format(host, port, path), data=data,
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        raise RuntimeError(json.loads(error.read()).get('error', str(error)))
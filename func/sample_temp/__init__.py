@@ -1,2 +1,3 @@
-from .level_table import level_table
-from .sample_crop import sample_crop
+from .level_table import level_table, level_count
+from .sample_crop import sample_crop, target_class
+from .metric_cache import MetricCache, scene_cache, cached_stage
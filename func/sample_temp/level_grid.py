@@ -0,0 +1,219 @@
+from osgeo import gdal
+import numpy as np
+from skimage import feature, color, filters
+
+
+def lc_bounds(offset, pixel, sample_size, number, lc_origin, lc_pixel, lc_length, stride=None):
+    """
+    Land cover index range [i1, i2) of every sample along one axis, same arithmetic as level_target.
+    :param offset: geo coordinate of the image origin (image_geo[0] or image_geo[3])
+    :param pixel: image pixel size along the axis (image_geo[1] or image_geo[5])
+    :param stride: image pixels between two samples (sample_size if None)
+    """
+    stride = sample_size if stride is None else stride
+    start = offset + (np.arange(number) * stride) * pixel
+    end = start + sample_size * pixel
+    i1 = np.abs((start - lc_origin) / lc_pixel)
+    i2 = np.abs((end - lc_origin) / lc_pixel)
+    i1, i2 = np.minimum(i1, i2), np.maximum(i1, i2)
+    i1 = np.maximum(np.floor(i1), 0).astype(np.int64)
+    i2 = np.minimum(np.ceil(i2) + 1, lc_length).astype(np.int64)
+    return i1, i2
+
+
+def lc_rows(lc, h1, h2):
+    """
+    Land cover rows [h1, h2) of an array, or read with a GDAL window from a dataset.
+    """
+    if isinstance(lc, gdal.Dataset):
+        return lc.ReadAsArray(0, int(h1), lc.RasterXSize, int(h2 - h1))
+    return lc[h1:h2]
+
+
+def lc_shape(lc):
+    if isinstance(lc, gdal.Dataset):
+        return lc.RasterYSize, lc.RasterXSize
+    return lc.shape
+
+
+def lc_blocks(lc, end, block_rows=256):
+    """
+    Land cover rows [0, end) as consecutive blocks of block_rows rows.
+    """
+    for h in range(0, int(end), block_rows):
+        yield lc_rows(lc, h, min(h + block_rows, int(end)))
+
+
+def lc_strip_bytes(lc, lc_geo, image_geo, rows, sample_size=256, stride=None, block_rows=256):
+    """
+    Largest land cover block read by target_fraction_grid from a dataset,
+    and the largest set of column cumulative sums it keeps (bytes).
+    """
+    lc_h, lc_w = lc_shape(lc)
+    h1, h2 = lc_bounds(image_geo[3], image_geo[5], sample_size, rows, lc_geo[3], lc_geo[5], lc_h, stride)
+    itemsize = gdal.GetDataTypeSize(lc.GetRasterBand(1).DataType) // 8 if isinstance(lc, gdal.Dataset) else 1
+    kept = max([np.sum((h1 >= h1[i]) & (h1 < h2[i])) + 1 for i in range(rows)], default=0)
+    return min(block_rows, int(np.max(h2, initial=0))) * lc_w * itemsize + kept * (lc_w + 1) * 8
+
+
+def window_sums(blocks, h1, h2, w1, w2):
+    """
+    Sums of the windows rows [h1[i], h2[i]) × columns [w1[j], w2[j]) of a raster streamed as row blocks,
+    from its summed-area table taken only at the window row bounds (column cumulative sums of rows [0, b)).
+    Every pixel is summed once whatever the overlap of the windows, and only the bounds of the
+    windows not finished yet are kept in memory.
+    :param blocks: consecutive row blocks (n, w) of the raster from row 0, down to max(h2) at least,
+                   or (n, w, k) to sum k layers at once
+    :param h1, h2: row bounds of the window rows, non-decreasing
+    :return: (len(h1), len(w1)) int64, or (len(h1), len(w1), k)
+    """
+    rows = len(h1)
+    assert np.all(np.diff(h1) >= 0) and np.all(np.diff(h2) >= 0), 'window rows should be in order'
+    sums = None
+    bounds = np.unique(np.concatenate([h1, h2]))
+    prefix = {}
+    col_sum = None
+    h, i, k = 0, 0, 0
+    for block in blocks:
+        if i == rows:
+            break
+        if col_sum is None:
+            col_sum = np.zeros(block.shape[1:], dtype=np.int64)
+            sums = np.zeros((rows, len(w1)) + block.shape[2:], dtype=np.int64)
+        n = block.shape[0]
+        start = 0
+        while k < bounds.size and bounds[k] <= h + n:
+            b = bounds[k]
+            col_sum += block[start:b - h].sum(axis=0, dtype=np.int64)
+            start = b - h
+            prefix[b] = np.concatenate([np.zeros((1,) + col_sum.shape[1:], dtype=np.int64),
+                                        np.cumsum(col_sum, axis=0)])
+            while i < rows and h2[i] == b:
+                top, bottom = prefix[h1[i]], prefix[b]
+                sums[i] = (bottom[w2] - bottom[w1]) - (top[w2] - top[w1])
+                i += 1
+            for key in [key for key in prefix if i == rows or key < h1[i]]:
+                del prefix[key]
+            k += 1
+        col_sum += block[start:].sum(axis=0, dtype=np.int64)
+        h += n
+    return np.zeros((rows, len(w1)), dtype=np.int64) if sums is None else sums
+
+
+def target_fraction_grid(lc, lc_geo, image_geo, rows, cols, sample_size=256, stride=None, block_rows=256,
+                         target_values=None):
+    """
+    Target fraction of all rows × cols samples in one pass over the land cover.
+    The sums come from the summed-area table of the land cover (window_sums), over the same land cover window
+    as level_target (including the +1 of the ceil bounds), so overlapping samples (stride < sample_size)
+    cost no more land cover reading.
+    :param lc: land cover array, or gdal dataset read block by block (bounded memory)
+    :param target_values: None (lc is the target mask, True=255), or the land cover values of several target
+                          classes (lc holds the land cover classes), summed in the same pass
+    :return: (rows, cols) float64, or (rows, cols, len(target_values)); cross_entropy of it is the target level
+    """
+    lc_h, lc_w = lc_shape(lc)
+    h1, h2 = lc_bounds(image_geo[3], image_geo[5], sample_size, rows, lc_geo[3], lc_geo[5], lc_h, stride)
+    w1, w2 = lc_bounds(image_geo[0], image_geo[1], sample_size, cols, lc_geo[0], lc_geo[1], lc_w, stride)
+
+    blocks = lc_blocks(lc, np.max(h2, initial=0), block_rows)
+    area = (h2 - h1)[:, np.newaxis] * (w2 - w1)[np.newaxis, :]
+    if target_values is not None:
+        values = np.asarray(target_values)
+        target_sum = window_sums((block[:, :, np.newaxis] == values for block in blocks), h1, h2, w1, w2)
+        if target_sum.ndim == 2:  # no window
+            target_sum = np.zeros((rows, cols, values.size), dtype=np.int64)
+        return target_sum / area[:, :, np.newaxis]
+    target_sum = window_sums(blocks, h1, h2, w1, w2)
+    return target_sum / 255 / area
+
+
+def edge_map(gray, sigma=2.0, method='canny'):
+    """
+    Edge pixels of a grayscale image (float in [0, 1]).
+    'canny': feature.canny as in level_edge;
+    'gradient': gradient magnitude of the Gaussian-smoothed image above the high threshold of canny
+                (0.2), without non-maximum suppression and hysteresis.
+    """
+    if method == 'canny':
+        return feature.canny(gray, sigma=sigma)
+    elif method == 'gradient':
+        smoothed = filters.gaussian(gray, sigma=sigma, mode='constant')
+        # filters.sobel = hypot(ndi.sobel) / (4 * sqrt(2)), the magnitude thresholded by canny
+        return filters.sobel(smoothed) >= 0.2 / (4 * np.sqrt(2))
+    raise ValueError('edge method should be canny or gradient: {}'.format(method))
+
+
+def edge_blocks(image, rgb_bands, height, width, sample_size=256, sigma=2.0, method='canny', strip_rows=1):
+    """
+    Edge map of the image rows [0, height) and columns [0, width), as blocks of strip_rows * sample_size rows,
+    each detected on the block and a margin of 4 sigma.
+    Single band images are scaled by the image maximum (level_edge uses the sample maximum).
+    """
+    windowed = isinstance(image, gdal.Dataset)
+    H = image.RasterYSize if windowed else image.shape[1]
+    margin = int(np.ceil(4 * sigma)) + 2
+    gray_max = None
+    if len(rgb_bands) == 1:
+        if windowed:
+            gray_max = max(float(image.GetRasterBand(rgb_bands[0] + 1).ComputeRasterMinMax(False)[1]), 1.)
+        else:
+            gray_max = max(float(np.max(image[rgb_bands[0]])), 1.)
+
+    for x1 in range(0, height, strip_rows * sample_size):
+        x2 = min(x1 + strip_rows * sample_size, height)
+        m1, m2 = max(x1 - margin, 0), min(x2 + margin, H)
+        if windowed:
+            strip = np.stack([image.GetRasterBand(b + 1).ReadAsArray(0, m1, width, m2 - m1)
+                              for b in rgb_bands], axis=0)
+        else:
+            strip = image[rgb_bands, m1:m2, :width]
+        if len(rgb_bands) == 3:
+            gray = color.rgb2gray(strip.transpose(1, 2, 0))
+        else:
+            gray = strip[0] / gray_max if gray_max > 1 else strip[0].astype(np.float64)
+        yield edge_map(gray, sigma, method)[x1 - m1:x2 - m1]
+
+
+def edge_level_grid(image, rgb_bands, rows, cols, sample_size=256, sigma=2.0, f=10,
+                    method='canny', strip_rows=1, stride=None):
+    """
+    Edge level of all rows × cols samples, from edge maps of image strips
+    (strip_rows * sample_size rows and a margin of 4 sigma) instead of one edge detection per sample.
+    The edge pixels are summed per sample from the summed-area table of the edge map (window_sums):
+    f * edges.sum() / (H * W) as level_edge, for overlapping samples (stride < sample_size) too.
+    :param image: image array (c, h, w), or gdal dataset read strip by strip (bounded memory)
+    :return: (rows, cols) float64
+    """
+    stride = sample_size if stride is None else stride
+    h1 = np.arange(rows) * stride
+    w1 = np.arange(cols) * stride
+    blocks = edge_blocks(image, rgb_bands, int(np.max(h1 + sample_size, initial=0)),
+                         int(np.max(w1 + sample_size, initial=0)), sample_size, sigma, method, strip_rows)
+    edge_sum = window_sums(blocks, h1, h1 + sample_size, w1, w1 + sample_size)
+    return f * edge_sum / (sample_size * sample_size)
+
+
+def zero_fraction_grid(image_ds, rows, cols, sample_size=256, factor=8, build_overviews=False, stride=None):
+    """
+    Approximate fraction of no data pixels (0 in all bands) of every sample from a decimated read
+    (1/factor resolution, served by the overviews of the image when it has them).
+    :param build_overviews: build the 1/factor overview (nearest) when the image has none
+    :return: (rows, cols) float64, empty when the image is smaller than one sample
+    """
+    if rows <= 0 or cols <= 0:
+        return np.zeros((max(rows, 0), max(cols, 0)))
+    if build_overviews and image_ds.GetRasterBand(1).GetOverviewCount() == 0:
+        image_ds.BuildOverviews('NEAREST', [factor])
+
+    stride = sample_size if stride is None else stride
+    block = max(sample_size // factor, 1)
+    h1 = np.arange(rows) * stride * block // sample_size  # sample bounds in the decimated grid
+    w1 = np.arange(cols) * stride * block // sample_size
+    zero = None
+    for b in range(image_ds.RasterCount):
+        band = image_ds.GetRasterBand(b + 1).ReadAsArray(0, 0, (cols - 1) * stride + sample_size,
+                                                         (rows - 1) * stride + sample_size,
+                                                         buf_xsize=int(w1[-1]) + block, buf_ysize=int(h1[-1]) + block)
+        zero = band == 0 if zero is None else zero & (band == 0)
+    return window_sums([zero], h1, h1 + block, w1, w1 + block) / (block * block)
@@ -1,67 +1,39 @@
-import os
-import re
 import numpy as np
 import pandas as pd
+from func import instrument
+from .manifest import load_manifest, manifest_from_names
 
 
-def level_table(sample_folder, print_data=True):
-    folder_files = os.listdir(sample_folder)
-    tif_files = [file for file in folder_files if file.endswith('.tif')]
-    print(sample_folder, len(tif_files))
+def level_table(sample_folder, print_data=True, t_bins=3, e_bins=3):
+    """
+    Number of samples in each class (t1-t{t_bins} × e1-e{e_bins}) of the folder, from its manifest.
+    """
+    tiles = load_manifest(sample_folder)
+    if tiles is None:
+        tiles = manifest_from_names(sample_folder, e_bins)
+    instrument.log(sample_folder, len(tiles))
+    return level_data(tiles, print_data, t_bins, e_bins)
 
-    count_t1e1 = 0
-    count_t1e2 = 0
-    count_t1e3 = 0
-    count_t2e1 = 0
-    count_t2e2 = 0
-    count_t2e3 = 0
-    count_t3e1 = 0
-    count_t3e2 = 0
-    count_t3e3 = 0
 
-    for i in range(len(tif_files)):
-        tif_name = tif_files[i]
-
-        match_t = re.search(r't(\d+)', tif_name)
-        match_e = re.search(r'e(\d+)', tif_name)
-
-        if match_t:
-            t_level = int(match_t.group(1))
-        else:
-            raise ValueError('tif name:', tif_name, i)
-
-        if match_e:
-            e_level = int(match_e.group(1))
-        else:
-            raise ValueError('tif name:', tif_name, i)
-
-        if (t_level == 1) & (e_level == 1):
-            count_t1e1 += 1
-        elif (t_level == 1) & (e_level == 2):
-            count_t1e2 += 1
-        elif (t_level == 1) & (e_level == 3):
-            count_t1e3 += 1
-        elif (t_level == 2) & (e_level == 1):
-            count_t2e1 += 1
-        elif (t_level == 2) & (e_level == 2):
-            count_t2e2 += 1
-        elif (t_level == 2) & (e_level == 3):
-            count_t2e3 += 1
-        elif (t_level == 3) & (e_level == 1):
-            count_t3e1 += 1
-        elif (t_level == 3) & (e_level == 2):
-            count_t3e2 += 1
-        elif (t_level == 3) & (e_level == 3):
-            count_t3e3 += 1
-        else:
-            raise ValueError('t:', t_level, 'e:', e_level, tif_name, i)
-
-    data = np.array([[count_t1e1, count_t1e2, count_t1e3],
-                     [count_t2e1, count_t2e2, count_t2e3],
-                     [count_t3e1, count_t3e2, count_t3e3]])
-    df = pd.DataFrame(data, index=['t1', 't2', 't3'], columns=['e1', 'e2', 'e3'])
+def level_frame(data):
+    df = pd.DataFrame(data, index=['t{}'.format(k + 1) for k in range(data.shape[0])],
+                      columns=['e{}'.format(k + 1) for k in range(data.shape[1])])
     df['sum'] = df.sum(axis=1)
     df.loc['sum'] = df.sum(axis=0)
+    return df
+
+
+def level_data(tiles, print_data=True, t_bins=3, e_bins=3):
+    stratum = (tiles['t_level'].to_numpy() - 1) * e_bins + (tiles['e_level'].to_numpy() - 1)
+    data = np.bincount(stratum, minlength=t_bins * e_bins).reshape(t_bins, e_bins)
     if print_data:
-        print(df)
+        instrument.log(level_frame(data))
     return data
+
+
+def level_count(tiles, print_data=True, t_bins=3, e_bins=3):
+    """
+    Same table as level_table, from the DataFrame returned by sample_crop (no tif files needed).
+    """
+    instrument.log('samples', len(tiles))
+    return level_data(tiles, print_data, t_bins, e_bins)
@@ -0,0 +1,50 @@
+import os
+import numpy as np
+import pandas as pd
+
+MANIFEST_NAME = 'manifest.npz'
+
+
+def save_manifest(tiles, folder):
+    """
+    Save the sample DataFrame (one column per array) as manifest.npz in the folder.
+    """
+    path = os.path.join(folder, MANIFEST_NAME)
+    columns = {}
+    for column in tiles.columns:
+        values = tiles[column].to_numpy()
+        columns[column] = values.astype(str) if values.dtype == object else values
+    np.savez(path, **columns)
+    return path
+
+
+def load_manifest(folder):
+    """
+    :return: sample DataFrame saved by save_manifest, None if the folder has no manifest
+    """
+    path = os.path.join(folder, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return pd.DataFrame({column: data[column] for column in data.files})
+
+
+def manifest_from_names(folder, e_bins=3):
+    """
+    Levels recovered from the tif names (*_t?e?.tif), for folders saved without manifest,
+    and the sample row and column when all names have them (*_h???w???_t?e?.tif).
+    """
+    names = pd.Series([file for file in os.listdir(folder) if file.endswith('.tif')], dtype=object)
+    levels = names.str.extract(r'_t(\d+)e(\d+)\.tif$')
+    error = levels.isna().any(axis=1).to_numpy()
+    if error.any():
+        raise ValueError('tif name:', names[error].iloc[0])
+    tiles = pd.DataFrame({'name': names,
+                          't_level': levels[0].astype(np.int64),
+                          'e_level': levels[1].astype(np.int64)})
+    tiles['stratum'] = (tiles['t_level'] - 1) * e_bins + (tiles['e_level'] - 1)
+    position = names.str.extract(r'_h(\d+)w(\d+)_t\d+e\d+\.tif$')
+    if len(names) and not position.isna().any(axis=None):
+        tiles['row'] = position[0].astype(np.int64)
+        tiles['col'] = position[1].astype(np.int64)
+    return tiles
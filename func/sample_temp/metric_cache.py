@@ -0,0 +1,146 @@
+import os
+import time
+import json
+import hashlib
+import numpy as np
+from func import instrument
+
+
+def file_fingerprint(path, content=False):
+    """
+    Fingerprint of an input raster: absolute path, size and modification time,
+    or the sha1 of the file content when content=True (stable across copies and touches).
+    """
+    if content:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+    stat = os.stat(path)
+    return '{}:{}:{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def cache_key(*items):
+    """
+    Short hash of the fingerprints and parameters a cached result depends on.
+    """
+    return hashlib.sha1(json.dumps(items, default=str).encode()).hexdigest()[:16]
+
+
+def save_npz(path, **arrays):
+    """
+    np.savez to a temporary file then renamed, an interrupted run never leaves a truncated cache file.
+    """
+    temp_path = path + '.tmp.npz'
+    np.savez(temp_path, **arrays)
+    os.replace(temp_path, path)
+
+
+def cached_stage(path, make):
+    """
+    Stage output reused when it exists, otherwise make(partial_path) writes it and it is renamed to path
+    once complete (an interrupted stage is run again).
+    """
+    if os.path.exists(path):
+        instrument.log('cached:', path)
+        return path
+    partial_path = os.path.splitext(path)[0] + '.partial.tif'
+    make(partial_path)
+    os.replace(partial_path, path)
+    return path
+
+
+class MetricCache:
+    """
+    Per-sample metrics of one scene cached on disk, saved every checkpoint_seconds of sample rows and at the end
+    of the scene (flush), so that an interrupted run resumes from the last saved rows without rewriting
+    the whole cache after every row.
+    The edge file (zero fraction and edge level, key of the image side) and the target file
+    (target level, key of the image and land cover sides) are separate: a new land cover
+    reuses the edge levels.
+    Not computed values are NaN, a row is finished when both files have it.
+    Usage:
+        cache = MetricCache(cache_folder, edge_key, target_key)
+        cache.load(rows, cols)
+        cache.update(i, records)  # records of score_row
+        records = cache.records(i)  # finished row
+        cache.flush()  # end of the scene
+    """
+    def __init__(self, folder, edge_key, target_key, checkpoint_seconds=30):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.edge_path = os.path.join(folder, 'edge_{}.npz'.format(edge_key))
+        self.target_path = os.path.join(folder, 'target_{}.npz'.format(target_key))
+        self.checkpoint_seconds = checkpoint_seconds
+        self.unsaved = 0  # rows updated since the last save
+        self.saved_time = time.perf_counter()
+
+    def load(self, rows, cols):
+        shape = (rows, cols)
+        self.zero = np.full(shape, np.nan)
+        self.edge = np.full(shape, np.nan)
+        self.edge_done = np.zeros(rows, dtype=bool)
+        self.target = np.full(shape, np.nan)
+        self.target_done = np.zeros(rows, dtype=bool)
+        if os.path.exists(self.edge_path):
+            with np.load(self.edge_path) as data:
+                if data['edge'].shape == shape:
+                    self.zero, self.edge, self.edge_done = data['zero'], data['edge'], data['done']
+        if os.path.exists(self.target_path):
+            with np.load(self.target_path) as data:
+                if data['target'].shape == shape:
+                    self.target, self.target_done = data['target'], data['done']
+        instrument.log('metric cache: {} of {} sample rows finished, edge levels of {} rows'
+                       .format(np.sum(self.row_done()), rows, np.sum(self.edge_done)))
+        self.unsaved = 0
+        self.saved_time = time.perf_counter()
+
+    def row_done(self):
+        return self.edge_done & self.target_done
+
+    def records(self, i):
+        """
+        :return: records of the finished row i, as returned by score_row
+        """
+        cols = np.flatnonzero(~np.isnan(self.zero[i]))
+        return [(j, self.zero[i, j], self.target[i, j], self.edge[i, j]) for j in cols]
+
+    def update(self, i, records):
+        for j, zero, target_level, edge_level in records:
+            self.zero[i, j] = zero
+            self.target[i, j] = target_level
+            self.edge[i, j] = edge_level
+        self.edge_done[i] = True
+        self.target_done[i] = True
+        self.unsaved += 1
+        if time.perf_counter() - self.saved_time >= self.checkpoint_seconds:
+            self.flush()
+
+    def flush(self):
+        """
+        Save the rows updated since the last save.
+        """
+        if self.unsaved:
+            save_npz(self.edge_path, zero=self.zero, edge=self.edge, done=self.edge_done)
+            save_npz(self.target_path, target=self.target, done=self.target_done)
+        self.unsaved = 0
+        self.saved_time = time.perf_counter()
+
+
+def scene_cache(cache_folder, image_path, lc_path, lc_target_value, process_image=True, quantile='exact',
+                lc_in_memory=False, rgb_bands=None, sample_size=256, zero_percent=0.2, edge_mode='tile',
+                prescreen=False, content_hash=False, stride=None):
+    """
+    Cache paths and metric cache of one scene, keyed by the fingerprints of the input rasters
+    and the parameters each stage depends on.
+    :return: dict with image_process_path, lc_process_path (stage outputs in cache_folder, reused when they exist)
+             and metrics (MetricCache)
+    """
+    image_key = cache_key(file_fingerprint(image_path, content_hash), process_image, quantile)
+    lc_key = cache_key(image_key, file_fingerprint(lc_path, content_hash), lc_target_value)
+    edge_key = cache_key(image_key, rgb_bands, sample_size, zero_percent, edge_mode, prescreen, stride)
+    target_key = cache_key(lc_key, lc_in_memory, sample_size, zero_percent, prescreen, stride)
+    return {'image_process_path': os.path.join(cache_folder, 'image_{}.tif'.format(image_key)),
+            'lc_process_path': os.path.join(cache_folder, 'lc_{}.tif'.format(lc_key)),
+            'metrics': MetricCache(cache_folder, edge_key, target_key)}
@@ -0,0 +1,138 @@
+import time
+import queue
+import threading
+
+_END = object()
+
+
+class Prefetch:
+    """
+    Items of an iterable produced ahead by a background thread into a bounded queue (at most depth items),
+    e.g. the next sample row strips read while the current one is scored (GDAL releases the GIL while reading).
+    Usage:
+        strips = Prefetch(read_strips, depth=2)
+        for strip in strips:
+            ...
+        strips.close()
+        strips.stats  # busy: time producing, full: producer waiting on a full queue (the consumer is slower),
+                      # empty: consumer waiting on an empty queue (the producer is slower)
+    """
+    def __init__(self, iterable, depth=2, name='read'):
+        self.name = name
+        self.queue = queue.Queue(max(depth, 1))
+        self.stop = threading.Event()
+        self.stats = {'items': 0, 'busy': 0., 'full': 0., 'empty': 0.}
+        self.thread = threading.Thread(target=self._produce, args=(iter(iterable),), daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        start = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.stats['full'] += time.perf_counter() - start
+
+    def _produce(self, iterator):
+        try:
+            while not self.stop.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                self.stats['busy'] += time.perf_counter() - start
+                self.stats['items'] += 1
+                self._put(item)
+        except BaseException as error:  # raised again in the consumer
+            self._put(error)
+            return
+        self._put(_END)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        item = self.queue.get()
+        self.stats['empty'] += time.perf_counter() - start
+        if item is _END:
+            self.queue.put(_END)
+            raise StopIteration
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+
+class Drain:
+    """
+    Calls func(*args) queued with put() run in order by a background thread, at most depth calls waiting,
+    e.g. the candidate samples written while the next ones are scored.
+    Usage:
+        drain = Drain(depth=16)
+        drain.put(writer.write, sample, save_path, geo, proj)  # blocks only when depth calls are waiting
+        drain.close()  # all calls done, the first error raised
+        drain.stats  # busy: time calling, full: caller waiting on a full queue (the calls are slower),
+                     # empty: thread waiting for calls (the caller is slower)
+    """
+    def __init__(self, depth=16, name='write'):
+        self.name = name
+        self.queue = queue.Queue(max(depth, 1))
+        self.error = None
+        self.stats = {'items': 0, 'busy': 0., 'full': 0., 'empty': 0.}
+        self.thread = threading.Thread(target=self._consume, daemon=True)
+        self.thread.start()
+
+    def _consume(self):
+        while True:
+            start = time.perf_counter()
+            task = self.queue.get()
+            self.stats['empty'] += time.perf_counter() - start
+            if task is _END:
+                return
+            if self.error is not None:
+                continue  # drain the queue after an error, the caller raises it
+            start = time.perf_counter()
+            try:
+                task[0](*task[1:])
+            except BaseException as error:
+                self.error = error
+            self.stats['busy'] += time.perf_counter() - start
+            self.stats['items'] += 1
+
+    def put(self, func, *args):
+        if self.error is not None:
+            raise self.error
+        start = time.perf_counter()
+        self.queue.put((func,) + args)
+        self.stats['full'] += time.perf_counter() - start
+
+    def close(self):
+        """
+        Wait for all queued calls, and raise the first error of them.
+        """
+        self.queue.put(_END)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def pipeline_stats(read, drain=None):
+    """
+    Stall summary of a pipelined sample_crop: time each stage spent waiting on the others.
+    :return: dict (saved in the run report), text line
+    """
+    stats = {'read': dict(read.stats)}
+    text = 'pipeline: read {} strips in {:.2f}s, stalled {:.2f}s (queue full) | score waited {:.2f}s for reads'.format(
+        read.stats['items'], read.stats['busy'], read.stats['full'], read.stats['empty'])
+    if drain is not None:
+        stats['write'] = dict(drain.stats)
+        text += ', {:.2f}s for writes | write {} samples in {:.2f}s, idle {:.2f}s'.format(
+            drain.stats['full'], drain.stats['items'], drain.stats['busy'], drain.stats['empty'])
+    return stats, text
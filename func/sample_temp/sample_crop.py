@@ -1,15 +1,45 @@
 import os
 from osgeo import gdal
 import numpy as np
+import pandas as pd
 from skimage import feature, color
-from func.data_preparation import array_proj
+from func import instrument
+from func.data_preparation import ArrayWriter, raster_remove
+from .manifest import save_manifest
+from .tile_store import TileStore
+from .tile_kernel import tile_metrics, resolve_kernel
+from .level_grid import target_fraction_grid, edge_level_grid, lc_strip_bytes, zero_fraction_grid
 
 
-def level_target(sample, sample_geo, lc, lc_geo):
+def level_target(sample, sample_geo, lc, lc_geo, target_values=None):
     """
     use land cover data
+    target_values: None (lc is the target mask, True=255), or the land cover values of several target classes
+                   (lc holds the land cover classes): one entropy per class, see class_fractions
     """
-    C, H, W = sample.shape
+    target_area = lc[target_window(sample.shape, sample_geo, lc.shape, lc_geo)]
+    if target_values is not None:
+        return cross_entropy(class_fractions(target_area, target_values))
+    target_level = np.sum(target_area / 255) / (target_area.shape[0] * target_area.shape[1])
+
+    entropy = cross_entropy(target_level)
+    return entropy
+
+
+def class_fractions(target_area, target_values):
+    """
+    Fraction of the land cover window covered by each target class, one comparison of the window with
+    every class value (any land cover data type, negative no data and large class codes included).
+    """
+    counts = np.sum(target_area[..., np.newaxis] == np.asarray(target_values), axis=(0, 1))
+    return counts / target_area.size
+
+
+def target_window(sample_shape, sample_geo, lc_shape, lc_geo):
+    """
+    Land cover window (rows, cols slices) covering a sample (c, h, w) at sample_geo, one pixel of margin.
+    """
+    C, H, W = sample_shape
     extent = [sample_geo[0], sample_geo[0] + W * sample_geo[1],
               sample_geo[3], sample_geo[3] + H * sample_geo[5]]
 
@@ -27,19 +57,14 @@ def level_target(sample, sample_geo, lc, lc_geo):
         w1, w2 = w2, w1
 
     h1 = int(np.max([np.floor(h1), 0]))
-    h2 = int(np.min([np.ceil(h2) + 1, lc.shape[0]]))
+    h2 = int(np.min([np.ceil(h2) + 1, lc_shape[0]]))
     w1 = int(np.max([np.floor(w1), 0]))
-    w2 = int(np.min([np.ceil(w2) + 1, lc.shape[1]]))
-
-    target_area = lc[h1:h2, w1:w2]
-    target_level = np.sum(target_area / 255) / (target_area.shape[0] * target_area.shape[1])
-
-    entropy = cross_entropy(target_level)
-    return entropy
+    w2 = int(np.min([np.ceil(w2) + 1, lc_shape[1]]))
+    return slice(h1, h2), slice(w1, w2)
 
 
 def cross_entropy(p, epsilon=1e-10):
-    assert 0 <= p <= 1, 'p should be in [0, 1]'
+    assert np.all((0 <= p) & (p <= 1)), 'p should be in [0, 1]'
     p = np.clip(p, epsilon, 1. - epsilon)
     q = 1 - p
     entropy = - p * np.log2(p) - q * np.log2(q)
@@ -66,51 +91,162 @@ def level_edge(sample, sigma=2.0, f=10):
     return edge_level
 
 
-def class_by_level(temp_folder, image_list,
-                   target_list, edge_list,
-                   q1=0.05, q2=0.95):
-    file_number = len(image_list)
-    t_min = np.quantile(target_list, q1)
-    t_max = np.quantile(target_list, q2)
-    e_min = np.quantile(edge_list, q1)
-    e_max = np.quantile(edge_list, q2)
-
-    t_l = (t_max - t_min) / 3.
-    e_l = (e_max - e_min) / 3.
-    t_l1, t_l2 = t_min + t_l, t_min + 2 * t_l
-    e_l1, e_l2 = e_min + e_l, e_min + 2 * e_l
-    # print('target [{:.5f} {:.5f}]  edge [{:.5f} {:.5f}]'.format(t_l1, t_l2, e_l1, e_l2))
-
-    for i in range(file_number):
-        image_name = image_list[i]
-        image_path = os.path.join(temp_folder, image_name)
-
-        t_value, e_value = target_list[i], edge_list[i]
-
-        if 0. <= t_value < t_l1:
-            target_level = 1
-        elif t_l1 <= t_value < t_l2:
-            target_level = 2
-        elif t_value >= t_l2:
-            target_level = 3
-        else:
-            raise ValueError('target value error -- idx:{} t:{}'.format(i, t_value))
-
-        if e_value < e_l1:
-            edge_level = 1
-        elif e_l1 <= e_value < e_l2:
-            edge_level = 2
-        elif e_value >= e_l2:
-            edge_level = 3
-        else:
-            raise ValueError('edge value error -- idx:{} e:{}'.format(i, e_value))
+def level_threshold(value_list, q1=0.05, q2=0.95, bins=3):
+    """
+    bins - 1 thresholds splitting [quantile q1, quantile q2] of the values into equal levels.
+    """
+    v_min = np.quantile(value_list, q1)
+    v_max = np.quantile(value_list, q2)
+    v_l = (v_max - v_min) / bins
+    return v_min + np.arange(1, bins) * v_l
+
+
+def level_class(target_list, edge_list, q1=0.05, q2=0.95, t_bins=3, e_bins=3):
+    """
+    Target level (1 - t_bins) and edge level (1 - e_bins) of every sample.
+    :return: target_levels, edge_levels (int arrays)
+    """
+    target_list = np.asarray(target_list, dtype=np.float64)
+    edge_list = np.asarray(edge_list, dtype=np.float64)
+    if target_list.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    error = np.flatnonzero(~(target_list >= 0.))
+    if error.size:
+        raise ValueError('target value error -- idx:{} t:{}'.format(error[0], target_list[error[0]]))
+    error = np.flatnonzero(np.isnan(edge_list))
+    if error.size:
+        raise ValueError('edge value error -- idx:{} e:{}'.format(error[0], edge_list[error[0]]))
+
+    target_levels = np.digitize(target_list, level_threshold(target_list, q1, q2, t_bins)) + 1
+    edge_levels = np.digitize(edge_list, level_threshold(edge_list, q1, q2, e_bins)) + 1
+    return target_levels, edge_levels
+
+
+def level_stratum(target_levels, edge_levels, e_bins=3):
+    """
+    Class index of every sample, (t_level - 1) * e_bins + (e_level - 1): t1e1, t1e2, ... in row-major order.
+    """
+    return (np.asarray(target_levels) - 1) * e_bins + (np.asarray(edge_levels) - 1)
 
-        new_name = image_name[:-4] + '_t{0:01d}e{1:01d}.tif'.format(target_level, edge_level)
-        new_path = os.path.join(temp_folder, new_name)
-        os.rename(image_path, new_path)
-        print('\r' + '[{0}/{1}] {2} t:{3:.4f} e:{4:.4f}'
-              .format(i + 1, file_number, new_name, t_value, e_value), end='')
-    print('\n', end='')
+
+def level_name(image_name, target_level, edge_level):
+    return image_name[:-4] + '_t{0:01d}e{1:01d}.tif'.format(target_level, edge_level)
+
+
+def target_class(tiles, value, e_bins=3):
+    """
+    Samples of sample_crop(target_values=[...]) with the target, levels, class and name of the target class value
+    (columns target, t_level, stratum, name), to select samples for this class.
+    """
+    names = [name.rsplit('_t', 1)[0] + '.tif' for name in tiles['name']]
+    target_levels = tiles['t_level_{}'.format(value)].to_numpy()
+    return tiles.assign(target=tiles['target_{}'.format(value)], t_level=target_levels,
+                        stratum=level_stratum(target_levels, tiles['e_level'].to_numpy(), e_bins),
+                        name=[level_name(name, t, e) for name, t, e in zip(names, target_levels, tiles['e_level'])])
+
+
+def score_row(strip, i, sample_size, zero_percent, rgb_bands, lc, lc_geo, image_geo,
+              target_all=None, edge_all=None, keep_all=None, stride=None, kernel='numpy', target_values=None):
+    """
+    Zero fraction, target level and edge level of the samples in sample row i.
+    strip: image rows of sample row i, (c, sample_size, w)
+    target_all / edge_all: levels of all samples computed beforehand (level_grid) or cached (NaN: not computed),
+                           or None
+    keep_all: samples left by the no data pre-screening (zero_fraction_grid), or None
+    stride: image pixels between two samples (sample_size if None)
+    kernel: 'numpy' (functions above) or 'numba' (zero count, target fraction and Canny edge count of a sample
+            in one compiled pass, same values, see tile_kernel)
+    target_values: land cover values of several target classes (lc holds the land cover classes), the target level
+                   of a sample is then an array of one entropy per class (None: lc is the target mask)
+    :return: list of (j, zero, target_level, edge_level) of the samples kept by zero_percent
+    """
+    stride = sample_size if stride is None else stride
+    cols = (strip.shape[2] - sample_size) // stride + 1
+    x1 = i * stride
+    records = []
+    for j in range(cols):
+        if keep_all is not None and not keep_all[i, j]:
+            continue
+        y1 = j * stride
+        y2 = j * stride + sample_size
+        sample = strip[:, :, y1:y2]
+        if kernel != 'numpy':
+            records.extend(score_sample(sample, i, j, stride, zero_percent, rgb_bands, lc, lc_geo, image_geo,
+                                        target_all, edge_all, kernel, target_values))
+            continue
+
+        with instrument.step('zero_filter'):
+            sample_zero = np.all(sample == 0, axis=0).astype(np.uint8)
+        if np.sum(sample_zero) < zero_percent * sample_size ** 2:  # ignore samples with too many 0
+            geo_sample = list(image_geo)
+            geo_sample[0] = geo_sample[0] + y1 * geo_sample[1]  # geo[0] -> width
+            geo_sample[3] = geo_sample[3] + x1 * geo_sample[5]
+
+            # level rate
+            if target_all is None or np.isnan(target_all[i, j]).any():
+                with instrument.step('target'):
+                    target_level = level_target(sample, geo_sample, lc, lc_geo, target_values)
+            else:
+                target_level = target_all[i, j]
+            if edge_all is None or np.isnan(edge_all[i, j]):
+                with instrument.step('edge'):
+                    edge_level = level_edge(sample[rgb_bands, :, :])
+            else:
+                edge_level = edge_all[i, j]
+            records.append((j, np.sum(sample_zero) / sample_size ** 2, target_level, edge_level))
+    return records
+
+
+def score_sample(sample, i, j, stride, zero_percent, rgb_bands, lc, lc_geo, image_geo, target_all, edge_all,
+                 kernel, target_values=None):
+    """
+    score_row of one sample with the fused kernel (tile_metrics).
+    :return: [(j, zero, target_level, edge_level)], or [] when the sample has too many 0
+    """
+    C, H, W = sample.shape
+    geo_sample = list(image_geo)
+    geo_sample[0] = geo_sample[0] + j * stride * geo_sample[1]
+    geo_sample[3] = geo_sample[3] + i * stride * geo_sample[5]
+    target_known = target_all is not None and not np.isnan(target_all[i, j]).any()
+    edge_known = edge_all is not None and not np.isnan(edge_all[i, j])
+    lc_area = None if target_known else lc[target_window(sample.shape, geo_sample, lc.shape, lc_geo)]
+    with instrument.step('tile_kernel'):
+        zero, target, edge_count = tile_metrics(sample, None if target_values is not None else lc_area, rgb_bands,
+                                                zero_percent * H * W, edge=not edge_known, kernel=kernel)
+    if zero >= zero_percent * H * W:
+        return []
+    if target_values is not None and not target_known:
+        with instrument.step('target'):
+            target = class_fractions(lc_area, target_values)
+    target_level = target_all[i, j] if target_known else cross_entropy(target)
+    edge_level = edge_all[i, j] if edge_known else 10 * edge_count / (H * W)  # level_edge(f=10)
+    return [(j, zero / (H * W), target_level, edge_level)]
+
+
+def read_strip(image_ds, i, sample_size, keep_row=None, stride=None):
+    """
+    Image rows of sample row i read with a GDAL window, (c, sample_size, w)
+    keep_row: samples of the row left by the pre-screening, only the columns between
+              the first and last of them are read (the rest stays 0)
+    """
+    W = image_ds.RasterXSize
+    stride = sample_size if stride is None else stride
+    x1, x2 = 0, W
+    if keep_row is not None:
+        keep = np.flatnonzero(keep_row)
+        if keep.size == 0:
+            return np.zeros((image_ds.RasterCount, sample_size, W), dtype=np.uint8)
+        x1, x2 = keep[0] * stride, keep[-1] * stride + sample_size
+    with instrument.step('read') as step:
+        strip = image_ds.ReadAsArray(x1, i * stride, x2 - x1, sample_size)
+        step.add(bytes_read=strip.nbytes)
+    if len(strip.shape) == 2:
+        strip = strip[np.newaxis]
+    if x2 - x1 < W:
+        full = np.zeros((strip.shape[0], sample_size, W), dtype=strip.dtype)
+        full[:, :, x1:x2] = strip
+        strip = full
+    return strip
 
 
 def sample_crop(image_path,
@@ -120,71 +256,294 @@ def sample_crop(image_path,
                 rgb_bands=None,
                 sample_size=256,
                 zero_percent=0.2,
-                delete_temp_tif=True):
+                delete_temp_tif=True,
+                save_tiles=True,
+                target_grid=False,
+                workers=1,
+                edge_mode='tile',
+                windowed=False,
+                prescreen=False,
+                prescreen_margin=0.1,
+                build_overviews=False,
+                tile_store='tif',
+                write_workers=0,
+                write_options=None,
+                metric_cache=None,
+                t_bins=3,
+                e_bins=3,
+                q1=0.05,
+                q2=0.95,
+                stride=None,
+                stream=None,
+                pipeline=False,
+                read_depth=2,
+                write_depth=16,
+                kernel='numpy',
+                target_values=None):
+    """
+    Crop the image into candidate samples, and record target (entropy) and edge level of each sample.
+    :param save_tiles: save every candidate sample in temp_folder (crop_name column of the manifest),
+                       or only score them in memory (temp_folder unused)
+    :param target_grid: compute the target level of all samples at once (target_fraction_grid)
+                        instead of level_target for each sample, same values
+    :param workers: number of processes scoring the sample rows (image and land cover in shared memory),
+                    the results are the same as workers=1
+    :param edge_mode: 'tile' (canny of each sample), 'scene' (canny of image strips, block-summed per sample)
+                      or 'gradient' (thresholded gradient magnitude of image strips), see edge_level_grid
+    :param windowed: read one sample row strip of image and land cover at a time (GDAL window reads)
+                     instead of the whole rasters, same samples; the peak strip memory is printed
+    :param prescreen: drop the samples that are clearly no data (zero fraction of a 1/8 decimated read or overview
+                      >= zero_percent + prescreen_margin) before the full resolution read and scoring;
+                      samples near the threshold are still checked exactly. Needs windowed: the whole image is
+                      read otherwise, and the dropped samples would save no read
+    :param build_overviews: with prescreen, build the 1/8 overview of the image when it has none (an external
+                            image_path.ovr: only for an image the run created, not an input image)
+    :param tile_store: how candidate samples are saved when save_tiles=True, 'tif' (one GeoTIFF each)
+                       or 'npy' (one memory-mappable .npy file in temp_folder, see TileStore)
+    :param write_workers: threads writing the candidate GeoTIFFs while scoring goes on (0: synchronous)
+    :param write_options: GeoTIFF creation options of the candidates, see creation_options
+    :param metric_cache: MetricCache of the scene (see scene_cache), the finished sample rows are not scored
+                         again (nor read when save_tiles=False), the others are cached row by row
+    :param stride: image pixels between two candidate samples, overlapping samples when < sample_size
+                   (sample_size if None); the target levels then come from target_fraction_grid, and
+                   edge_mode 'scene' or 'gradient' keeps the edge detection to one pass over the image
+    :param t_bins, e_bins: number of target and edge levels, equal steps of [quantile q1, quantile q2], see level_class
+    :param pipeline: read the next sample row strips in a background thread (read_depth strips ahead) while the
+                     current one is scored, and write the candidate samples from another thread (write_depth
+                     samples queued), same samples; the time each stage waited on the others is printed
+    :param kernel: 'numpy' or 'numba' (zero count, target fraction and Canny edge count of each sample fused in one
+                   compiled pass, same values, falls back to 'numpy' when Numba is not installed), see tile_kernel
+    :param target_values: land cover values of several target classes scored in the same pass (lc_path holds the
+                          land cover classes, see land_cover_process with a list of class values): the target of
+                          every sample is computed for each class (target_{value}, t_level_{value} columns), the
+                          edge level and the candidate samples are shared; target, t_level and stratum are those of
+                          the first class, see target_class for the others
+    :param stream: StreamSelect fed with the scored samples of each row instead of collecting them
+                   (save_tiles=False, memory bounded by its reservoirs whatever the scene size)
+    :return: DataFrame of the candidate samples (name, row, col, geo0-geo5, zero, target, edge,
+             t_level, e_level, stratum, crop_name), also saved as manifest.npz in temp_folder when save_tiles=True;
+             the stream when stream is given
+    """
     if rgb_bands is None:
         rgb_bands = [2, 1, 0]
     assert len(rgb_bands) == 1 or 3
+    assert stream is None or not save_tiles, 'stream needs save_tiles=False'
+    assert not (windowed and workers > 1), 'windowed reading runs in one process'
+    assert not prescreen or windowed, 'prescreen needs windowed reading'
+    kernel = resolve_kernel(kernel)
+    assert target_values is None or (stream is None and metric_cache is None), \
+        'several target values are scored without stream and metric cache'
 
     image_ds = gdal.Open(image_path)
     image_geo = image_ds.GetGeoTransform()
     image_proj = image_ds.GetProjection()
-    image = image_ds.ReadAsArray()  # (c, h, w)
-    del image_ds
-    print('image', image.shape)
-
-    lc_ds = gdal.Open(lc_path)
+    C, H, W = image_ds.RasterCount, image_ds.RasterYSize, image_ds.RasterXSize
+    stride = sample_size if stride is None else stride
+    rows = (H - sample_size) // stride + 1
+    cols = (W - sample_size) // stride + 1
+
+    rows, cols = max(rows, 0), max(cols, 0)  # image smaller than one sample: no sample
+
+    keep_all = None
+    if prescreen:
+        with instrument.step('zero_filter'):
+            keep_all = zero_fraction_grid(image_ds, rows, cols, sample_size, build_overviews=build_overviews,
+                                          stride=stride) < zero_percent + prescreen_margin
+        instrument.log('pre-screening: {} of {} samples dropped as no data'
+                       .format(keep_all.size - np.sum(keep_all), keep_all.size))
+    image = None
+    if not windowed:
+        with instrument.step('read') as step:
+            image = image_ds.ReadAsArray()  # (c, h, w)
+            step.add(bytes_read=image.nbytes)
+        del image_ds
+    instrument.log('image', (C, H, W))
+
+    lc_ds = lc_path if isinstance(lc_path, gdal.Dataset) else gdal.Open(lc_path)  # path or aligned MEM dataset
     lc_geo = lc_ds.GetGeoTransform()
-    lc = lc_ds.ReadAsArray()
-    del lc_ds
-
-    if not os.path.exists(temp_folder):
+    lc = None
+    if not windowed:
+        with instrument.step('read') as step:
+            lc = lc_ds.ReadAsArray()
+            step.add(bytes_read=lc.nbytes)
+        del lc_ds
+
+    if save_tiles and not os.path.exists(temp_folder):
         os.mkdir(temp_folder)
-
-    C, H, W = image.shape
-    rows = (H - sample_size) // sample_size + 1
-    cols = (W - sample_size) // sample_size + 1
+    writer = ArrayWriter(write_workers, options=write_options)
+    store = None
+    if save_tiles and tile_store == 'npy':
+        store = TileStore(temp_folder, image_path, image_proj)
+        store_list = []
+
+    row_done = np.zeros(rows, dtype=bool)
+    if metric_cache is not None:
+        metric_cache.load(rows, cols)
+        row_done = metric_cache.row_done()
+
+    target_all = None
+    if (target_grid or windowed or stride != sample_size) and not row_done.all():
+        with instrument.step('target'):
+            target_all = cross_entropy(target_fraction_grid(lc_ds if windowed else lc, lc_geo, image_geo,
+                                                            rows, cols, sample_size, stride,
+                                                            target_values=target_values))
+    edge_all = None
+    if edge_mode != 'tile' and not (metric_cache is not None and metric_cache.edge_done.all()):
+        with instrument.step('edge'):
+            edge_all = edge_level_grid(image_ds if windowed else image, rgb_bands, rows, cols, sample_size,
+                                       method='canny' if edge_mode == 'scene' else edge_mode, stride=stride)
+    if metric_cache is not None:  # cached levels first, NaN ones are computed by score_row
+        edge_all = np.where(metric_cache.edge_done[:, np.newaxis], metric_cache.edge,
+                            np.nan if edge_all is None else edge_all)
+        if target_all is None:
+            target_all = np.where(metric_cache.target_done[:, np.newaxis], metric_cache.target, np.nan)
+    row_list = np.flatnonzero(~row_done)
 
     image_list = []
+    sample_rows = []
+    col_list = []
+    geo_list = []
+    zero_list = []
     target_list = []
     edge_list = []
     count = 0
+    strip_bytes = 0
+    if stream is not None:
+        scene_index = stream.add_scene(sample_prefix, image_path, image_geo, stride)
 
     # ----- First loop: level value recording -----
-    for i in range(rows):
-        for j in range(cols):
-            x1 = i * sample_size
-            x2 = i * sample_size + sample_size
-            y1 = j * sample_size
-            y2 = j * sample_size + sample_size
-            sample = image[:, x1:x2, y1:y2]
+    if windowed:
+        read_ds = gdal.Open(image_path) if pipeline else image_ds  # one dataset per thread
+        strips = (read_strip(read_ds, i, sample_size, None if keep_all is None else keep_all[i], stride)
+                  for i in row_list)
+    else:
+        strips = (image[:, i * stride:i * stride + sample_size] for i in row_list)
+    if pipeline:
+        from .pipeline import Prefetch, Drain, pipeline_stats
+        strips = Prefetch(strips, read_depth, 'read')
+    drain = Drain(write_depth, 'write') if pipeline and save_tiles else None
+    if workers > 1:
+        from .sample_pool import score_rows_pool
+        scored = zip(strips, score_rows_pool(image, lc, lc_geo, image_geo, target_all, edge_all, keep_all,
+                                             sample_size, zero_percent, rgb_bands, workers, row_list, stride,
+                                             kernel, target_values))
+    else:
+        scored = ((strip, score_row(strip, i, sample_size, zero_percent, rgb_bands, lc, lc_geo, image_geo,
+                                    target_all, edge_all, keep_all, stride, kernel, target_values))
+                  for i, strip in zip(row_list, strips))
 
-            sample_zero = np.all(sample == 0, axis=0).astype(np.uint8)
-            if np.sum(sample_zero) < zero_percent * sample_size ** 2:  # ignore samples with too many 0
-                geo_sample = list(image_geo)
-                geo_sample[0] = geo_sample[0] + y1 * geo_sample[1]  # geo[0] -> width
-                geo_sample[3] = geo_sample[3] + x1 * geo_sample[5]
-
-                # save samples
-                save_name = '{0}_h{1:03d}w{2:03d}.tif'.format(sample_prefix, i, j)
-                save_path = os.path.join(temp_folder, save_name)
-                array_proj(sample, save_path, geo_sample, image_proj)
-
-                # level rate
-                sample_rgb = sample[rgb_bands, :, :]
-                target_level = level_target(sample, geo_sample, lc, lc_geo)
-                edge_level = level_edge(sample_rgb)
-
-                image_list.append(save_name)
-                target_list.append(target_level)
-                edge_list.append(edge_level)
-
-                count += 1
-                print('\r' + '<{}> {} {} target:{:.4f} edge:{:.4f}'
-                      .format(count, save_name, sample.shape, target_level, edge_level), end='')
+    for i in range(rows):
+        if row_done[i]:  # finished in a previous run
+            records = metric_cache.records(i)
+            strip = None
+            if save_tiles and records:
+                strip = read_strip(image_ds, i, sample_size, stride=stride) if windowed \
+                    else image[:, i * stride:i * stride + sample_size]
+        else:
+            strip, records = next(scored)
+            if metric_cache is not None:
+                metric_cache.update(i, records)
+        if strip is not None:
+            strip_bytes = max(strip_bytes, strip.nbytes)
+        if stream is not None:
+            stream.add(scene_index, i, records)
+            count += len(records)
+            instrument.progress('<{}> sample row {}/{}'.format(count, i + 1, rows))
+            continue
+        for j, zero, target_level, edge_level in records:
+            x1 = i * stride
+            y1 = j * stride
+            y2 = j * stride + sample_size
+            sample = None if strip is None else strip[:, :, y1:y2]
+
+            geo_sample = list(image_geo)
+            geo_sample[0] = geo_sample[0] + y1 * geo_sample[1]  # geo[0] -> width
+            geo_sample[3] = geo_sample[3] + x1 * geo_sample[5]
+
+            # save samples
+            save_name = '{0}_h{1:03d}w{2:03d}.tif'.format(sample_prefix, i, j)
+            if save_tiles:
+                with instrument.step('write', bytes_written=sample.nbytes):
+                    if store is None:
+                        task = (writer.write, sample, os.path.join(temp_folder, save_name), geo_sample, image_proj)
+                    else:
+                        task = (store.append, sample)
+                        store_list.append(len(store_list))  # appended in order
+                    if drain is None:
+                        task[0](*task[1:])
+                    else:
+                        drain.put(*task)
+
+            image_list.append(save_name)
+            sample_rows.append(i)
+            col_list.append(j)
+            geo_list.append(geo_sample)
+            zero_list.append(zero)
+            target_list.append(target_level)
+            edge_list.append(edge_level)
+
+            count += 1
+            instrument.progress('<{}> {} {} target:{} edge:{:.4f}'
+                                .format(count, save_name, (C, sample_size, sample_size),
+                                        ' '.join('{:.4f}'.format(v) for v in np.atleast_1d(target_level)),
+                                        edge_level))
+    if metric_cache is not None:
+        metric_cache.flush()
+    instrument.add_tiles(count)
+
+    if windowed:
+        instrument.progress_end('peak strip memory: image {:.1f} MB, land cover {:.1f} MB'.format(
+            strip_bytes / 1024 ** 2, lc_strip_bytes(lc_ds, lc_geo, image_geo, rows, sample_size, stride) / 1024 ** 2))
+        del image_ds, lc_ds
 
     # ----- Second loop: classify according to level value -----
-    class_by_level(temp_folder, image_list, target_list, edge_list)
+    with instrument.step('write'):
+        if drain is not None:
+            drain.close()
+        writer.close()
+        if store is not None:
+            store.close()
+    instrument.progress_end('{} candidate samples'.format(count))
+    if pipeline:
+        strips.close()
+        stats, text = pipeline_stats(strips, drain)
+        instrument.annotate(pipeline=stats)
+        instrument.log(text)
+    if stream is not None:
+        stream.flush()
+        return stream
+    class_targets = None
+    if target_values is not None:
+        class_targets = np.array(target_list, dtype=np.float64).reshape(-1, len(target_values))
+        target_list = class_targets[:, 0]
+    target_levels, edge_levels = level_class(target_list, edge_list, q1, q2, t_bins, e_bins)
+    tiles = pd.DataFrame({'name': [level_name(name, t, e) for name, t, e
+                                   in zip(image_list, target_levels, edge_levels)],
+                          'row': sample_rows,
+                          'col': col_list})
+    geo_array = np.array(geo_list, dtype=np.float64).reshape(-1, 6)
+    for k in range(6):
+        tiles['geo{}'.format(k)] = geo_array[:, k]
+    tiles['zero'] = zero_list
+    tiles['target'] = target_list
+    tiles['edge'] = edge_list
+    tiles['t_level'] = target_levels
+    tiles['e_level'] = edge_levels
+    tiles['stratum'] = level_stratum(target_levels, edge_levels, e_bins)
+    if class_targets is not None:
+        for k, value in enumerate(target_values):
+            tiles['target_{}'.format(value)] = class_targets[:, k]
+            tiles['t_level_{}'.format(value)] = level_class(class_targets[:, k], edge_list, q1, q2, t_bins,
+                                                            e_bins)[0]
+    if store is not None:
+        tiles['store_index'] = store_list
+    elif save_tiles:
+        tiles['crop_name'] = image_list  # candidate GeoTIFFs keep their crop names, the level is in the manifest
+    if save_tiles:
+        save_manifest(tiles, temp_folder)
 
     if delete_temp_tif:
-        os.remove(image_path)
-        os.remove(lc_path)
+        raster_remove(image_path)
+        if not isinstance(lc_path, gdal.Dataset):
+            os.remove(lc_path)
+    return tiles
@@ -0,0 +1,74 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+from .sample_crop import score_row
+
+_shared = {}
+
+
+def shared_array(array):
+    """
+    Copy the array into shared memory.
+    :return: SharedMemory, (name, shape, dtype) to attach the array in other processes
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(desc):
+    name, shape, dtype = desc
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _init_worker(image_desc, lc_desc, kwargs):
+    _shared['image_shm'], _shared['image'] = attach_array(image_desc)
+    _shared['lc_shm'], _shared['lc'] = attach_array(lc_desc)
+    _shared['kwargs'] = kwargs
+
+
+def _score_row_task(i):
+    sample_size, stride = _shared['kwargs']['sample_size'], _shared['kwargs']['stride']
+    strip = _shared['image'][:, i * stride:i * stride + sample_size]
+    return score_row(strip, i, lc=_shared['lc'], **_shared['kwargs'])
+
+
+def score_rows_pool(image, lc, lc_geo, image_geo, target_all, edge_all, keep_all,
+                    sample_size=256, zero_percent=0.2, rgb_bands=None, workers=2, row_list=None, stride=None,
+                    kernel='numpy', target_values=None):
+    """
+    score_row of every sample row with a process pool, the image and land cover are shared (not copied).
+    Yields the records row by row in order, same as the serial loop.
+    :param row_list: sample rows to score (increasing), all rows if None
+    :param stride: image pixels between two samples (sample_size if None)
+    :param kernel: 'numpy' or 'numba', see score_row
+    :param target_values: land cover values of several target classes, see score_row
+    """
+    stride = sample_size if stride is None else stride
+    if row_list is None:
+        row_list = range((image.shape[1] - sample_size) // stride + 1)
+    kwargs = {'sample_size': sample_size,
+              'zero_percent': zero_percent,
+              'rgb_bands': rgb_bands,
+              'lc_geo': lc_geo,
+              'image_geo': image_geo,
+              'target_all': target_all,
+              'edge_all': edge_all,
+              'keep_all': keep_all,
+              'stride': stride,
+              'kernel': kernel,
+              'target_values': target_values}
+
+    image_shm, image_desc = shared_array(image)
+    lc_shm, lc_desc = shared_array(lc)
+    try:
+        with mp.Pool(workers, initializer=_init_worker, initargs=(image_desc, lc_desc, kwargs)) as pool:
+            for records in pool.imap(_score_row_task, row_list):
+                yield records
+    finally:
+        image_shm.close()
+        image_shm.unlink()
+        lc_shm.close()
+        lc_shm.unlink()
@@ -0,0 +1,95 @@
+import os
+from func import instrument
+from func.data_preparation import image_process, land_cover_process, stretch_quantile
+from .sample_crop import sample_crop
+from .metric_cache import scene_cache, cached_stage
+
+
+def scene_image_path(work_folder, scene_name):
+    """
+    Processed image written by scene_score in work_folder (process_image without cache_folder).
+    """
+    return os.path.join(work_folder, scene_name + '.tif')
+
+
+def scene_score(image_path,
+                lc_path,
+                lc_target_value,
+                work_folder,
+                scene_name,
+                process_image=True,
+                block_process=False,
+                memory_mb=256,
+                quantile=None,
+                rgb_bands=None,
+                sample_size=256,
+                zero_percent=0.2,
+                target_grid=False,
+                edge_mode='tile',
+                windowed=False,
+                prescreen=False,
+                build_overviews=False,
+                stride=None,
+                cache_folder=None,
+                stream=None,
+                pipeline=False,
+                read_depth=2,
+                kernel='numpy'):
+    """
+    Stretch the image, align the land cover in memory and score the candidate samples of one scene,
+    without writing any sample (sample_crop(save_tiles=False)).
+    The samples are named {scene_name}_h???w???.
+    cache_folder: processed image and sample levels cached there (see scene_cache), reused by reruns
+    stream: StreamSelect fed with the samples of the scene instead of a DataFrame, see sample_crop
+    build_overviews: with prescreen, the 1/8 overview of the processed image is built when missing
+                     (not with process_image=False: the input image is not written)
+    pipeline, read_depth: sample rows read ahead in a background thread while scoring, see sample_crop
+    kernel: 'numpy' or 'numba' (fused compiled metrics of each sample), see sample_crop
+    :return: sample DataFrame with scene and image_path columns (image_path: the processed image, kept for cropping),
+             or the stream
+    """
+    quantile = stretch_quantile(quantile, block_process)
+    metric_cache = None
+    if cache_folder is not None:
+        cache = scene_cache(cache_folder, image_path, lc_path, lc_target_value, process_image, quantile, True,
+                            rgb_bands, sample_size, zero_percent, edge_mode, prescreen, stride=stride)
+        metric_cache = cache['metrics']
+
+    with instrument.stage('image_process', scene=scene_name, path=image_path):
+        if process_image and metric_cache is not None:
+            image_process_path = cached_stage(cache['image_process_path'], lambda path: image_process(
+                image_path, path, block=block_process, memory_mb=memory_mb, quantile=quantile))
+        elif process_image:
+            image_process_path = scene_image_path(work_folder, scene_name)
+            image_process(image_path, image_process_path, block=block_process, memory_mb=memory_mb,
+                          quantile=quantile)
+        else:
+            image_process_path = image_path
+            build_overviews = False  # no .ovr written next to the input image
+    with instrument.stage('land_cover_process', scene=scene_name, path=lc_path):
+        lc_ds = land_cover_process(image_process_path, lc_path, None, lc_target_value, in_memory=True,
+                                   memory_mb=memory_mb)
+
+    with instrument.stage('sample_crop', scene=scene_name):
+        tiles = sample_crop(image_process_path, lc_ds, None, scene_name, rgb_bands, sample_size, zero_percent,
+                            delete_temp_tif=False, save_tiles=False, target_grid=target_grid, edge_mode=edge_mode,
+                            windowed=windowed, prescreen=prescreen, build_overviews=build_overviews,
+                            metric_cache=metric_cache, stride=stride,
+                            stream=stream, pipeline=pipeline, read_depth=read_depth, kernel=kernel)
+    if stream is not None:
+        return tiles
+    tiles.insert(0, 'scene', scene_name)
+    tiles.insert(1, 'image_path', image_process_path)
+    return tiles
+
+
+def scene_score_stages(log_mode, trace_memory, image_path, lc_path, lc_target_value, work_folder, scene_name,
+                       *args):
+    """
+    scene_score in a worker process, with the instrumentation of the run (see instrument.configure).
+    :return: sample DataFrame (or stream), stage records of the scene (image_process, land_cover_process, sample_crop)
+             to add to the run report of the main process
+    """
+    instrument.configure(log_mode, trace_memory=trace_memory)
+    tiles = scene_score(image_path, lc_path, lc_target_value, work_folder, scene_name, *args)
+    return tiles, instrument.stages()
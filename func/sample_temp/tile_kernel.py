@@ -0,0 +1,314 @@
+"""
+Metrics of one candidate sample in one fused pass: number of no data pixels (0 in all bands), target fraction of
+its land cover window and number of Canny edge pixels, compiled with Numba (optional dependency) when installed,
+otherwise computed with the NumPy / scikit-image functions of sample_crop.
+The compiled Canny follows feature.canny step by step (Gaussian smoothing with constant border and bleed-over
+correction, Sobel gradients, bilinear non-maximum suppression, 8-connected hysteresis), so the values are those
+of level_edge up to floating point rounding (check_kernel compares both).
+"""
+from functools import lru_cache
+import numpy as np
+from scipy import ndimage as ndi
+
+try:
+    import numba
+    NUMBA_ERROR = None
+except ImportError as error:  # the NumPy kernel is used
+    numba = None
+    NUMBA_ERROR = str(error)
+
+KERNELS = ('numpy', 'numba')
+RGB_WEIGHTS = (0.2125, 0.7154, 0.0721)  # color.rgb2gray
+LOW_THRESHOLD = float(np.float32(0.1))  # feature.canny defaults (the low threshold is a C float there)
+HIGH_THRESHOLD = 0.2
+
+
+def kernel_available(kernel):
+    return kernel == 'numpy' or (kernel == 'numba' and numba is not None)
+
+
+def resolve_kernel(kernel):
+    """
+    kernel to use: 'numba' falls back to 'numpy' with a message when Numba cannot be imported
+    (optional dependency, see requirements.txt).
+    """
+    assert kernel in KERNELS, 'kernel should be one of {}'.format(KERNELS)
+    if not kernel_available(kernel):
+        from func import instrument
+        instrument.log("kernel 'numba': numba cannot be imported ({}), the numpy kernel is used "
+                       "(pip install numba)".format(NUMBA_ERROR))
+        return 'numpy'
+    return kernel
+
+
+def gaussian_weights(sigma, truncate=4.0):
+    """
+    1-D Gaussian of ndi.gaussian_filter (radius int(truncate * sigma + 0.5)).
+    """
+    radius = int(truncate * float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1)
+    phi = np.exp(-0.5 / (sigma * sigma) * x ** 2)
+    return phi / phi.sum()
+
+
+@lru_cache(maxsize=8)
+def bleed_over(height, width, sigma):
+    """
+    Smoothed mask of ones + eps, by which feature.canny divides the smoothed image (constant border).
+    """
+    return ndi.gaussian_filter(np.ones((height, width)), sigma, mode='constant', cval=0.) + np.finfo(np.float64).eps
+
+
+def gray_scale(rgb):
+    """
+    Scale of the rgb bands to [0, 1] in color.rgb2gray (img_as_float: 1 / dtype maximum),
+    None when the compiled kernel does not follow it (signed integer or float bands).
+    """
+    if rgb.dtype.kind != 'u':
+        return None
+    return 1.0 / np.iinfo(rgb.dtype).max
+
+
+def tile_metrics_numpy(sample, lc_area, rgb_bands, zero_limit, edge=True, sigma=2.0):
+    """
+    Reference kernel: the functions of sample_crop (np.all, sum / 255, level_edge).
+    :return: zero pixels, target fraction (NaN if lc_area is None), edge pixels (-1 if not edge);
+             target and edge are not computed (NaN, -1) when zero pixels >= zero_limit
+    """
+    from .sample_crop import level_edge
+    zero = int(np.sum(np.all(sample == 0, axis=0)))
+    target, edge_count = np.nan, -1
+    if zero >= zero_limit:
+        return zero, target, edge_count
+    if lc_area is not None:
+        target = np.sum(lc_area / 255) / (lc_area.shape[0] * lc_area.shape[1])
+    if edge:
+        gray = sample[rgb_bands]
+        edge_count = int(round(level_edge(gray, sigma, f=1) * gray.shape[1] * gray.shape[2]))
+    return zero, target, edge_count
+
+
+def tile_metrics(sample, lc_area, rgb_bands, zero_limit, edge=True, sigma=2.0, kernel='numba'):
+    """
+    Zero pixels, target fraction and edge pixels of one sample, see tile_metrics_numpy.
+    :param sample: (c, size, size) view of the image strip
+    :param lc_area: land cover window of the sample (target = 255), or None when the target is known
+    :param zero_limit: samples with at least zero_limit no data pixels are not scored further
+    :param edge: count the Canny edge pixels of sample[rgb_bands]
+    :param kernel: 'numba' (compiled, fused) or 'numpy' (also used when Numba is missing, see resolve_kernel)
+    """
+    if kernel == 'numpy' or numba is None:
+        return tile_metrics_numpy(sample, lc_area, rgb_bands, zero_limit, edge, sigma)
+    scale = gray_scale(sample) if edge else 1.0
+    if scale is None:  # edge of level_edge, the rest compiled
+        zero, target, _ = tile_metrics(sample, lc_area, rgb_bands, zero_limit, False, sigma, kernel)
+        if zero < zero_limit:
+            return zero, target, tile_metrics_numpy(sample, None, rgb_bands, 0, True, sigma)[2]
+        return zero, target, -1
+    H, W = sample.shape[1:]
+    zero, target_sum, edge_count = _tile_metrics_jit(
+        sample, np.asarray(rgb_bands, dtype=np.int64),
+        np.zeros((0, 0), dtype=np.uint8) if lc_area is None else np.ascontiguousarray(lc_area), lc_area is not None,
+        int(min(np.ceil(zero_limit), H * W + 1)), edge, scale, gaussian_weights(sigma),
+        bleed_over(H, W, sigma), np.asarray(RGB_WEIGHTS), LOW_THRESHOLD, HIGH_THRESHOLD)
+    target = np.nan if lc_area is None or zero >= zero_limit else \
+        target_sum / 255 / (lc_area.shape[0] * lc_area.shape[1])
+    return zero, target, edge_count
+
+
+def check_kernel(samples, lc_areas, rgb_bands, sigma=2.0):
+    """
+    Compare the compiled kernel with the NumPy functions on the samples.
+    :return: dict: samples, same_zero, same_target, same_edge (fraction of samples with identical values),
+             max_edge_diff (edge pixels), max_target_diff
+    """
+    assert numba is not None, 'numba is not installed'
+    result = {'samples': len(samples), 'same_zero': 0, 'same_target': 0, 'same_edge': 0, 'max_edge_diff': 0,
+              'max_target_diff': 0.}
+    for sample, lc_area in zip(samples, lc_areas):
+        zero_n, target_n, edge_n = tile_metrics_numpy(sample, lc_area, rgb_bands, np.inf, True, sigma)
+        zero_j, target_j, edge_j = tile_metrics(sample, lc_area, rgb_bands, np.inf, True, sigma, 'numba')
+        result['same_zero'] += zero_n == zero_j
+        result['same_target'] += target_n == target_j or (np.isnan(target_n) and np.isnan(target_j))
+        result['same_edge'] += edge_n == edge_j
+        result['max_edge_diff'] = max(result['max_edge_diff'], abs(edge_n - edge_j))
+        if lc_area is not None:
+            result['max_target_diff'] = max(result['max_target_diff'], abs(target_n - target_j))
+    for key in ('same_zero', 'same_target', 'same_edge'):
+        result[key] = result[key] / max(len(samples), 1)
+    return result
+
+
+def _jit(func):
+    return func if numba is None else numba.njit(cache=True, nogil=True)(func)
+
+
+@_jit
+def _line_index(i, n, reflect):
+    # index of position i of a line of n values extended by its border (-1: constant 0, or reflect x[-1] = x[0])
+    if 0 <= i < n:
+        return i
+    if not reflect:
+        return -1
+    return -i - 1 if i < 0 else 2 * n - i - 1
+
+
+@_jit
+def _correlate_rows(src, dst, weights, reflect):
+    # ndi.correlate1d along axis 0: symmetric kernels as (x[-k] + x[k]) * w, antisymmetric as (x[-k] - x[k]) * w,
+    # center first then from the farthest pair (same rounding); the columns are updated together
+    H, W = src.shape
+    r = weights.size // 2
+    symmetric = weights[0] == weights[-1]
+    for x in range(H):
+        for y in range(W):
+            dst[x, y] = src[x, y] * weights[r]
+        for k in range(r, 0, -1):
+            a, b = _line_index(x - k, H, reflect), _line_index(x + k, H, reflect)
+            w = weights[r - k]
+            for y in range(W):
+                va = src[a, y] if a >= 0 else 0.
+                vb = src[b, y] if b >= 0 else 0.
+                dst[x, y] += ((va + vb) if symmetric else (va - vb)) * w
+
+
+@_jit
+def _correlate_cols(src, dst, weights, reflect):
+    # ndi.correlate1d along axis 1, each row extended by its border in a line buffer
+    H, W = src.shape
+    r = weights.size // 2
+    symmetric = weights[0] == weights[-1]
+    line = np.empty(W + 2 * r)
+    for x in range(H):
+        for i in range(W + 2 * r):
+            index = _line_index(i - r, W, reflect)
+            line[i] = src[x, index] if index >= 0 else 0.
+        for y in range(W):
+            value = line[y + r] * weights[r]
+            for k in range(r, 0, -1):
+                value += ((line[y + r - k] + line[y + r + k]) if symmetric
+                          else (line[y + r - k] - line[y + r + k])) * weights[r - k]
+            dst[x, y] = value
+
+
+@_jit
+def _tile_metrics_jit(sample, rgb_bands, lc_area, has_lc, zero_limit, edge, scale, gauss, bleed,
+                      rgb_weights, low, high):
+    C, H, W = sample.shape
+    zero = 0
+    for x in range(H):
+        for y in range(W):
+            empty = True
+            for c in range(C):
+                if sample[c, x, y] != 0:
+                    empty = False
+                    break
+            if empty:
+                zero += 1
+    if zero >= zero_limit:
+        return zero, 0., -1
+
+    target_sum = 0.
+    if has_lc:
+        for x in range(lc_area.shape[0]):
+            for y in range(lc_area.shape[1]):
+                target_sum += lc_area[x, y]
+    if not edge:
+        return zero, target_sum, -1
+
+    # gray image as level_edge (color.rgb2gray)
+    gray = np.empty((H, W))
+    for x in range(H):
+        for y in range(W):
+            gray[x, y] = sample[rgb_bands[0], x, y] * scale * rgb_weights[0] \
+                + sample[rgb_bands[1], x, y] * scale * rgb_weights[1] \
+                + sample[rgb_bands[2], x, y] * scale * rgb_weights[2]
+
+    # Gaussian smoothing (constant border), corrected by the bleed-over of the border
+    temp = np.empty((H, W))
+    smoothed = np.empty((H, W))
+    _correlate_rows(gray, temp, gauss, False)
+    _correlate_cols(temp, smoothed, gauss, False)
+    for x in range(H):
+        for y in range(W):
+            smoothed[x, y] /= bleed[x, y]
+
+    # Sobel gradients (reflect border) and magnitude
+    derivative = np.array([-1., 0., 1.])
+    smooth = np.array([1., 2., 1.])
+    isobel = np.empty((H, W))
+    jsobel = np.empty((H, W))
+    _correlate_rows(smoothed, temp, derivative, True)
+    _correlate_cols(temp, isobel, smooth, True)
+    _correlate_cols(smoothed, temp, derivative, True)
+    _correlate_rows(temp, jsobel, smooth, True)
+    magnitude = np.empty((H, W))
+    for x in range(H):
+        for y in range(W):
+            magnitude[x, y] = np.sqrt(isobel[x, y] * isobel[x, y] + jsobel[x, y] * jsobel[x, y])
+
+    # bilinear non-maximum suppression, the border pixels are never edges
+    kept = np.zeros((H, W))
+    for x in range(1, H - 1):
+        for y in range(1, W - 1):
+            m = magnitude[x, y]
+            if not m >= low:
+                continue
+            is_down = isobel[x, y] <= 0
+            is_up = isobel[x, y] >= 0
+            is_left = jsobel[x, y] <= 0
+            is_right = jsobel[x, y] >= 0
+            cond1 = (is_up and is_right) or (is_down and is_left)
+            cond2 = (is_down and is_right) or (is_up and is_left)
+            if not cond1 and not cond2:
+                continue
+            abs_i = abs(isobel[x, y])
+            abs_j = abs(jsobel[x, y])
+            if cond1:
+                if abs_i > abs_j:
+                    w = abs_j / abs_i
+                    n1_1, n1_2 = magnitude[x + 1, y], magnitude[x + 1, y + 1]
+                    n2_1, n2_2 = magnitude[x - 1, y], magnitude[x - 1, y - 1]
+                else:
+                    w = abs_i / abs_j
+                    n1_1, n1_2 = magnitude[x, y + 1], magnitude[x + 1, y + 1]
+                    n2_1, n2_2 = magnitude[x, y - 1], magnitude[x - 1, y - 1]
+                if n1_2 * w + n1_1 * (1.0 - w) <= m and n2_2 * w + n2_1 * (1.0 - w) <= m:
+                    kept[x, y] = m
+            if cond2:
+                if abs_i < abs_j:
+                    w = abs_i / abs_j
+                    n1_1, n1_2 = magnitude[x, y + 1], magnitude[x - 1, y + 1]
+                    n2_1, n2_2 = magnitude[x, y - 1], magnitude[x + 1, y - 1]
+                else:
+                    w = abs_j / abs_i
+                    n1_1, n1_2 = magnitude[x - 1, y], magnitude[x - 1, y + 1]
+                    n2_1, n2_2 = magnitude[x + 1, y], magnitude[x + 1, y - 1]
+                if n1_2 * w + n1_1 * (1.0 - w) <= m and n2_2 * w + n2_1 * (1.0 - w) <= m:
+                    kept[x, y] = m
+
+    # hysteresis: kept pixels 8-connected to a pixel above the high threshold
+    edge_count = 0
+    visited = np.zeros((H, W), dtype=np.bool_)
+    stack = np.empty(H * W, dtype=np.int64)
+    for x in range(H):
+        for y in range(W):
+            if visited[x, y] or kept[x, y] < high:
+                continue
+            visited[x, y] = True
+            top = 0
+            stack[top] = x * W + y
+            top += 1
+            while top > 0:
+                top -= 1
+                p = stack[top]
+                edge_count += 1
+                px, py = p // W, p % W
+                for dx in range(-1, 2):
+                    for dy in range(-1, 2):
+                        qx, qy = px + dx, py + dy
+                        if 0 <= qx < H and 0 <= qy < W and not visited[qx, qy] and kept[qx, qy] > 0:
+                            visited[qx, qy] = True
+                            stack[top] = qx * W + qy
+                            top += 1
+    return zero, target_sum, edge_count
@@ -0,0 +1,69 @@
+import os
+import json
+import struct
+import numpy as np
+
+STORE_NAME = 'candidates.npy'
+STORE_META = 'candidates.json'
+HEADER_BYTES = 128  # .npy header, written on close when the number of samples is known
+
+
+def npy_header(dtype, shape, size=HEADER_BYTES):
+    """
+    .npy (format 1.0) header of an array of dtype and shape, padded to size bytes.
+    """
+    header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False,
+                   'shape': tuple(shape)})
+    header = header.ljust(size - 11) + '\n'
+    assert len(header) == size - 10, 'npy header longer than {} bytes'.format(size)
+    return np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class TileStore:
+    """
+    All candidate samples appended to one .npy file (n, bands, size, size) instead of one GeoTIFF each,
+    the same format as the shards of shard_export (np.load(mmap_mode='r') or open_memmap read it).
+    The samples are appended after a reserved header, written on close with the final count.
+    The geotransform of sample k is in the manifest (store_index == k).
+    Usage:
+        store = TileStore(temp_folder, image_path, image_proj)
+        k = store.append(sample)
+        ...
+        store.close()
+        tiles, meta = load_store(temp_folder)  # memory-mapped
+    """
+    def __init__(self, folder, image_path, proj):
+        self.folder = folder
+        self.file = open(os.path.join(folder, STORE_NAME), 'wb')
+        self.file.write(b'\0' * HEADER_BYTES)
+        self.meta = {'image_path': os.path.abspath(image_path), 'proj': proj, 'count': 0}
+
+    def append(self, sample):
+        if self.meta['count'] == 0:
+            self.meta['shape'] = list(sample.shape)
+            self.meta['dtype'] = sample.dtype.str
+        self.file.write(np.ascontiguousarray(sample).tobytes())
+        self.meta['count'] += 1
+        return self.meta['count'] - 1
+
+    def close(self):
+        self.file.seek(0)
+        if self.meta['count']:
+            self.file.write(npy_header(self.meta['dtype'], [self.meta['count']] + self.meta['shape']))
+        else:
+            self.file.write(npy_header(np.uint8, (0,)))
+        self.file.close()
+        with open(os.path.join(self.folder, STORE_META), 'w') as f:
+            json.dump(self.meta, f)
+
+
+def load_store(folder):
+    """
+    :return: memory-mapped samples (n, bands, size, size), meta (image_path, proj, ...)
+    """
+    with open(os.path.join(folder, STORE_META)) as f:
+        meta = json.load(f)
+    if meta['count'] == 0:
+        return np.zeros((0,), dtype=np.uint8), meta
+    tiles = np.lib.format.open_memmap(os.path.join(folder, STORE_NAME), mode='r')
+    return tiles, meta
@@ -1,7 +1,10 @@
+import os
 import click
-from func.data_preparation import image_process, land_cover_process
-from func.sample_temp import sample_crop, level_table
-from func.sample_selection import sample_select
+from func import instrument
+from func.data_preparation import image_process, land_cover_process, creation_options, stretch_quantile, raster_remove
+from func.sample_temp import sample_crop, level_table, level_count, scene_cache, cached_stage, target_class
+from func.sample_temp.tile_kernel import resolve_kernel
+from func.sample_selection import sample_select, sample_select_tiles, StreamSelect, stream_select, shard_export
 
 
 @click.command()
@@ -14,17 +17,27 @@ from func.sample_selection import sample_select
               required=True,
               help='Land cover data corresponding to teh remote sensing image.')
 @click.option('--lc_target_value',
-              type=int,
+              type=str,
               required=True,
-              help='Value of the target class in the land cover data.')
+              help='Value of the target class in the land cover data, or comma separated values of several target '
+                   'classes scored in one pass (one selection per class in sample_folder/class_<value>).')
 @click.option('--sample_folder', type=click.Path(exists=False), default=r'.\samples',
               help='Folder where the selected samples saved.')
 @click.option('--process_image', type=click.BOOL, default=True,
               help='Whether the image is processed.')
 @click.option('--image_process_path', type=click.Path(exists=False), default=r'.\image.tif',
               help='Path where the image saved after processing.')
+@click.option('--block_process', type=click.BOOL, default=False,
+              help='Whether the image is stretched block by block (bounded memory, no temporary halves).')
+@click.option('--memory_mb', type=int, default=256,
+              help='Memory budget (MB) of one block when block_process=True.')
+@click.option('--quantile', type=click.Choice(['exact', 'histogram']), default=None,
+              help='Estimation of the 2%/98% stretch limits: exact np.quantile (one full band in memory) or one-pass '
+                   'histogram. Default: histogram with block_process, exact otherwise.')
 @click.option('--lc_process_path', type=click.Path(exists=False), default=r'.\land_cover.tif',
               help='Path where the land cover data saved after processing.')
+@click.option('--lc_in_memory', type=click.BOOL, default=False,
+              help='Whether the land cover is aligned to the image grid in memory (no land cover file written).')
 @click.option('--temp_folder', type=click.Path(exists=False), default=r'.\temp',
               help='Temporary folder for all samples.')
 @click.option('--sample_prefix', type=str, default='sample',
@@ -35,8 +48,82 @@ from func.sample_selection import sample_select
               help='Size of the sample (bands, size, size)')
 @click.option('--zero_percent', type=float, default=0.2,
               help='Save samples that are all 0 (no data in image) with the probability, values (0-1).')
+@click.option('--target_grid', type=click.BOOL, default=False,
+              help='Whether the target level of all samples is computed at once (same values, faster).')
+@click.option('--edge_mode', type=click.Choice(['tile', 'scene', 'gradient']), default='tile',
+              help='Edge intensity from canny of each sample (tile), canny of image strips (scene), '
+                   'or thresholded gradient magnitude of image strips (gradient).')
+@click.option('--windowed', type=click.BOOL, default=False,
+              help='Whether image and land cover are read one sample row at a time (bounded memory).')
+@click.option('--stride', type=int, default=None,
+              help='Pixels between two candidate samples, overlapping samples when smaller than sample_size '
+                   '(default: sample_size).')
+@click.option('--no_overlap', type=click.BOOL, default=False,
+              help='Whether the selected samples are kept from overlapping each other (with stride < sample_size).')
+@click.option('--prescreen', type=click.BOOL, default=False,
+              help='Whether samples that are clearly no data are dropped from a decimated read before cropping '
+                   '(with windowed).')
+@click.option('--build_overviews', type=click.BOOL, default=False,
+              help='Whether the 1/8 overview of the processed image is built for prescreen when it has none.')
+@click.option('--target_bins', type=int, default=3,
+              help='Number of target (entropy) levels of the stratification.')
+@click.option('--edge_bins', type=int, default=3,
+              help='Number of edge intensity levels of the stratification.')
+@click.option('--clip_q1', type=float, default=0.05,
+              help='Lower quantile of the metric range split into equal levels, values (0-1).')
+@click.option('--clip_q2', type=float, default=0.95,
+              help='Upper quantile of the metric range split into equal levels, values (0-1).')
+@click.option('--workers', type=int, default=1,
+              help='Number of processes scoring the samples.')
+@click.option('--pipeline', type=click.BOOL, default=False,
+              help='Whether the next sample rows are read and the candidate samples written in background threads '
+                   'while the current row is scored (stalls of each stage printed).')
+@click.option('--read_depth', type=int, default=2,
+              help='Sample row strips read ahead with pipeline.')
+@click.option('--write_depth', type=int, default=16,
+              help='Candidate samples queued for writing with pipeline.')
+@click.option('--kernel', type=click.Choice(['numpy', 'numba']), default='numpy',
+              help='Metrics of each sample computed by NumPy / scikit-image, or by one fused Numba kernel '
+                   '(same values, numpy when Numba is not installed).')
+@click.option('--tile_store', type=click.Choice(['tif', 'npy']), default='tif',
+              help='Candidate samples saved as one GeoTIFF each (tif) or in one memory-mapped .npy file (npy).')
+@click.option('--write_workers', type=int, default=0,
+              help='Number of threads writing sample GeoTIFFs while scoring goes on (0: synchronous).')
+@click.option('--compress', type=click.Choice(['NONE', 'DEFLATE', 'LZW', 'ZSTD']), default='NONE',
+              help='Compression of the sample GeoTIFFs (tiled, with predictor when compressed).')
 @click.option('--sample_percent', type=float, default=0.025,
               help='Percentage of samples selected, values (0-1).')
+@click.option('--sample_format', type=click.Choice(['tif', 'vrt']), default='tif',
+              help='Selected samples saved as GeoTIFF, or as VRT windows of the processed image (npy store or '
+                   'score_first only, the processed image is kept).')
+@click.option('--score_first', type=click.BOOL, default=False,
+              help='Whether samples are scored in memory and only the selected samples are cropped (no temp folder).')
+@click.option('--streaming', type=click.BOOL, default=False,
+              help='Whether samples are scored and selected in one pass, keeping only metric sketches and bounded '
+                   'reservoirs of samples (memory independent of the scene size, implies score_first).')
+@click.option('--reservoir_size', type=int, default=1000,
+              help='Samples kept in each cell of the metric grid with streaming (at least the samples selected '
+                   'in a class for a uniform draw).')
+@click.option('--export_folder', type=click.Path(exists=False), default=None,
+              help='Folder where the selected image tiles and their land cover label tiles (same windows) are '
+                   'exported in fixed-size memory-mappable shards with an index (None: no export).')
+@click.option('--shard_size', type=int, default=1024,
+              help='Samples per shard of the export.')
+@click.option('--label_value', type=int, default=None,
+              help='Labels of the export: land cover classes (None) or 1 / 0 for this land cover value '
+                   '(with several target values, any value gives 1 / 0 labels of the class of each export).')
+@click.option('--cache_folder', type=click.Path(exists=False), default=None,
+              help='Folder caching the processed image and land cover and the sample levels, keyed by the input '
+                   'files and parameters: reruns skip the finished stages and resume the sample rows.')
+@click.option('--cache_hash', type=click.BOOL, default=False,
+              help='Whether the inputs are identified by a hash of their content instead of path, size and mtime.')
+@click.option('--log_mode', type=click.Choice(instrument.MODES), default='progress',
+              help='Progress lines (progress), one summary line per stage (quiet) or one JSON record per stage '
+                   'on stdout (json). The stage records are saved in <sample_folder>_report.json.')
+@click.option('--profile', type=click.BOOL, default=False,
+              help='Whether the run is profiled with cProfile (<sample_folder>_report.prof).')
+@click.option('--trace_memory', type=click.BOOL, default=False,
+              help='Whether Python allocations are traced with tracemalloc (peak per stage, top allocations).')
 @click.option('--delete_temp_tif', type=click.BOOL, default=True,
               help='Whether to delete the image and land cover data generated after processing')
 @click.option('--delete_temp_folder', type=click.BOOL, default=True,
@@ -47,31 +134,176 @@ def sampling(image_path,
              sample_folder,
              process_image,
              image_process_path,
+             block_process,
+             memory_mb,
+             quantile,
              lc_process_path,
+             lc_in_memory,
              temp_folder,
              sample_prefix,
              rgb_bands,
              sample_size,
              zero_percent,
+             target_grid,
+             edge_mode,
+             windowed,
+             stride,
+             no_overlap,
+             prescreen,
+             build_overviews,
+             target_bins,
+             edge_bins,
+             clip_q1,
+             clip_q2,
+             workers,
+             pipeline,
+             read_depth,
+             write_depth,
+             kernel,
+             tile_store,
+             write_workers,
+             compress,
              sample_percent,
+             sample_format,
+             score_first,
+             streaming,
+             reservoir_size,
+             export_folder,
+             shard_size,
+             label_value,
+             cache_folder,
+             cache_hash,
+             log_mode,
+             profile,
+             trace_memory,
              delete_temp_tif,
              delete_temp_folder):
-    print('-' * 10, '1. data preparation', '-' * 10)
-    if process_image:
-        image_process(image_path, image_process_path)
+    params = dict(locals())
+    instrument.configure(log_mode, profile, trace_memory)
+    quantile = stretch_quantile(quantile, block_process)
+    assert not (windowed and workers > 1), 'windowed reading runs in one process'
+    assert not prescreen or windowed, 'prescreen needs windowed reading'
+    kernel = resolve_kernel(kernel)
+    target_values = [int(value) for value in lc_target_value.split(',')]
+    lc_target_value = target_values[0] if len(target_values) == 1 else target_values
+    target_values = None if len(target_values) == 1 else target_values
+    assert target_values is None or not (streaming or cache_folder), \
+        'several target values are scored without streaming and cache_folder'
+    score_first = score_first or streaming or target_values is not None
+    assert sample_format == 'tif' or score_first or tile_store == 'npy', 'vrt samples need score_first or npy store'
+    if sample_format == 'vrt':
+        delete_temp_tif = False  # the vrt samples point into the processed image
+
+    write_options = None if compress == 'NONE' else creation_options(compress, block_size=sample_size)
+
+    metric_cache = None
+    if cache_folder is not None:
+        cache = scene_cache(cache_folder, image_path, lc_path, lc_target_value, process_image, quantile,
+                            lc_in_memory, rgb_bands, sample_size, zero_percent, edge_mode, prescreen, cache_hash,
+                            stride)
+        image_process_path = cache['image_process_path']
+        lc_process_path = cache['lc_process_path']
+        metric_cache = cache['metrics']
+        delete_temp_tif = False  # the processed image and land cover are kept in the cache
+
+    instrument.log('-' * 10, '1. data preparation', '-' * 10)
+    with instrument.stage('image_process', path=image_path):
+        if process_image and metric_cache is not None:
+            cached_stage(image_process_path, lambda path: image_process(image_path, path, block=block_process,
+                                                                        memory_mb=memory_mb, quantile=quantile))
+        elif process_image:
+            image_process(image_path, image_process_path, block=block_process, memory_mb=memory_mb,
+                          quantile=quantile)
+        else:
+            image_process_path = image_path
+            delete_temp_tif = False
+            build_overviews = False  # no .ovr written next to the input image
+    with instrument.stage('land_cover_process', path=lc_path):
+        if metric_cache is not None and not lc_in_memory:
+            lc_process = cached_stage(lc_process_path, lambda path: land_cover_process(
+                image_process_path, lc_path, path, lc_target_value, memory_mb=memory_mb))
+        else:
+            lc_process = land_cover_process(image_process_path, lc_path, lc_process_path, lc_target_value,
+                                            in_memory=lc_in_memory, memory_mb=memory_mb)
+
+    instrument.log('-' * 10, '2. sample crop', '-' * 10)
+    if score_first:
+        stream = StreamSelect(target_bins, edge_bins, clip_q1, clip_q2, reservoir_size) if streaming else None
+        with instrument.stage('sample_crop', workers=workers):
+            tiles = sample_crop(image_process_path, lc_process, temp_folder,
+                                sample_prefix, rgb_bands, sample_size, zero_percent, False,
+                                save_tiles=False, target_grid=target_grid, workers=workers,
+                                edge_mode=edge_mode, windowed=windowed,
+                                prescreen=prescreen, build_overviews=build_overviews, metric_cache=metric_cache,
+                                t_bins=target_bins, e_bins=edge_bins, q1=clip_q1, q2=clip_q2, stride=stride,
+                                stream=stream, pipeline=pipeline, read_depth=read_depth, kernel=kernel,
+                                target_values=target_values)
+
+        if target_values is not None:  # one selection per target class from the same candidates
+            for value in target_values:
+                instrument.log('-' * 10, '3. sample select: class {}'.format(value), '-' * 10)
+                class_tiles = target_class(tiles, value, edge_bins)
+                sample_count = level_count(class_tiles, t_bins=target_bins, e_bins=edge_bins)
+                with instrument.stage('sample_select', target_value=value):
+                    sample_select_tiles(sample_count, class_tiles, image_process_path,
+                                        class_folder(sample_folder, value), sample_percent, sample_size,
+                                        sample_format, write_workers, write_options, stride, no_overlap)
+                _ = level_table(class_folder(sample_folder, value), t_bins=target_bins, e_bins=edge_bins)
+        elif streaming:
+            instrument.log('-' * 10, '3. sample select', '-' * 10)
+            with instrument.stage('sample_select'):
+                stream_select(stream, sample_folder, sample_percent, sample_size, sample_format, write_workers,
+                              write_options, no_overlap)
+        else:
+            sample_count = level_count(tiles, t_bins=target_bins, e_bins=edge_bins)
+
+            instrument.log('-' * 10, '3. sample select', '-' * 10)
+            with instrument.stage('sample_select'):
+                sample_select_tiles(sample_count, tiles, image_process_path, sample_folder, sample_percent,
+                                    sample_size, sample_format, write_workers, write_options, stride, no_overlap)
+        if target_values is None:
+            _ = level_table(sample_folder, t_bins=target_bins, e_bins=edge_bins)
+        if delete_temp_tif and export_folder is None:
+            raster_remove(image_process_path)
+            if isinstance(lc_process, str):
+                os.remove(lc_process)
     else:
-        image_process_path = image_path
-        delete_temp_tif = False
-    land_cover_process(image_process_path, lc_path, lc_process_path, lc_target_value)
+        with instrument.stage('sample_crop', workers=workers):
+            sample_crop(image_process_path, lc_process, temp_folder,
+                        sample_prefix, rgb_bands, sample_size, zero_percent,
+                        delete_temp_tif and export_folder is None, target_grid=target_grid, workers=workers,
+                        edge_mode=edge_mode, windowed=windowed, prescreen=prescreen,
+                        build_overviews=build_overviews, tile_store=tile_store, write_workers=write_workers,
+                        write_options=write_options, metric_cache=metric_cache, t_bins=target_bins,
+                        e_bins=edge_bins, q1=clip_q1, q2=clip_q2, stride=stride, pipeline=pipeline,
+                        read_depth=read_depth, write_depth=write_depth, kernel=kernel)
+        sample_count = level_table(temp_folder, t_bins=target_bins, e_bins=edge_bins)
+
+        instrument.log('-' * 10, '3. sample select', '-' * 10)
+        with instrument.stage('sample_select'):
+            sample_select(sample_count, temp_folder, sample_folder, sample_percent, delete_temp_folder,
+                          sample_format, write_workers, write_options, stride, no_overlap)
+        _ = level_table(sample_folder, t_bins=target_bins, e_bins=edge_bins)
+
+    if export_folder is not None:
+        instrument.log('-' * 10, '4. training export', '-' * 10)
+        for value in [None] if target_values is None else target_values:
+            with instrument.stage('shard_export', target_value=value):
+                shard_export(class_folder(sample_folder, value), class_folder(export_folder, value), lc_path,
+                             image_process_path, sample_size, stride, shard_size,
+                             label_value if value is None or label_value is None else value)
+        if delete_temp_tif:
+            raster_remove(image_process_path)
+            if isinstance(lc_process, str):
+                os.remove(lc_process)
+    instrument.write_report(instrument.report_path(sample_folder), **params)
 
-    print('-' * 10, '2. sample crop', '-' * 10)
-    sample_crop(image_process_path, lc_process_path, temp_folder,
-                sample_prefix, rgb_bands, sample_size, zero_percent, delete_temp_tif)
-    sample_count = level_table(temp_folder)
 
-    print('-' * 10, '3. sample select', '-' * 10)
-    sample_select(sample_count, temp_folder, sample_folder, sample_percent, delete_temp_folder)
-    _ = level_table(sample_folder)
+def class_folder(folder, value=None):
+    """
+    Folder of the samples of one target class (folder/class_<value>), folder itself for a single target class.
+    """
+    return folder if value is None else os.path.join(folder, 'class_{}'.format(value))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,36 @@
+import click
+from func import instrument
+from func.sample_service import SceneStore, serve
+
+
+@click.command()
+@click.option('--host', type=str, default='127.0.0.1',
+              help='Address the service listens on (local only by default).')
+@click.option('--port', type=int, default=8765,
+              help='Port of the service.')
+@click.option('--work_folder', type=click.Path(exists=False), default=r'.\service',
+              help='Folder of the processed images of the scenes in memory.')
+@click.option('--memory_mb', type=int, default=1024,
+              help='Memory (MB) of the scored samples of all scenes, least recently used scenes evicted beyond it.')
+@click.option('--cache_folder', type=click.Path(exists=False), default=None,
+              help='Folder caching the processed images and sample levels on disk as well (evicted scenes are '
+                   'scored again from there).')
+@click.option('--cache_hash', type=click.BOOL, default=False,
+              help='Whether the inputs are identified by a hash of their content instead of path, size and mtime.')
+@click.option('--log_mode', type=click.Choice(instrument.MODES), default='quiet',
+              help='Progress lines (progress), one summary line per stage (quiet) or one JSON record per stage '
+                   'on stdout (json).')
+def sampling_service(host,
+                     port,
+                     work_folder,
+                     memory_mb,
+                     cache_folder,
+                     cache_hash,
+                     log_mode):
+    instrument.configure(log_mode)
+    store = SceneStore(work_folder, memory_mb, cache_folder, cache_hash)
+    serve(store, port, host)
+
+
+if __name__ == '__main__':
+    sampling_service()
@@ -0,0 +1,46 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+from func.data_preparation import array_proj  # noqa: E402
+from func.sample_temp.manifest import MANIFEST_NAME, load_manifest  # noqa: E402
+from func.sample_selection.sample_select import sample_select  # noqa: E402
+
+GEO = (100., 0.5, 0, 200., 0, -0.5)
+
+
+def write_candidates(folder, names, sample_size=8):
+    os.makedirs(folder, exist_ok=True)
+    for name in names:
+        array_proj(np.ones((3, sample_size, sample_size), dtype=np.uint8), os.path.join(folder, name), GEO, '')
+
+
+def test_no_overlap_without_manifest(tmp_path):
+    """
+    Folder of level-named tifs without manifest.npz: rows and columns come from the names.
+    """
+    temp_folder = str(tmp_path / 'temp')
+    names = ['s_h{:03d}w{:03d}_t1e1.tif'.format(i, j) for i in range(4) for j in range(4)]
+    write_candidates(temp_folder, names)
+    assert not os.path.exists(os.path.join(temp_folder, MANIFEST_NAME))
+
+    sample_count = np.array([[len(names)]])
+    sample_folder = str(tmp_path / 'samples')
+    sample_select(sample_count, temp_folder, sample_folder, sample_percent=1., delete_temp_folder=False,
+                  stride=4, no_overlap=True)
+
+    selected = load_manifest(sample_folder)
+    assert len(selected) > 0
+    rows, cols = selected['row'].to_numpy(), selected['col'].to_numpy()
+    for k in range(len(selected)):  # windows of 8 pixels every 4: at least 2 rows or columns apart
+        near = (np.abs(rows - rows[k]) < 2) & (np.abs(cols - cols[k]) < 2)
+        assert near.sum() == 1
+
+
+def test_no_overlap_without_positions(tmp_path):
+    temp_folder = str(tmp_path / 'temp')
+    write_candidates(temp_folder, ['a_t1e1.tif', 'b_t1e1.tif'])
+    with pytest.raises(ValueError, match='no_overlap'):
+        sample_select(np.array([[2]]), temp_folder, str(tmp_path / 'samples'), sample_percent=1.,
+                      delete_temp_folder=False, stride=4, no_overlap=True)